@@ -41,6 +41,10 @@ required_packages = ['boto3>=1.9.55', 'numpy>=1.9.0', 'protobuf>=3.1', 'scipy>=0
 if sys.version_info < (3, 4):
     required_packages.append('enum34>=1.1.6')
 
+# concurrent.futures is introduced in Python 3.2. Installing futures back port
+if sys.version_info < (3, 2):
+    required_packages.append('futures>=3.2.0')
+
 setup(name="sagemaker",
       version=get_version(),
       description="Open source library for training and deploying models on Amazon SageMaker.",
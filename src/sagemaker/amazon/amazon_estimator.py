@@ -12,21 +12,51 @@
 # language governing permissions and limitations under the License.
 from __future__ import absolute_import
 
+import hashlib
+import io
 import json
 import logging
-import tempfile
+import zlib
+from collections import deque
+from concurrent import futures
 
+import numpy as np
+from botocore.exceptions import ClientError
+from scipy.sparse import issparse
 from six.moves.urllib.parse import urlparse
 
 from sagemaker.amazon import validation
 from sagemaker.amazon.hyperparameter import Hyperparameter as hp  # noqa
-from sagemaker.amazon.common import write_numpy_to_dense_tensor
+from sagemaker.amazon.common import (read_records_as_numpy, write_numpy_to_dense_tensor,
+                                     write_spmatrix_to_sparse_tensor, _build_recordio_index, _DenseEncoderPool,
+                                     _INDEX_HEADER, _read_recordio_index_header, _RecordIOIndexBuilder,
+                                     _write_recordio_index)
 from sagemaker.estimator import EstimatorBase, _TrainingJob
-from sagemaker.session import s3_input
+from sagemaker.session import Session, s3_input
 from sagemaker.utils import sagemaker_timestamp
 
 logger = logging.getLogger(__name__)
 
+_MB = 1024 * 1024
+# Size in bytes of the shards created from chunked training data
+_DEFAULT_SHARD_SIZE = 128 * _MB
+# Bounds of the shard sizes recommended by recommended_shard_size_mb
+_MIN_SHARD_SIZE_MB, _MAX_SHARD_SIZE_MB = 64, 1024
+# Approximate size in bytes of the RecordIO header and protobuf fields of each record
+_RECORD_OVERHEAD = 32
+# Number of input bytes encoded at a time from chunked training data
+_STREAM_BLOCK_BYTES = 1 << 24
+# Number of shard parts uploaded at the same time
+_UPLOAD_CONCURRENCY = 4
+# Size in bytes of the parts of the multipart uploads of shards, above the 5 MB minimum part size of S3
+_UPLOAD_PART_SIZE = 8 * _MB
+# Maximum number of concurrent ranged GET requests of ``RecordSet.sample``
+_RANGE_GET_CONCURRENCY = 16
+# Compression level of gzip compressed shards, which trades a little size for much faster compression than level 9
+_GZIP_LEVEL = 6
+# Default channels and fractions of records created by ``AmazonAlgorithmEstimatorBase.record_sets``
+_DEFAULT_SPLITS = (('train', .8), ('validation', .1), ('test', .1))
+
 
 class AmazonAlgorithmEstimatorBase(EstimatorBase):
     """Base class for Amazon first-party Estimator implementations. This class isn't intended
@@ -159,7 +189,8 @@ class AmazonAlgorithmEstimatorBase(EstimatorBase):
         if wait:
             self.latest_training_job.wait(logs=logs)
 
-    def record_set(self, train, labels=None, channel="train"):
+    def record_set(self, train, labels=None, channel="train", processes=None, target_shard_size_mb=None,
+                   shards_per_instance=None, cache=False, compression=None, index=False):
         """Build a :class:`~RecordSet` from a numpy :class:`~ndarray` matrix and label vector.
 
         For the 2D ``ndarray`` ``train``, each row is converted to a :class:`~Record` object.
@@ -172,30 +203,218 @@ class AmazonAlgorithmEstimatorBase(EstimatorBase):
         also stored in S3.
 
         The number of S3 objects created is controlled by the ``train_instance_count`` property
-        on this Estimator. One S3 object is created per training instance.
+        on this Estimator. By default, one S3 object is created per training instance. With
+        ``target_shard_size_mb`` or ``shards_per_instance``, the same number of evenly sized objects
+        is created for every training instance instead, which lets Pipe mode overlap S3 reads and
+        shuffles records across more objects. See :func:`recommended_shard_size_mb`.
+
+        ``train`` can also be a scipy sparse matrix, whose rows are stored as sparse tensors. Its shards
+        are cut so that they hold about the same number of non-zero values rather than rows.
+
+        ``train`` and ``labels`` are encoded a block of rows at a time, so they can be ``np.memmap``
+        arrays larger than memory. ``train`` can also be an iterable of ``(features, labels)`` chunks,
+        for example built from the chunks of a pandas ``read_csv`` call with ``chunksize``. The chunks are encoded
+        as they are read and uploaded in shards of about ``target_shard_size_mb`` (default: 128 MB) as each
+        shard is completed, so only one chunk is held in memory at a time. At least ``train_instance_count``
+        shards are created.
+
+        If ``cache`` is True, the records are uploaded under a key prefix derived from a fingerprint of
+        ``train``, ``labels`` and the shard layout rather than from the current time. When the manifest
+        file and the shards under that prefix already exist, they are reused without encoding or uploading
+        anything, which speeds up calling ``record_set`` again with the same data.
+
+        If ``compression`` is 'Gzip', each S3 object is gzip compressed in blocks by the upload threads while
+        the next records are encoded, and the RecordSet declares the compression on its channel. SageMaker only
+        decompresses channels in Pipe input mode, so the channel is set to use Pipe mode.
+
+        If ``index`` is True, an offset index file is uploaded next to each S3 object, which lets
+        :meth:`RecordSet.head` and :meth:`RecordSet.sample` download single records. Index files are
+        not listed in the manifest file, so they are not read by training jobs.
 
         Args:
-            train (numpy.ndarray): A 2D numpy array of training data.
+            train (numpy.ndarray, scipy.sparse.spmatrix or iterable): A 2D numpy array or scipy sparse
+                matrix of training data, or an iterable of ``(features, labels)`` tuples of 2D feature arrays
+                and 1D label arrays (or None).
             labels (numpy.ndarray): A 1D numpy array of labels. Its length must be equal to the
-               number of rows in ``train``.
+               number of rows in ``train``. Must be None if ``train`` is an iterable of chunks.
             channel (str): The SageMaker TrainingJob channel this RecordSet should be assigned to.
+            processes (int): Number of worker processes used to encode ``train`` and ``labels``
+                (default: None). If None or 1, the records are encoded in this process.
+            target_shard_size_mb (float): Approximate size of each S3 object in megabytes (default: None).
+            shards_per_instance (int): Number of S3 objects to create per training instance (default: None).
+                Cannot be combined with ``target_shard_size_mb`` or used with an iterable of chunks.
+            cache (bool): Whether to reuse records uploaded earlier for the same data and shard layout
+                (default: False). Cannot be used with an iterable of chunks.
+            compression (str): Valid values: 'Gzip', None (default: None). The compression of the S3 objects.
+            index (bool): Whether to upload an offset index file next to each S3 object (default: False).
+                Cannot be combined with ``compression``.
         Returns:
             RecordSet: A RecordSet referencing the encoded, uploading training and label data.
         """
+        compression = _compression_type(compression)
         s3 = self.sagemaker_session.boto_session.resource('s3')
         parsed_s3_url = urlparse(self.data_location)
         bucket, key_prefix = parsed_s3_url.netloc, parsed_s3_url.path
-        key_prefix = key_prefix + '{}-{}/'.format(type(self).__name__, sagemaker_timestamp())
-        key_prefix = key_prefix.lstrip('/')
+        if target_shard_size_mb is not None and shards_per_instance is not None:
+            raise ValueError("Only one of target_shard_size_mb and shards_per_instance can be set")
+        if cache:
+            if not hasattr(train, 'shape'):
+                raise ValueError("cache can only be used when train is an array or a sparse matrix")
+            num_shards = self._num_shards(train, target_shard_size_mb, shards_per_instance)
+            fingerprint = _record_set_fingerprint(train, labels, num_shards, compression, index)
+            key_prefix = (key_prefix + '{}-{}/'.format(type(self).__name__, fingerprint)).lstrip('/')
+            manifest_s3_file = _cached_manifest(s3, bucket, key_prefix)
+            if manifest_s3_file is not None:
+                logger.info("Using cached records in manifest file {}".format(manifest_s3_file))
+                return RecordSet(manifest_s3_file, num_records=train.shape[0], feature_dim=train.shape[1],
+                                 channel=channel, compression=compression)
+        else:
+            key_prefix = (key_prefix + '{}-{}/'.format(type(self).__name__, sagemaker_timestamp())).lstrip('/')
         logger.debug('Uploading to bucket {} and key_prefix {}'.format(bucket, key_prefix))
-        manifest_s3_file = upload_numpy_to_s3_shards(self.train_instance_count, s3, bucket, key_prefix, train, labels)
+        manifest_s3_file, num_records, feature_dim = self._upload_records(
+            s3, bucket, key_prefix, train, labels, processes, target_shard_size_mb, shards_per_instance,
+            compression=compression, index=index)
         logger.debug("Created manifest file {}".format(manifest_s3_file))
-        return RecordSet(manifest_s3_file, num_records=train.shape[0], feature_dim=train.shape[1], channel=channel)
+        return RecordSet(manifest_s3_file, num_records=num_records, feature_dim=feature_dim, channel=channel,
+                         compression=compression)
+
+    def record_sets(self, features, labels=None, splits=None, shuffle_seed=None, processes=None,
+                    target_shard_size_mb=None, shards_per_instance=None, compression=None, index=False):
+        """Build a :class:`~RecordSet` for each of several channels from a random split of the rows of
+        ``features`` and ``labels``.
+
+        The rows are shuffled with a random permutation and split into consecutive ranges, one per
+        channel, holding the given fractions of the rows. Fractions that add up to less than 1 leave the
+        remaining rows out. The rows of each channel are gathered a block at a time while they are
+        encoded, so no copy of ``features`` is made for the channels, and the channels are encoded and
+        uploaded concurrently. See :meth:`record_set` for how the records of each channel are stored. The
+        row and shard counts of every channel are checked before uploading, and if a channel fails to upload,
+        the objects of every channel are deleted.
+
+        Args:
+            features (numpy.ndarray or scipy.sparse.spmatrix): A 2D numpy array or scipy sparse matrix
+                of training data.
+            labels (numpy.ndarray): A 1D numpy array of labels. Its length must be equal to the
+               number of rows in ``features``.
+            splits (dict or list): The fraction of the rows for each channel, as a dict or a list of
+                ``(channel, fraction)`` tuples (default: 80% for "train", 10% for "validation" and
+                10% for "test"). A list or ``collections.OrderedDict`` sets the order of the
+                returned RecordSets.
+            shuffle_seed (int): Seed of the random permutation of the rows (default: None). If None,
+                the rows are split differently every time.
+            processes (int): Number of worker processes used to encode each channel (default: None).
+            target_shard_size_mb (float): Approximate size of each S3 object in megabytes (default: None).
+            shards_per_instance (int): Number of S3 objects to create per training instance for each
+                channel (default: None). Cannot be combined with ``target_shard_size_mb``.
+            compression (str): Valid values: 'Gzip', None (default: None). The compression of the S3 objects,
+                see :meth:`record_set`.
+            index (bool): Whether to upload an offset index file next to each S3 object (default: False),
+                see :meth:`record_set`.
+        Returns:
+            list[RecordSet]: A RecordSet for each channel in ``splits``, ready to be passed to :meth:`fit`.
+        """
+        if target_shard_size_mb is not None and shards_per_instance is not None:
+            raise ValueError("Only one of target_shard_size_mb and shards_per_instance can be set")
+        if not hasattr(features, 'shape'):
+            raise ValueError("features must be an array or a sparse matrix")
+        compression = _compression_type(compression)
+        splits = list(_DEFAULT_SPLITS if splits is None else splits.items() if isinstance(splits, dict) else splits)
+        channel_rows = _split_rows(features.shape[0], [fraction for _, fraction in splits], shuffle_seed)
+        # Every channel is checked before any channel is uploaded
+        for (channel, _), rows in zip(splits, channel_rows):
+            num_shards = self._num_shards(features, target_shard_size_mb, shards_per_instance, rows)
+            if len(rows) < num_shards:
+                raise ValueError("Channel {} has {} rows, fewer than its {} shards".format(
+                    channel, len(rows), num_shards))
+
+        parsed_s3_url = urlparse(self.data_location)
+        bucket, key_prefix = parsed_s3_url.netloc, parsed_s3_url.path
+        key_prefix = (key_prefix + '{}-{}/'.format(type(self).__name__, sagemaker_timestamp())).lstrip('/')
+        logger.debug('Uploading to bucket {} and key_prefix {}'.format(bucket, key_prefix))
+        # Each channel is uploaded from its own thread, which needs its own s3 resource
+        resources = [self.sagemaker_session.boto_session.resource('s3') for _ in splits]
+        # The channels share one pool of encoder processes, started before the upload threads
+        pool = _dense_encoder_pool(features, labels, processes)
+        executor = futures.ThreadPoolExecutor(len(splits))
+        channel_prefixes = ['{}{}/'.format(key_prefix, channel) for channel, _ in splits]
+        try:
+            uploads = [executor.submit(self._upload_records, s3, bucket, channel_prefix, features, labels, processes,
+                                       target_shard_size_mb, shards_per_instance, rows=rows,
+                                       compression=compression, index=index, pool=pool)
+                       for s3, channel_prefix, rows in zip(resources, channel_prefixes, channel_rows)]
+            futures.wait(uploads)
+            errors = [upload.exception() for upload in uploads if upload.exception() is not None]
+            if errors:
+                # A failed channel deletes its own objects, the objects of the other channels are deleted here
+                for s3, channel_prefix, upload in zip(resources, channel_prefixes, uploads):
+                    if upload.exception() is None:
+                        _delete_prefix(s3, bucket, channel_prefix)
+                raise errors[0]
+            results = [upload.result() for upload in uploads]
+        finally:
+            executor.shutdown()
+            if pool is not None:
+                pool.close()
+        return [RecordSet(manifest_s3_file, num_records=num_records, feature_dim=feature_dim, channel=channel,
+                          compression=compression)
+                for (manifest_s3_file, num_records, feature_dim), (channel, _) in zip(results, splits)]
+
+    def _upload_records(self, s3, bucket, key_prefix, train, labels, processes, target_shard_size_mb,
+                        shards_per_instance, rows=None, compression=None, index=False, pool=None):
+        """Upload ``train`` and ``labels``, or the rows of them indexed by ``rows``, as shards under
+        ``key_prefix``, see :meth:`record_set`. Dense rows are encoded by ``pool`` if it is not None.
+
+        Returns:
+            tuple: The S3 url of the manifest file, the number of records and the number of features.
+        """
+        if hasattr(train, 'shape'):
+            num_shards = self._num_shards(train, target_shard_size_mb, shards_per_instance, rows)
+            if issparse(train):
+                manifest_s3_file = upload_spmatrix_to_s3_shards(num_shards, s3, bucket, key_prefix, train, labels,
+                                                                rows=rows, compression=compression, index=index)
+            elif pool is not None:
+                manifest_s3_file = _upload_numpy_shards(num_shards, s3, bucket, key_prefix, train, labels, pool,
+                                                        rows=rows, compression=compression, index=index)
+            else:
+                manifest_s3_file = upload_numpy_to_s3_shards(num_shards, s3, bucket, key_prefix, train, labels,
+                                                             processes=processes, rows=rows, compression=compression,
+                                                             index=index)
+            return manifest_s3_file, train.shape[0] if rows is None else len(rows), train.shape[1]
+        if labels is not None:
+            raise ValueError("labels must be None when train is an iterable of (features, labels) chunks")
+        if shards_per_instance is not None:
+            raise ValueError("shards_per_instance cannot be used with an iterable of chunks")
+        shard_size = _DEFAULT_SHARD_SIZE if target_shard_size_mb is None else int(target_shard_size_mb * _MB)
+        return upload_numpy_chunks_to_s3_shards(s3, bucket, key_prefix, train, shard_size=shard_size,
+                                                min_shards=self.train_instance_count, processes=processes,
+                                                compression=compression, index=index)
+
+    def _num_shards(self, train, target_shard_size_mb, shards_per_instance, rows=None):
+        """Return the number of shards to split ``train``, or the rows of it indexed by ``rows``, into,
+        a multiple of ``train_instance_count``. Shard counts derived from ``target_shard_size_mb`` are
+        capped so that every shard holds at least one row."""
+        if shards_per_instance is not None:
+            if shards_per_instance < 1:
+                raise ValueError("shards_per_instance must be >= 1")
+            return self.train_instance_count * shards_per_instance
+        if target_shard_size_mb is not None:
+            if target_shard_size_mb <= 0:
+                raise ValueError("target_shard_size_mb must be > 0")
+            instance_size_mb = _estimated_encoded_size(train) / float(_MB * self.train_instance_count)
+            num_rows = train.shape[0]
+            if rows is not None:
+                instance_size_mb *= len(rows) / float(max(1, num_rows))
+                num_rows = len(rows)
+            shards_per_instance = min(int(round(instance_size_mb / target_shard_size_mb)),
+                                      num_rows // self.train_instance_count)
+            return self.train_instance_count * max(1, shards_per_instance)
+        return self.train_instance_count
 
 
 class RecordSet(object):
 
-    def __init__(self, s3_data, num_records, feature_dim, s3_data_type='ManifestFile', channel='train'):
+    def __init__(self, s3_data, num_records, feature_dim, s3_data_type='ManifestFile', channel='train',
+                 compression=None):
         """A collection of Amazon :class:~`Record` objects serialized and stored in S3.
 
         Args:
@@ -208,12 +427,15 @@ class RecordSet(object):
                 be used to train. If 'ManifestFile', then ``s3_data`` defines a single s3 manifest file, listing
                 each s3 object to train on.
             channel (str): The SageMaker Training Job channel this RecordSet should be bound to
+            compression (str): Valid values: 'Gzip', None (default: None). The compression of the s3 objects.
+                Compressed RecordSets are read in Pipe input mode.
         """
         self.s3_data = s3_data
         self.feature_dim = feature_dim
         self.num_records = num_records
         self.s3_data_type = s3_data_type
         self.channel = channel
+        self.compression = compression
 
     def __repr__(self):
         """Return an unambiguous representation of this RecordSet"""
@@ -225,54 +447,690 @@ class RecordSet(object):
 
     def records_s3_input(self):
         """Return a s3_input to represent the training data"""
+        if self.compression is not None:
+            return s3_input(self.s3_data, distribution='ShardedByS3Key', s3_data_type=self.s3_data_type,
+                            compression=self.compression, input_mode='Pipe')
         return s3_input(self.s3_data, distribution='ShardedByS3Key', s3_data_type=self.s3_data_type)
 
+    def head(self, n, sagemaker_session=None):
+        """Download and decode the first ``n`` records.
+
+        Only the requested records are downloaded, with ranged GET requests located by the offset
+        index files uploaded next to the S3 objects by ``record_set(..., index=True)``.
+
+        Args:
+            n (int): The number of records to return.
+            sagemaker_session (sagemaker.session.Session): Session object which manages interactions
+                with Amazon S3 (default: None). If not specified, one is created using the default AWS
+                configuration chain.
+        Returns:
+            tuple: The features and labels of the records, as returned by
+                :func:`~sagemaker.amazon.common.read_records_as_numpy`.
+        """
+        return read_records_as_numpy(io.BytesIO(_IndexedShards(self, sagemaker_session).head(n)))
+
+    def sample(self, n, random_state=None, sagemaker_session=None):
+        """Download and decode ``n`` records chosen at random without replacement.
+
+        Only the sampled records and their offset index entries are downloaded, with concurrent
+        ranged GET requests, see :meth:`head`. The records are returned in the order they are stored.
+
+        Args:
+            n (int): The number of records to sample.
+            random_state (int or numpy.random.RandomState): Seed or random state used to choose the
+                records (default: None).
+            sagemaker_session (sagemaker.session.Session): Session object which manages interactions
+                with Amazon S3 (default: None). If not specified, one is created using the default AWS
+                configuration chain.
+        Returns:
+            tuple: The features and labels of the records, as returned by
+                :func:`~sagemaker.amazon.common.read_records_as_numpy`.
+        """
+        if not isinstance(random_state, np.random.RandomState):
+            random_state = np.random.RandomState(random_state)
+        return read_records_as_numpy(io.BytesIO(_IndexedShards(self, sagemaker_session).sample(n, random_state)))
+
+
+class _IndexedShards(object):
+    """Read records of the S3 objects of a :class:`RecordSet` with ranged GET requests, located with the
+    offset index file uploaded next to each object."""
+
+    def __init__(self, record_set, sagemaker_session=None):
+        if record_set.s3_data_type != 'ManifestFile':
+            raise ValueError("Records can only be read from a RecordSet with a manifest file")
+        if record_set.compression is not None:
+            raise ValueError("Records cannot be read from compressed objects")
+        sagemaker_session = sagemaker_session or Session()
+        # S3 clients are thread-safe, unlike the s3 resource
+        self._client = sagemaker_session.boto_session.resource('s3').meta.client
+        parsed_s3_url = urlparse(record_set.s3_data)
+        manifest = self._client.get_object(Bucket=parsed_s3_url.netloc, Key=parsed_s3_url.path.lstrip('/'))
+        manifest = json.loads(manifest['Body'].read().decode('utf-8'))
+        parsed_prefix = urlparse(manifest[0]['prefix'])
+        self.bucket = parsed_prefix.netloc
+        self.keys = [parsed_prefix.path.lstrip('/') + file_name for file_name in manifest[1:]]
+
+    def head(self, n):
+        """Return the RecordIO data of the first ``n`` records."""
+        records = []
+        for key in self.keys:
+            if n <= 0:
+                break
+            count = min(n, self._count(key))
+            if count:
+                entries = self._entries(key, 0, count)
+                # The records of a shard are stored back to back, so they are read with a single request
+                records.append(self._get(key, int(entries[0, 0]) - 8, _padded_end(entries[-1])))
+                n -= count
+        return b''.join(records)
+
+    def sample(self, n, random_state):
+        """Return the RecordIO data of ``n`` records chosen at random without replacement."""
+        executor = futures.ThreadPoolExecutor(_RANGE_GET_CONCURRENCY)
+        try:
+            shard_ends = np.cumsum(list(executor.map(self._count, self.keys)), dtype=np.int64)
+            total = int(shard_ends[-1]) if len(shard_ends) else 0
+            if n > total:
+                raise ValueError("Cannot sample {} records from a RecordSet of {} records".format(n, total))
+            positions = _sample_positions(total, n, random_state)
+            shards = np.searchsorted(shard_ends, positions, side='right')
+            starts = np.concatenate([[0], shard_ends])[shards]
+            return b''.join(executor.map(self._record, [self.keys[shard] for shard in shards],
+                                         (positions - starts).tolist()))
+        finally:
+            executor.shutdown()
+
+    def _count(self, key):
+        header = _read_recordio_index_header(self._get(key + '.idx', 0, _INDEX_HEADER.size))
+        if header is None:
+            raise ValueError("Invalid offset index file s3://{}/{}.idx".format(self.bucket, key))
+        return header[2]
+
+    def _entries(self, key, start, end):
+        """Return the (payload offset, payload length) index entries of records ``start`` to ``end``."""
+        data = self._get(key + '.idx', _INDEX_HEADER.size + 16 * start, _INDEX_HEADER.size + 16 * end)
+        return np.frombuffer(data, '<u8').reshape(-1, 2)
+
+    def _record(self, key, position):
+        entry = self._entries(key, position, position + 1)[0]
+        return self._get(key, int(entry[0]) - 8, _padded_end(entry))
+
+    def _get(self, key, start, end):
+        """Return the bytes ``start`` to ``end`` (exclusive) of an object."""
+        try:
+            response = self._client.get_object(Bucket=self.bucket, Key=key,
+                                               Range='bytes={}-{}'.format(start, end - 1))
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey') and key.endswith('.idx'):
+                raise ValueError("No offset index file s3://{}/{}, records must be uploaded with index=True"
+                                 .format(self.bucket, key))
+            raise
+        return response['Body'].read()
+
+
+def _padded_end(entry):
+    """Return the end of the RecordIO record with the offset index ``entry``, including its padding."""
+    return int(entry[0]) + ((int(entry[1]) + 3) >> 2 << 2)
+
+
+def _sample_positions(total, n, random_state):
+    """Return ``n`` distinct integers below ``total`` chosen at random, in increasing order."""
+    if n * 4 >= total:
+        return np.sort(random_state.choice(total, n, replace=False))
+    # Drawing with replacement and dropping duplicates avoids permuting all ``total`` positions
+    positions = np.unique(random_state.randint(0, total, n, dtype=np.int64))
+    while len(positions) < n:
+        draws = random_state.randint(0, total, n - len(positions), dtype=np.int64)
+        positions = np.unique(np.concatenate([positions, draws]))
+    return positions
+
+
+def _compression_type(compression):
+    """Return the ``s3_input`` compression type of the ``compression`` argument of ``record_set``."""
+    if compression is None:
+        return None
+    if str(compression).lower() == 'gzip':
+        return 'Gzip'
+    raise ValueError("Unsupported compression {}, must be 'Gzip' or None".format(compression))
+
+
+def _record_set_fingerprint(train, labels, *layout):
+    """Return a hex digest identifying the records written for ``train`` and ``labels`` with the shard ``layout``."""
+    digest = hashlib.sha1(repr(layout).encode('utf-8'))
+    if issparse(train):
+        train = train.tocsr()
+        arrays = [train.data, train.indices, train.indptr, np.array(train.shape)]
+    else:
+        arrays = [train]
+    for array in arrays + [labels]:
+        if array is None:
+            digest.update(b'None')
+            continue
+        digest.update('{} {}'.format(array.dtype.str, array.shape).encode('utf-8'))
+        rows_per_block = max(1, _STREAM_BLOCK_BYTES // max(1, array[:1].nbytes))
+        for start in range(0, array.shape[0], rows_per_block):
+            digest.update(np.ascontiguousarray(array[start:start + rows_per_block]))
+    return digest.hexdigest()
+
+
+def _cached_manifest(s3, bucket, key_prefix):
+    """Return the S3 url of the manifest file under ``key_prefix`` if it and every shard it lists exist,
+    or None if any of them is missing."""
+    manifest_key = key_prefix + ".amazon.manifest"
+    try:
+        manifest = json.loads(s3.Object(bucket, manifest_key).get()['Body'].read().decode('utf-8'))
+        for file_name in manifest[1:]:
+            s3.meta.client.head_object(Bucket=bucket, Key=key_prefix + file_name)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            return None
+        raise
+    return "s3://{}/{}".format(bucket, manifest_key)
+
+
+def recommended_shard_size_mb(data_size_mb, train_instance_count, min_shards_per_instance=4):
+    """Recommend a ``target_shard_size_mb`` for :meth:`AmazonAlgorithmEstimatorBase.record_set`.
+
+    The recommended size gives every training instance at least ``min_shards_per_instance`` shards,
+    so that Pipe mode can overlap reading one shard with the next, while keeping shards between
+    64 MB and 1 GB so that each S3 read stays efficient.
+
+    Args:
+        data_size_mb (float): Size of the encoded training data in megabytes.
+        train_instance_count (int): Number of training instances.
+        min_shards_per_instance (int): Number of shards each instance should get if the data allows it
+            (default: 4).
+    Returns:
+        int: The recommended shard size in megabytes.
+    """
+    shard_size_mb = data_size_mb / float(train_instance_count * min_shards_per_instance)
+    return int(min(max(shard_size_mb, _MIN_SHARD_SIZE_MB), _MAX_SHARD_SIZE_MB))
+
+
+def _estimated_encoded_size(array):
+    """Estimate the size in bytes of the RecordIO-protobuf records written for the rows of ``array``."""
+    if issparse(array):
+        # Each value is stored with a varint key of a few bytes
+        return array.shape[0] * _RECORD_OVERHEAD + array.nnz * (array.dtype.itemsize + 3)
+    return array.shape[0] * _RECORD_OVERHEAD + array.size * array.dtype.itemsize
+
+
+def _split_rows(num_rows, fractions, shuffle_seed=None):
+    """Return arrays of the indexes of consecutive ranges of a random permutation of ``num_rows`` rows,
+    holding the given ``fractions`` of the rows."""
+    fractions = np.asarray(fractions, dtype=np.float64)
+    if not len(fractions) or np.any(fractions <= 0) or fractions.sum() > 1 + 1e-9:
+        raise ValueError("Split fractions must be > 0 and add up to at most 1: {}".format(fractions.tolist()))
+    permutation = np.random.RandomState(shuffle_seed).permutation(num_rows)
+    bounds = np.minimum(np.round(num_rows * np.cumsum(fractions)).astype(np.int64), num_rows)
+    return np.split(permutation, bounds)[:len(fractions)]
+
 
 def _build_shards(num_shards, array):
+    bounds = _shard_bounds(num_shards, array.shape[0])
+    return [array[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def _delete_prefix(s3, bucket, key_prefix):
+    """Delete every object of ``bucket`` whose key starts with ``key_prefix``."""
+    s3.Bucket(bucket).objects.filter(Prefix=key_prefix).delete()
+
+
+def _shard_bounds(num_shards, num_rows):
+    if num_shards < 1:
+        raise ValueError("num_shards must be >= 1")
+    if num_rows < num_shards:
+        raise ValueError("Array length is less than num shards")
+    # Spread the remainder rows over the shards, so that shard sizes differ by at most one row
+    return [num_rows * i // num_shards for i in range(num_shards + 1)]
+
+
+def _build_sparse_shard_bounds(num_shards, indptr):
+    """Return the row bounds of ``num_shards`` shards of a CSR matrix with row pointers ``indptr``.
+
+    Shards hold about the same number of non-zero values. Each row also counts as one value, so that
+    empty rows are spread evenly and every shard holds at least one row."""
     if num_shards < 1:
         raise ValueError("num_shards must be >= 1")
-    shard_size = int(array.shape[0] / num_shards)
-    if shard_size == 0:
+    num_rows = len(indptr) - 1
+    if num_rows < num_shards:
         raise ValueError("Array length is less than num shards")
-    shards = [array[i * shard_size:i * shard_size + shard_size] for i in range(num_shards - 1)]
-    shards.append(array[(num_shards - 1) * shard_size:])
-    return shards
+    costs = indptr - indptr[0] + np.arange(num_rows + 1)
+    bounds = [0]
+    for shard_index in range(num_shards - 1):
+        # Each shard gets an equal part of the rows left, so that a shard ending after a row with more
+        # values than its part does not leave the next shards empty
+        start = bounds[-1]
+        remaining = num_shards - shard_index
+        target = costs[start] + (costs[-1] - costs[start]) / float(remaining)
+        bound = int(np.searchsorted(costs, target))
+        if bound > 0 and target - costs[bound - 1] < costs[bound] - target:
+            bound -= 1
+        # Keep at least one row in this shard and in each of the next shards
+        bounds.append(min(max(bound, start + 1), num_rows - remaining + 1))
+    return bounds + [num_rows]
 
 
-def upload_numpy_to_s3_shards(num_shards, s3, bucket, key_prefix, array, labels=None):
+def upload_numpy_to_s3_shards(num_shards, s3, bucket, key_prefix, array, labels=None, processes=None, rows=None,
+                              compression=None, index=False):
     """Upload the training ``array`` and ``labels`` arrays to ``num_shards`` s3 objects,
-    stored in "s3://``bucket``/``key_prefix``/"."""
-    shards = _build_shards(num_shards, array)
-    if labels is not None:
-        label_shards = _build_shards(num_shards, labels)
-    uploaded_files = []
-    if key_prefix[-1] != '/':
-        key_prefix = key_prefix + '/'
+    stored in "s3://``bucket``/``key_prefix``/".
+
+    Shards are uploaded in parts while they are encoded, see :class:`_ShardUploader`.
+    If ``processes`` is greater than 1, the shards are encoded by a pool of that many worker processes,
+    started once before the uploads, see :func:`~sagemaker.amazon.common.write_numpy_to_dense_tensor`.
+    If ``rows`` is not None, only the rows indexed by it are uploaded, in that order, without copying
+    ``array`` and ``labels``. If ``compression`` is 'Gzip', the shards are gzip compressed, and if ``index``
+    is True, an offset index file is uploaded next to each shard, see :class:`_ShardUploader`."""
+    pool = _dense_encoder_pool(array, labels, processes)
     try:
-        for shard_index, shard in enumerate(shards):
-            with tempfile.TemporaryFile() as file:
-                if labels is not None:
-                    write_numpy_to_dense_tensor(file, shard, label_shards[shard_index])
-                else:
-                    write_numpy_to_dense_tensor(file, shard)
-                file.seek(0)
-                shard_index_string = str(shard_index).zfill(len(str(len(shards))))
-                file_name = "matrix_{}.pbr".format(shard_index_string)
-                key = key_prefix + file_name
-                logger.debug("Creating object {} in bucket {}".format(key, bucket))
-                s3.Object(bucket, key).put(Body=file)
-                uploaded_files.append(file_name)
-        manifest_key = key_prefix + ".amazon.manifest"
-        manifest_str = json.dumps(
-            [{'prefix': 's3://{}/{}'.format(bucket, key_prefix)}] + uploaded_files)
-        s3.Object(bucket, manifest_key).put(Body=manifest_str.encode('utf-8'))
-        return "s3://{}/{}".format(bucket, manifest_key)
+        return _upload_numpy_shards(num_shards, s3, bucket, key_prefix, array, labels, pool, rows=rows,
+                                    compression=compression, index=index)
+    finally:
+        if pool is not None:
+            pool.close()
+
+
+def _dense_encoder_pool(array, labels, processes):
+    """Return a pool of ``processes`` worker processes sharing the dense ``array`` and ``labels``, or None
+    if the rows are encoded in this process."""
+    if processes is None or processes <= 1 or issparse(array):
+        return None
+    return _DenseEncoderPool(processes, array, labels)
+
+
+def _upload_numpy_shards(num_shards, s3, bucket, key_prefix, array, labels, pool, rows=None, compression=None,
+                         index=False):
+    """Upload ``array`` and ``labels`` as shards, see :func:`upload_numpy_to_s3_shards`, encoding them with
+    the ``_DenseEncoderPool`` ``pool`` sharing these arrays, or in this process if ``pool`` is None."""
+    if rows is not None:
+        shard_rows = _build_shards(num_shards, rows)
+    else:
+        bounds = _shard_bounds(num_shards, array.shape[0])
+        shard_rows = [slice(start, end) for start, end in zip(bounds[:-1], bounds[1:])]
+
+    def write_shard(file, shard_index):
+        shard = shard_rows[shard_index]
+        if pool is not None:
+            pool.write(file, shard)
+        elif isinstance(shard, slice):
+            write_numpy_to_dense_tensor(file, array[shard], None if labels is None else labels[shard])
+        else:
+            write_numpy_to_dense_tensor(file, array, labels, rows=shard)
+
+    return _upload_shards(s3, bucket, key_prefix, num_shards, write_shard, compression, index)
+
+
+def upload_spmatrix_to_s3_shards(num_shards, s3, bucket, key_prefix, array, labels=None, rows=None, compression=None,
+                                 index=False):
+    """Upload the training sparse matrix ``array`` and ``labels`` array to ``num_shards`` s3 objects,
+    stored in "s3://``bucket``/``key_prefix``/".
+
+    Rows are stored as sparse tensors. Shard boundaries are chosen from the cumulative number of
+    non-zero values, so that shards have about the same size even if row densities are skewed.
+    If ``rows`` is not None, only the rows indexed by it are uploaded, in that order, gathering the
+    rows of one shard at a time. If ``compression`` is 'Gzip', the shards are gzip compressed, and if
+    ``index`` is True, an offset index file is uploaded next to each shard."""
+    array = array.tocsr()
+    if rows is None:
+        indptr = array.indptr
+    else:
+        indptr = np.concatenate([[0], np.cumsum(np.diff(array.indptr)[rows])])
+    bounds = _build_sparse_shard_bounds(num_shards, indptr)
+
+    def write_shard(file, shard_index):
+        shard = slice(bounds[shard_index], bounds[shard_index + 1])
+        if rows is not None:
+            shard = rows[shard]
+        if labels is not None:
+            write_spmatrix_to_sparse_tensor(file, array[shard], labels[shard])
+        else:
+            write_spmatrix_to_sparse_tensor(file, array[shard])
+
+    return _upload_shards(s3, bucket, key_prefix, num_shards, write_shard, compression, index)
+
+
+def _upload_shards(s3, bucket, key_prefix, num_shards, write_shard, compression=None, index=False):
+    """Upload ``num_shards`` shards written by ``write_shard(file, shard_index)``, followed by a manifest.
+
+    Shards are uploaded in parts while they are written. If an upload fails, the shards uploaded so far
+    are deleted. Returns the S3 url of the manifest file."""
+    uploader = _ShardUploader(s3, bucket, key_prefix, compression=compression, index=index)
+    try:
+        for shard_index in range(num_shards):
+            shard_index_string = str(shard_index).zfill(len(str(num_shards)))
+            file = uploader.open("matrix_{}.pbr".format(shard_index_string))
+            write_shard(file, shard_index)
+            file.close()
+        return uploader.upload_manifest()
+    except Exception as ex:  # pylint: disable=broad-except
+        try:
+            uploader.delete_uploaded()
+        finally:
+            raise ex
+
+
+def upload_numpy_chunks_to_s3_shards(s3, bucket, key_prefix, chunks, shard_size=_DEFAULT_SHARD_SIZE, min_shards=1,
+                                     processes=None, compression=None, index=False):
+    """Upload an iterable of ``(features, labels)`` array chunks to s3 objects of about ``shard_size`` bytes,
+    stored in "s3://``bucket``/``key_prefix``/".
+
+    Chunks are encoded as they are read and uploaded in parts while they are encoded, so only one chunk and
+    a few parts need to be in memory at a time. The labels of every chunk may be None. If the chunks fill
+    fewer than ``min_shards`` objects, the records of the last one are split to create ``min_shards`` objects,
+    so the first ``min_shards - 1`` objects are held in memory until they are complete. ``shard_size`` is the
+    size of the objects before compression, if ``compression`` is 'Gzip'. If ``index`` is True, an offset
+    index file is uploaded next to each object.
+
+    Returns:
+        tuple: The S3 url of the manifest file, the number of records and the number of features.
+    """
+    # The encoder processes are started before the upload threads, and receive the rows of each block
+    pool = _DenseEncoderPool(processes) if processes is not None and processes > 1 else None
+    uploader = _ShardUploader(s3, bucket, key_prefix, compression=compression, index=index)
+    shard = None
+    num_records, feature_dim = 0, None
+    try:
+        # Blocks grow with the number of processes, so that every process encodes a part of each block
+        block_bytes = _STREAM_BLOCK_BYTES * max(1, processes or 1)
+        for features, labels in chunks:
+            features = np.asarray(features)
+            labels = None if labels is None else np.asarray(labels)
+            feature_dim = _chunk_feature_dim(features, feature_dim)
+            rows_per_block = max(1, block_bytes // max(1, feature_dim * features.dtype.itemsize))
+            shard = _write_stream_chunk(uploader, shard, features, labels, pool, rows_per_block, shard_size,
+                                        min_shards)
+            num_records += features.shape[0]
+        if feature_dim is None:
+            raise ValueError("No chunks to upload")
+        shard = _open_stream_shard(uploader, min_shards) if shard is None else shard
+        _upload_stream_shards(uploader, shard, max(1, min_shards - len(uploader.uploaded_files)))
+        return uploader.upload_manifest(), num_records, feature_dim
     except Exception as ex:  # pylint: disable=broad-except
         try:
-            for file in uploaded_files:
-                s3.Object(bucket, key_prefix + file).delete()
+            uploader.delete_uploaded()
         finally:
             raise ex
+    finally:
+        if pool is not None:
+            pool.close()
+
+
+def _write_stream_chunk(uploader, shard, features, labels, pool, rows_per_block, shard_size, min_shards):
+    """Write the rows of a chunk to the streamed shards, starting with ``shard``, and return the last shard.
+
+    Rows are encoded in blocks of at most ``rows_per_block`` rows, split between the processes of ``pool``
+    if it is not None. Blocks hold at most the rows estimated to fill the rest of the shard they are
+    written to, so that shards only exceed ``shard_size`` by about a row."""
+    first_row = io.BytesIO()
+    write_numpy_to_dense_tensor(first_row, features[:1], None if labels is None else labels[:1])
+    row_size = float(first_row.tell())
+    start = 0
+    while start < features.shape[0]:
+        shard = _next_stream_shard(uploader, shard, shard_size, min_shards)
+        position = shard.tell()
+        rows_to_fill = int(-(-(shard_size - position) // row_size))
+        end = min(features.shape[0], start + max(1, min(rows_per_block, rows_to_fill)))
+        block_labels = None if labels is None else labels[start:end]
+        if pool is not None:
+            pool.write_arrays(shard, features[start:end], block_labels)
+        else:
+            write_numpy_to_dense_tensor(shard, features[start:end], block_labels)
+        # The size of the rows written so far estimates the size of the next ones
+        row_size = (shard.tell() - position) / float(end - start)
+        start = end
+    return shard
+
+
+def _chunk_feature_dim(features, feature_dim):
+    """Return the number of features in a chunk, checking that it is ``feature_dim`` if that is not None."""
+    if len(features.shape) != 2 or feature_dim not in (None, features.shape[1]):
+        raise ValueError("Chunk shape {} not compatible with feature dimension {}".format(features.shape, feature_dim))
+    return features.shape[1]
+
+
+def _next_stream_shard(uploader, shard, shard_size, min_shards):
+    """Return the shard to write the next block of chunked data to, finishing ``shard`` if it is full.
+
+    A shard is only started once records follow, so that the last shard, which may be split, is never empty."""
+    if shard is not None and shard.tell() >= shard_size:
+        _upload_stream_shards(uploader, shard, 1)
+        shard = None
+    return _open_stream_shard(uploader, min_shards) if shard is None else shard
+
+
+def _open_stream_shard(uploader, min_shards):
+    """Return the file to write the next shard of chunked data to: an in-memory buffer if the shard may
+    have to be split to create ``min_shards`` shards, otherwise a file uploading it while it is written."""
+    if len(uploader.uploaded_files) + 1 < min_shards:
+        return io.BytesIO()
+    return uploader.open(_stream_shard_name(len(uploader.uploaded_files)))
+
+
+def _upload_stream_shards(uploader, file, num_shards):
+    """Finish uploading the shard written to ``file``, a file returned by :func:`_open_stream_shard`.
+
+    The RecordIO records of a shard written to memory are uploaded as ``num_shards`` objects with equal
+    numbers of records."""
+    if not isinstance(file, io.BytesIO):
+        file.close()
+        return
+    # Python 2 has no BytesIO.getbuffer
+    data = file.getbuffer() if hasattr(file, 'getbuffer') else memoryview(file.getvalue())
+    size = len(data)
+    if num_shards == 1:
+        bounds = [0, size]
+    else:
+        record_starts = _build_recordio_index(data, size)[:, 0].astype(np.int64) - 8
+        if len(record_starts) < num_shards:
+            raise ValueError("Record count {} is less than num shards {}".format(len(record_starts), num_shards))
+        bounds = [int(record_starts[len(record_starts) * i // num_shards]) for i in range(num_shards)] + [size]
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        shard = uploader.open(_stream_shard_name(len(uploader.uploaded_files)))
+        shard.write(data[start:end])
+        shard.close()
+
+
+def _stream_shard_name(shard_index):
+    # The number of shards is not known in advance, so shard indexes have a fixed width
+    return "matrix_{}.pbr".format(str(shard_index).zfill(4))
+
+
+class _ShardUploader(object):
+    """Upload shards to objects under an S3 key prefix, followed by a manifest file listing them.
+
+    Shards are written to the files returned by :meth:`open`, which upload them in parts of about
+    ``_UPLOAD_PART_SIZE`` bytes with a multipart upload while they are written, or with a single request
+    if they are smaller than a part. Parts are uploaded by a pool of ``max_concurrency`` threads, and
+    writing blocks while ``max_concurrency`` parts are being uploaded, so at most that many parts and
+    the part being written are held in memory.
+
+    If ``compression`` is 'Gzip', ".gz" is appended to the shard names, and blocks of about
+    ``_UPLOAD_PART_SIZE`` bytes of each shard are compressed by the upload threads into gzip members,
+    which are uploaded in order in parts of at least ``_UPLOAD_PART_SIZE`` bytes. A gzip file may hold
+    several members, which are decompressed one after the other. If ``index`` is True, an offset index of
+    the records of each shard is built while it is written and uploaded when it is complete, in the format
+    of :class:`~sagemaker.amazon.common.RecordIOFile` index files, with ".idx" appended to the shard name.
+    Index files are not listed in the manifest file."""
+
+    def __init__(self, s3, bucket, key_prefix, max_concurrency=_UPLOAD_CONCURRENCY, compression=None, index=False):
+        if key_prefix[-1] != '/':
+            key_prefix = key_prefix + '/'
+        self.s3 = s3
+        # S3 clients are thread-safe, unlike the s3 resource and its Object resources
+        self.client = s3.meta.client
+        self.bucket = bucket
+        self.key_prefix = key_prefix
+        self.max_concurrency = max_concurrency
+        self.part_size = _UPLOAD_PART_SIZE
+        self.compression = _compression_type(compression)
+        if index and self.compression is not None:
+            raise ValueError("Offset index files cannot be uploaded for compressed shards")
+        self.index = index
+        self.uploaded_files = []
+        self._executor = futures.ThreadPoolExecutor(max_concurrency)
+        self._pending = []
+        # Keys and upload ids of the multipart uploads that are not complete
+        self._multipart_uploads = {}
+
+    def open(self, file_name):
+        """Return a writable file-like object uploading what is written to it as ``file_name``.
+
+        The upload is complete once the file is closed and :meth:`upload_manifest` returns."""
+        if self.compression == 'Gzip':
+            file_name += '.gz'
+        self.uploaded_files.append(file_name)
+        key = self.key_prefix + file_name
+        logger.debug("Creating object {} in bucket {}".format(key, self.bucket))
+        return _ShardWriter(self, key)
+
+    def submit(self, fn, *args):
+        """Run ``fn(*args)`` in an upload thread, after waiting for a thread to be available."""
+        self._wait(self.max_concurrency - 1)
+        future = self._executor.submit(fn, *args)
+        self._pending.append(future)
+        return future
+
+    def create_multipart_upload(self, key):
+        upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=key)['UploadId']
+        self._multipart_uploads[key] = upload_id
+        return upload_id
+
+    def upload_part(self, key, upload_id, part_number, body):
+        response = self.client.upload_part(Bucket=self.bucket, Key=key, UploadId=upload_id, PartNumber=part_number,
+                                           Body=body)
+        return {'ETag': response['ETag'], 'PartNumber': part_number}
+
+    def complete_multipart_upload(self, key, upload_id, parts):
+        """Complete a multipart upload once the uploads of its ``parts`` futures are done."""
+        self.client.complete_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id,
+                                              MultipartUpload={'Parts': [part.result() for part in parts]})
+        self._multipart_uploads.pop(key, None)
+
+    def put_object(self, key, body):
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=body)
+
+    def upload_manifest(self):
+        """Wait for the shard uploads, then upload the manifest file listing them and return its S3 url."""
+        self._wait(0)
+        self._executor.shutdown()
+        manifest_key = self.key_prefix + ".amazon.manifest"
+        manifest_str = json.dumps(
+            [{'prefix': 's3://{}/{}'.format(self.bucket, self.key_prefix)}] + self.uploaded_files)
+        self.s3.Object(self.bucket, manifest_key).put(Body=manifest_str.encode('utf-8'))
+        return "s3://{}/{}".format(self.bucket, manifest_key)
+
+    def delete_uploaded(self):
+        """Stop the shard uploads, abort the multipart uploads that are not complete and delete the shards
+        uploaded so far."""
+        for future in self._pending:
+            future.cancel()
+        self._executor.shutdown()
+        for key, upload_id in list(self._multipart_uploads.items()):
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id)
+        for file_name in self.uploaded_files:
+            self.s3.Object(self.bucket, self.key_prefix + file_name).delete()
+            if self.index:
+                self.s3.Object(self.bucket, self.key_prefix + file_name + '.idx').delete()
+
+    def _wait(self, max_pending):
+        """Wait until at most ``max_pending`` uploads are pending, raising the error of any failed upload."""
+        while len(self._pending) > max_pending:
+            done, not_done = futures.wait(self._pending, return_when=futures.FIRST_COMPLETED)
+            self._pending = list(not_done)
+            for future in done:
+                future.result()
+
+
+class _ShardWriter(object):
+    """A writable file-like object uploading a shard in parts while it is written, see :meth:`_ShardUploader.open`.
+    """
+
+    def __init__(self, uploader, key):
+        self.key = key
+        self._uploader = uploader
+        # The data of the next part
+        self._buffer = bytearray()
+        self._size = 0
+        self._upload_id = None
+        self._parts = []
+        self._index = _RecordIOIndexBuilder() if uploader.index else None
+        # The uncompressed data of the next gzip member, and the futures of the members being compressed
+        self._uncompressed = bytearray() if uploader.compression == 'Gzip' else None
+        self._members = deque()
+
+    def write(self, data):
+        if self._index is not None:
+            self._index.update(data)
+        self._size += len(memoryview(data))
+        if self._uncompressed is None:
+            self._buffer = self._fill(self._buffer, data, self._upload_part)
+        else:
+            self._uncompressed = self._fill(self._uncompressed, data, self._compress)
+
+    def tell(self):
+        """Return the number of bytes written, before compression."""
+        return self._size
+
+    def close(self):
+        """Start uploading the rest of the shard, and complete its upload once every part is uploaded."""
+        if self._buffer is None:
+            return
+        uploader = self._uploader
+        if self._uncompressed is not None:
+            # An empty shard is compressed to an empty gzip member
+            if self._uncompressed or self._size == 0:
+                self._compress(self._uncompressed)
+            self._add_members(0)
+        if self._upload_id is None:
+            uploader.submit(uploader.put_object, self.key, self._buffer)
+        else:
+            if self._buffer:
+                self._upload_part(self._buffer)
+            uploader.submit(uploader.complete_multipart_upload, self.key, self._upload_id, self._parts)
+        if self._index is not None:
+            index_file = io.BytesIO()
+            _write_recordio_index(index_file, self._index.index(), self._index.size)
+            uploader.submit(uploader.put_object, self.key + '.idx', index_file.getvalue())
+        self._buffer = self._uncompressed = None
+
+    def _fill(self, buffer, data, flush):
+        """Append ``data`` to ``buffer``, passing every ``_UPLOAD_PART_SIZE`` bytes to ``flush``, and return
+        the buffer of the rest."""
+        data = memoryview(data)
+        part_size = self._uploader.part_size
+        while len(data):
+            size = part_size - len(buffer)
+            buffer += data[:size]
+            data = data[size:]
+            if len(buffer) >= part_size:
+                flush(buffer)
+                buffer = bytearray()
+        return buffer
+
+    def _compress(self, data):
+        self._members.append(self._uploader.submit(_gzip_compress, data))
+        self._add_members(self._uploader.max_concurrency)
+
+    def _add_members(self, max_pending):
+        """Add the compressed gzip members to the parts in order, waiting until at most ``max_pending``
+        members are being compressed."""
+        while self._members and (len(self._members) > max_pending or self._members[0].done()):
+            self._buffer = self._fill(self._buffer, self._members.popleft().result(), self._upload_part)
+
+    def _upload_part(self, body):
+        uploader = self._uploader
+        if self._upload_id is None:
+            self._upload_id = uploader.create_multipart_upload(self.key)
+        self._parts.append(uploader.submit(uploader.upload_part, self.key, self._upload_id, len(self._parts) + 1,
+                                           body))
+
+
+def _gzip_compress(data):
+    """Return ``data`` compressed to a gzip member, without a modification time so that the compressed
+    shards of the same records are identical."""
+    compressor = zlib.compressobj(_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
 
 
 def registry(region_name, algorithm=None):
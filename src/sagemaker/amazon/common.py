@@ -13,14 +13,23 @@
 from __future__ import absolute_import
 
 import io
+import logging
+import mmap
+import multiprocessing
+import os
+import shutil
 import struct
 import sys
+import tempfile
 
 import numpy as np
-from scipy.sparse import issparse
+import six
+from scipy.sparse import csr_matrix, issparse
 
 from sagemaker.amazon.record_pb2 import Record
 
+logger = logging.getLogger(__name__)
+
 
 class numpy_to_record_serializer(object):
 
@@ -37,6 +46,34 @@ class numpy_to_record_serializer(object):
         return buf
 
 
+class spmatrix_to_record_serializer(object):
+    """Serialize the rows of a scipy sparse matrix as sparse tensors, see :func:`write_spmatrix_to_sparse_tensor`."""
+
+    def __init__(self, content_type='application/x-recordio-protobuf'):
+        self.content_type = content_type
+
+    def __call__(self, array):
+        buf = io.BytesIO()
+        write_spmatrix_to_sparse_tensor(buf, array)
+        buf.seek(0)
+        return buf
+
+
+class record_serializer(object):
+    """Serialize scipy sparse matrices with :class:`spmatrix_to_record_serializer` and other arrays with
+    :class:`numpy_to_record_serializer`."""
+
+    def __init__(self, content_type='application/x-recordio-protobuf'):
+        self.content_type = content_type
+        self.dense_serializer = numpy_to_record_serializer(content_type)
+        self.sparse_serializer = spmatrix_to_record_serializer(content_type)
+
+    def __call__(self, array):
+        if issparse(array):
+            return self.sparse_serializer(array)
+        return self.dense_serializer(array)
+
+
 class record_deserializer(object):
 
     def __init__(self, accept='application/x-recordio-protobuf'):
@@ -49,46 +86,50 @@ class record_deserializer(object):
             stream.close()
 
 
-def _write_feature_tensor(resolved_type, record, vector):
-    if resolved_type == "Int32":
-        record.features["values"].int32_tensor.values.extend(vector)
-    elif resolved_type == "Float64":
-        record.features["values"].float64_tensor.values.extend(vector)
-    elif resolved_type == "Float32":
-        record.features["values"].float32_tensor.values.extend(vector)
+class record_to_numpy_deserializer(object):
+    """Decode a RecordIO-protobuf response into a dict mapping label keys to numpy arrays.
 
+    Each array holds one row per record, see :func:`read_records_as_numpy`.
+    """
 
-def _write_label_tensor(resolved_type, record, scalar):
-    if resolved_type == "Int32":
-        record.label["values"].int32_tensor.values.extend([scalar])
-    elif resolved_type == "Float64":
-        record.label["values"].float64_tensor.values.extend([scalar])
-    elif resolved_type == "Float32":
-        record.label["values"].float32_tensor.values.extend([scalar])
+    def __init__(self, accept='application/x-recordio-protobuf', label_keys=None):
+        self.accept = accept
+        self.label_keys = label_keys
 
+    def __call__(self, stream, content_type):
+        try:
+            return read_records_as_numpy(stream, self.label_keys)[1]
+        finally:
+            stream.close()
 
-def _write_keys_tensor(resolved_type, record, vector):
-    if resolved_type == "Int32":
-        record.features["values"].int32_tensor.keys.extend(vector)
-    elif resolved_type == "Float64":
-        record.features["values"].float64_tensor.keys.extend(vector)
-    elif resolved_type == "Float32":
-        record.features["values"].float32_tensor.keys.extend(vector)
 
+def write_numpy_to_dense_tensor(file, array, labels=None, processes=None, rows=None):
+    """Writes a numpy array to a dense tensor
 
-def _write_shape(resolved_type, record, scalar):
-    if resolved_type == "Int32":
-        record.features["values"].int32_tensor.shape.extend([scalar])
-    elif resolved_type == "Float64":
-        record.features["values"].float64_tensor.shape.extend([scalar])
-    elif resolved_type == "Float32":
-        record.features["values"].float32_tensor.shape.extend([scalar])
+    Args:
+        file (file): The file object to write the RecordIO-protobuf records to.
+        array (numpy.ndarray): A 2D numpy array, one record is written per row.
+        labels (numpy.ndarray): A 1D numpy array of labels, one per row of ``array`` (default: None).
+        processes (int): Number of worker processes used to encode the rows (default: None). If None
+            or 1, the rows are encoded in the calling process. The worker processes are started for
+            this call, and share ``array`` and ``labels`` through forked or memory-mapped memory rather
+            than receiving a pickled copy.
+        rows (numpy.ndarray): A 1D array of indexes of the rows of ``array`` and ``labels`` to write, in
+            order (default: None). If None, all rows are written. Rows are gathered a block at a time
+            while they are encoded, so ``array`` and ``labels`` are never copied as a whole.
+    """
 
+    resolved_type, resolved_label_type = _resolve_dense_types(array, labels)
+    num_rows = array.shape[0] if rows is None else len(rows)
+    if processes is not None and processes > 1 and num_rows > 1:
+        with _DenseEncoderPool(processes, array, labels) as pool:
+            pool.write(file, rows)
+    else:
+        _write_dense_blocks(file, array, labels, resolved_type, resolved_label_type, rows)
 
-def write_numpy_to_dense_tensor(file, array, labels=None):
-    """Writes a numpy array to a dense tensor"""
 
-    # Validate shape of array and labels, resolve array and label types
+def _resolve_dense_types(array, labels):
+    """Validate the shapes of ``array`` and ``labels`` and return their tensor types."""
     if not len(array.shape) == 2:
         raise ValueError("Array must be a Matrix")
     if labels is not None:
@@ -97,17 +138,13 @@ def write_numpy_to_dense_tensor(file, array, labels=None):
         if labels.shape[0] not in array.shape:
             raise ValueError("Label shape {} not compatible with array shape {}".format(
                              labels.shape, array.shape))
+        if labels.shape[0] < array.shape[0]:
+            raise ValueError("Label shape {} has fewer labels than array shape {} has rows".format(
+                             labels.shape, array.shape))
         resolved_label_type = _resolve_type(labels.dtype)
-    resolved_type = _resolve_type(array.dtype)
-
-    # Write each vector in array into a Record in the file object
-    record = Record()
-    for index, vector in enumerate(array):
-        record.Clear()
-        _write_feature_tensor(resolved_type, record, vector)
-        if labels is not None:
-            _write_label_tensor(resolved_label_type, record, labels[index])
-        _write_recordio(file, record.SerializeToString())
+    else:
+        resolved_label_type = None
+    return _resolve_type(array.dtype), resolved_label_type
 
 
 def write_spmatrix_to_sparse_tensor(file, array, labels=None):
@@ -125,39 +162,56 @@ def write_spmatrix_to_sparse_tensor(file, array, labels=None):
         if labels.shape[0] not in array.shape:
             raise ValueError("Label shape {} not compatible with array shape {}".format(
                              labels.shape, array.shape))
+        if labels.shape[0] < array.shape[0]:
+            raise ValueError("Label shape {} has fewer labels than array shape {} has rows".format(
+                             labels.shape, array.shape))
         resolved_label_type = _resolve_type(labels.dtype)
+    else:
+        resolved_label_type = None
     resolved_type = _resolve_type(array.dtype)
 
-    csr_array = array.tocsr()
-    n_rows, n_cols = csr_array.shape
-
-    record = Record()
-    for row_idx in range(n_rows):
-        record.Clear()
-        row = csr_array.getrow(row_idx)
-        # Write values
-        _write_feature_tensor(resolved_type, record, row.data)
-        # Write keys
-        _write_keys_tensor(resolved_type, record, row.indices.astype(np.uint64))
-
-        # Write labels
-        if labels is not None:
-            _write_label_tensor(resolved_label_type, record, labels[row_idx])
-
-        # Write shape
-        _write_shape(resolved_type, record, n_cols)
-
-        _write_recordio(file, record.SerializeToString())
+    indptr, indices, data = _csr_components(array)
+    _write_sparse_blocks(file, indptr, indices, data, array.shape[1], labels, resolved_type,
+                         resolved_label_type)
 
 
 def read_records(file):
     """Eagerly read a collection of amazon Record protobuf objects from file."""
-    records = []
+    return list(iter_records(file))
+
+
+def iter_records(file):
+    """Lazily read amazon Record protobuf objects from file, parsing one record at a time."""
     for record_data in read_recordio(file):
         record = Record()
         record.ParseFromString(record_data)
-        records.append(record)
-    return records
+        yield record
+
+
+def read_records_as_numpy(file, label_keys=None):
+    """Read the tensors of the amazon Records in file straight into numpy arrays.
+
+    Records are decoded from large buffered reads of file without creating ``Record`` objects.
+    Dense tensors are returned as arrays with one row per record, sparse tensors (tensors with
+    keys) as :class:`~scipy.sparse.csr_matrix` objects. Label tensors holding a single value per
+    record are returned as 1D arrays.
+
+    Args:
+        file: A file-like object to read RecordIO-encoded Records from.
+        label_keys (list[str]): The keys of the label tensors to return. If None, every label
+            tensor is returned.
+
+    Returns:
+        tuple: The "values" features tensor of the records (None if the records have no
+            features), and a dict mapping label keys to arrays.
+    """
+    features, labels = _read_tensor_columns(file)
+    if label_keys is not None:
+        missing = [key for key in label_keys if key not in labels]
+        if missing:
+            raise ValueError("Label keys {} not found in records".format(missing))
+        labels = {key: labels[key] for key in label_keys}
+    return features.get('values'), labels
 
 
 # MXNet requires recordio records have length in bytes that's a multiple of 4
@@ -184,24 +238,948 @@ def _write_recordio(f, data):
 
 
 def read_recordio(f):
-    while(True):
-        try:
-            read_kmagic, = struct.unpack('I', f.read(4))
-        except struct.error:
+    for buf, offsets, lengths in _read_recordio_chunks(f):
+        for offset, length in zip(offsets, lengths):
+            yield buf[offset:offset + length]
+
+
+# Number of bytes the RecordIO readers request from the underlying file per read.
+_READ_CHUNK_BYTES = 1 << 24
+
+
+def _read_recordio_chunks(f):
+    """Read RecordIO data from ``f`` in large chunks.
+
+    Yields (buffer, offsets, lengths) tuples, where ``offsets`` and ``lengths`` locate the payloads
+    of the records that are complete in ``buffer``. A record truncated by the end of the file is
+    returned with the bytes that are available."""
+    pending = b''
+    while True:
+        data = f.read(_READ_CHUNK_BYTES)
+        buf = pending + data if pending else data
+        offsets, lengths, position = _scan_recordio(buf, 0, len(buf), partial=not data)
+        if offsets:
+            yield buf, offsets, lengths
+        if not data:
             return
+        pending = buf[position:]
+
+
+def _scan_recordio(buf, position, end, partial=True):
+    """Locate the records in ``buf[position:end]`` by reading their RecordIO headers.
+
+    Returns the payload offsets and lengths of the records found, and the position after the last
+    one. A record extending past ``end`` is included with the available bytes if ``partial`` is
+    True, otherwise scanning stops at its header."""
+    offsets, lengths = [], []
+    while position + 8 <= end:
+        read_kmagic, len_record = struct.unpack_from('II', buf, position)
+        assert read_kmagic == _kmagic
+        padded_end = position + 8 + (((len_record + 3) >> 2) << 2)
+        if padded_end > end and not partial:
+            break
+        offsets.append(position + 8)
+        lengths.append(min(len_record, end - position - 8))
+        position = padded_end
+    return offsets, lengths, position
+
+
+class RecordIOFile(object):
+    """Random access to the records of a RecordIO file, such as a ``matrix_*.pbr`` shard.
+
+    The file is memory-mapped, and records are returned as zero-copy ``memoryview`` objects over
+    their payloads, which can be parsed with ``Record.ParseFromString``.
+
+    Record boundaries are found with an offset index. The index is loaded from a sidecar file if
+    one exists and matches the size and modification time of the file and the headers of its first
+    and last records, otherwise it is built by scanning the record headers and saved to the sidecar
+    for later use.
+    """
+
+    def __init__(self, path, index_path=None, save_index=True):
+        """Open a RecordIO file for random access.
+
+        Args:
+            path (str): Path of the RecordIO file.
+            index_path (str): Path of the offset index sidecar file (default: ``path`` + '.idx').
+            save_index (bool): Whether to save the index to ``index_path`` when it has to be built
+                (default: True).
+        """
+        self.path = path
+        self.index_path = index_path or path + '.idx'
+        self._mmap = self._buffer = None
+        self._file = open(path, 'rb')
+        try:
+            self._open(save_index)
+        except Exception:
+            self.close()
+            raise
+
+    def _open(self, save_index):
+        stat = os.fstat(self._file.fileno())
+        size, mtime = stat.st_size, stat.st_mtime
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        self._buffer = memoryview(np.frombuffer(self._mmap, dtype=np.uint8) if size else b'')
+
+        index = _load_recordio_index(self.index_path, size, mtime)
+        if index is None or not _index_matches(self._mmap, size, index):
+            index = _build_recordio_index(self._mmap, size)
+            if save_index:
+                try:
+                    with open(self.index_path, 'wb') as index_file:
+                        _write_recordio_index(index_file, index, size, mtime)
+                except (IOError, OSError) as e:
+                    logger.debug("Could not save RecordIO index {}: {}".format(self.index_path, e))
+        self.offsets, self.lengths = index[:, 0], index[:, 1]
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        """Return the payload of a record as a memoryview, or a list of them for a slice."""
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        offset, length = int(self.offsets[index]), int(self.lengths[index])
+        return self._buffer[offset:offset + length]
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def sample(self, n, random_state=None):
+        """Return the payloads of ``n`` records chosen at random without replacement.
+
+        Args:
+            n (int): The number of records to sample.
+            random_state (int or numpy.random.RandomState): Seed or random state used to choose the
+                records (default: None).
+        """
+        if not isinstance(random_state, np.random.RandomState):
+            random_state = np.random.RandomState(random_state)
+        return [self[i] for i in random_state.choice(len(self), n, replace=False)]
+
+    def close(self):
+        """Close the file."""
+        self._buffer = None
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # Views returned by __getitem__ are still alive, the mapping is released with them
+                pass
+            self._mmap = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# An offset index is stored as a header followed by the (payload offset, payload length) of each
+# record as little-endian uint64 pairs. The header records the size and modification time of the
+# indexed file so that a stale index is detected. The modification time is 0 for indexes of S3
+# objects, which are uploaded together with the object.
+_INDEX_MAGIC = b'RIDX'
+_INDEX_VERSION = 2
+# magic, format version, indexed file size, indexed file modification time, record count
+_INDEX_HEADER = struct.Struct('<4sIQdQ')
+
+
+def _build_recordio_index(buf, size):
+    """Return an (n, 2) uint64 array with the payload offset and length of each record in ``buf``."""
+    offsets, lengths, _ = _index_recordio(buf, 0, size)
+    # The last record of a truncated file is indexed with the bytes that are available
+    lengths = np.minimum(lengths, size - offsets)
+    return np.stack([offsets, lengths], axis=1).astype(np.uint64)
+
+
+def _index_recordio(buf, position, end):
+    """Locate the records whose headers are in ``buf[position:end]``.
+
+    Returns int64 arrays of the payload offsets and lengths of the records, whose payloads may extend
+    past ``end``, and the position of the next record header, which is past ``end`` or a header
+    truncated by ``end``."""
+    if position + 8 <= end:
+        # Files written from dense arrays usually hold records of a single length, which can be
+        # verified without a Python loop over the records
+        _, len_record = struct.unpack_from('II', buf, position)
+        stride = 8 + (((len_record + 3) >> 2) << 2)
+        count = (end - position - 8) // stride + 1
+        headers = np.ndarray((count, 2), '=u4', buffer=buf, offset=position, strides=(stride, 4))
+        if (headers[:, 0] == _kmagic).all() and (headers[:, 1] == len_record).all():
+            offsets = np.arange(count, dtype=np.int64) * stride + (position + 8)
+            return offsets, np.full(count, len_record, dtype=np.int64), position + count * stride
+    offsets, lengths = [], []
+    while position + 8 <= end:
+        read_kmagic, len_record = struct.unpack_from('II', buf, position)
         assert read_kmagic == _kmagic
-        len_record, = struct.unpack('I', f.read(4))
-        pad = (((len_record + 3) >> 2) << 2) - len_record
-        yield f.read(len_record)
-        if pad:
-            f.read(pad)
+        offsets.append(position + 8)
+        lengths.append(len_record)
+        position += 8 + (((len_record + 3) >> 2) << 2)
+    return np.array(offsets, dtype=np.int64), np.array(lengths, dtype=np.int64), position
+
+
+class _RecordIOIndexBuilder(object):
+    """Build the offset index of RecordIO data that is written in pieces, which may split records and
+    their headers, such as a shard streamed to S3."""
+
+    def __init__(self):
+        self.size = 0
+        self._next = 0  # Position of the next record header
+        self._header = b''  # Bytes of the next record header written so far
+        self._offsets = []
+        self._lengths = []
+
+    def update(self, data):
+        """Locate the records in ``data``, the next bytes of the indexed data."""
+        data = np.frombuffer(data, dtype=np.uint8)
+        position = self._next - self.size
+        if position < 0:
+            # The previous pieces ended within the header of a record
+            self._header += data[:position + 8].tobytes()
+            if len(self._header) < 8:
+                self.size += len(data)
+                return
+            read_kmagic, len_record = struct.unpack('II', self._header)
+            assert read_kmagic == _kmagic
+            self._add(np.array([self._next + 8]), np.array([len_record]))
+            self._next += 8 + (((len_record + 3) >> 2) << 2)
+            self._header = b''
+            position = self._next - self.size
+        if position < len(data):
+            offsets, lengths, position = _index_recordio(data, position, len(data))
+            self._add(offsets + self.size, lengths)
+            self._next = self.size + position
+            if position < len(data):
+                self._header = data[position:].tobytes()
+        self.size += len(data)
+
+    def _add(self, offsets, lengths):
+        self._offsets.append(offsets)
+        self._lengths.append(lengths)
+
+    def index(self):
+        """Return an (n, 2) uint64 array with the payload offset and length of each record written."""
+        if not self._offsets:
+            return np.zeros((0, 2), dtype=np.uint64)
+        return np.stack([np.concatenate(self._offsets), np.concatenate(self._lengths)], axis=1).astype(np.uint64)
+
+
+def _write_recordio_index(f, index, size, mtime=0):
+    f.write(_INDEX_HEADER.pack(_INDEX_MAGIC, _INDEX_VERSION, size, mtime, len(index)))
+    f.write(np.ascontiguousarray(index, dtype='<u8').tobytes())
+
+
+def _read_recordio_index_header(data):
+    """Return the indexed file size, indexed file modification time and record count of an offset
+    index from its first bytes, or None if they are not an index header."""
+    if len(data) < _INDEX_HEADER.size:
+        return None
+    magic, version, indexed_size, indexed_mtime, count = _INDEX_HEADER.unpack_from(data, 0)
+    if magic != _INDEX_MAGIC or version != _INDEX_VERSION:
+        return None
+    return indexed_size, indexed_mtime, count
+
+
+def _read_recordio_index(data, size=None, mtime=None):
+    """Parse an offset index from bytes. Returns None if it is invalid or does not match ``size``
+    and ``mtime``."""
+    header = _read_recordio_index_header(data)
+    if header is None or (size is not None and header[0] != size) or (mtime is not None and header[1] != mtime):
+        return None
+    if len(data) != _INDEX_HEADER.size + 16 * header[2]:
+        return None
+    return np.frombuffer(data, '<u8', offset=_INDEX_HEADER.size).astype(np.uint64).reshape(-1, 2)
+
+
+def _load_recordio_index(index_path, size, mtime):
+    try:
+        with open(index_path, 'rb') as index_file:
+            return _read_recordio_index(index_file.read(), size, mtime)
+    except (IOError, OSError):
+        return None
+
+
+def _index_matches(buf, size, index):
+    """Return whether the first and last records located by ``index`` start with a RecordIO header
+    in ``buf``, which catches a file rewritten with other records within its modification time
+    resolution."""
+    if not len(index):
+        return size == 0
+    for offset, length in (index[0], index[-1]):
+        offset, length = int(offset), int(length)
+        if offset < 8 or offset + length > size:
+            return False
+        read_kmagic, len_record = struct.unpack_from('II', buf, offset - 8)
+        # The last record of a truncated file is indexed with the bytes that are available
+        if read_kmagic != _kmagic or min(len_record, size - offset) != length:
+            return False
+    return True
+
+
+# Protobuf wire-format tags of the Record message fields written by the vectorized encoders
+# below. Every field used here is length-delimited, so a tag is (field_number << 3) | 2.
+_FEATURES_TAG = 0x0a  # Record.features
+_LABEL_TAG = 0x12  # Record.label
+_VALUES_KEY = b'\x0a\x06values'  # key of the "values" map entry
+_ENTRY_VALUE_TAG = 0x12  # map entry value
+_TENSOR_TAGS = {'Int32': 0x3a, 'Float64': 0x1a, 'Float32': 0x12}  # Value oneof
+_VALUES_TAG, _KEYS_TAG, _SHAPE_TAG = 0x0a, 0x12, 0x1a  # tensor fields
+
+_TENSOR_DTYPES = {'Float64': np.dtype('<f8'), 'Float32': np.dtype('<f4')}
+_INT32_MIN, _INT32_MAX = -2 ** 31, 2 ** 31 - 1
+
+# Number of input bytes the vectorized encoders convert at a time. Bounds the temporary memory
+# used while encoding to a small multiple of this size.
+_ENCODE_BLOCK_BYTES = 1 << 22
+
+# Number of input bytes encoded by each task of a parallel encoder pool
+_PARALLEL_TASK_BYTES = 1 << 26
+
+
+def _write_dense_blocks(file, array, labels, resolved_type, resolved_label_type, rows=None):
+    """Write one Record per row of ``array``, or per row indexed by ``rows``, encoding blocks of rows
+    at a time with numpy.
+
+    The output is byte-identical to serializing each row with the protobuf library and writing
+    it with ``_write_recordio``."""
+    num_rows, num_cols = array.shape
+    if rows is not None:
+        num_rows = len(rows)
+    rows_per_block = max(1, _ENCODE_BLOCK_BYTES // max(1, num_cols * array.dtype.itemsize))
+    for start in range(0, num_rows, rows_per_block):
+        end = min(start + rows_per_block, num_rows)
+        block = slice(start, end) if rows is None else rows[start:end]
+        values = _packed_segment(array[block], num_cols, resolved_type)
+        segments = _map_entry(_FEATURES_TAG, resolved_type, _field(_VALUES_TAG, [values], omit_empty=True))
+        if labels is not None:
+            segments += _label_entry(labels[block], resolved_label_type)
+        _write_record_segments(file, segments, end - start)
+
+
+def _write_sparse_blocks(file, indptr, indices, data, num_cols, labels, resolved_type, resolved_label_type):
+    """Write one sparse Record per row of the CSR matrix given by ``indptr``, ``indices`` and ``data``.
+
+    Blocks of rows are encoded from slices of the CSR arrays, without creating per-row matrices.
+    The output is byte-identical to writing ``csr_array.getrow(i)`` for every row with protobuf."""
+    num_rows = len(indptr) - 1
+    shape = _field(_SHAPE_TAG, [_packed_segment(np.array([num_cols]), 1)])
+    max_block_nnz = max(1, _ENCODE_BLOCK_BYTES // max(1, data.dtype.itemsize + indices.dtype.itemsize))
+    start = 0
+    while start < num_rows:
+        end = int(np.searchsorted(indptr, indptr[start] + max_block_nnz, side='right')) - 1
+        end = min(max(end, start + 1), num_rows)
+        row_sizes = np.diff(indptr[start:end + 1]).astype(np.int64)
+        block = slice(indptr[start], indptr[end])
+        values = _packed_segment(data[block], row_sizes, resolved_type)
+        keys = _packed_segment(indices[block], row_sizes)
+        tensor = _field(_VALUES_TAG, [values], omit_empty=True) + _field(_KEYS_TAG, [keys], omit_empty=True)
+        segments = _map_entry(_FEATURES_TAG, resolved_type, tensor + shape)
+        if labels is not None:
+            segments += _label_entry(labels[start:end], resolved_label_type)
+        _write_record_segments(file, segments, end - start)
+        start = end
+
+
+class _DenseEncoderPool(object):
+    """A pool of worker processes encoding rows of dense arrays as RecordIO-protobuf records, in order.
+
+    A pool is meant to be started once for all the shards written from ``array`` and ``labels``, before
+    any thread uploading them is started, since forking a process while other threads run can deadlock
+    the forked workers. ``array`` and ``labels`` are shared with the workers instead of being pickled:
+    forked workers inherit them, other workers open them as read-only memory maps, of the file backing
+    an ``np.memmap`` or of a temporary copy. Other arrays are pickled and sent with each task, see
+    :meth:`write_arrays`. The pool can be used from several threads at a time.
+    """
+
+    def __init__(self, processes, array=None, labels=None):
+        self.processes = processes
+        self.array = array
+        self.labels = labels
+        context, forked = _pool_context()
+        self._temp_dir = None if forked else tempfile.mkdtemp()
+        try:
+            shared = [a if forked or a is None else _share_array(a, self._temp_dir) for a in (array, labels)]
+            self._pool = context.Pool(processes, _init_dense_worker, (shared,))
+        except Exception:
+            self._remove_temp_dir()
+            raise
+
+    def write(self, file, rows=None):
+        """Write the rows of the shared ``array`` and ``labels``, or the rows selected by ``rows``, to ``file``.
+
+        Args:
+            file (file): The file object to write the RecordIO-protobuf records to.
+            rows (slice or numpy.ndarray): A slice of the rows to write, or a 1D array of the indexes of the
+                rows to write, in order (default: None). If None, all rows are written.
+        """
+        resolved_types = _resolve_dense_types(self.array, self.labels)
+        if rows is None:
+            rows = slice(None)
+        if isinstance(rows, slice):
+            start, end, _ = rows.indices(self.array.shape[0])
+            tasks = [slice(start + task_start, start + task_end)
+                     for task_start, task_end in self._task_bounds(self.array, end - start)]
+        else:
+            tasks = [rows[task_start:task_end] for task_start, task_end in self._task_bounds(self.array, len(rows))]
+        self._run(file, [(None, task_rows) + resolved_types for task_rows in tasks])
+
+    def write_arrays(self, file, array, labels=None):
+        """Write the rows of ``array`` and ``labels``, which are sent to the workers, to ``file``."""
+        resolved_types = _resolve_dense_types(array, labels)
+        tasks = [((array[start:end], None if labels is None else labels[start:end]), slice(None)) + resolved_types
+                 for start, end in self._task_bounds(array, array.shape[0])]
+        self._run(file, tasks)
+
+    def _task_bounds(self, array, num_rows):
+        """Return the row bounds of the tasks encoding ``num_rows`` rows of ``array``, at least one per worker
+        if there are enough rows."""
+        row_bytes = max(1, array.shape[1] * array.dtype.itemsize)
+        rows_per_task = max(1, min(_PARALLEL_TASK_BYTES // row_bytes, -(-num_rows // self.processes)))
+        return [(start, min(start + rows_per_task, num_rows)) for start in range(0, num_rows, rows_per_task)]
+
+    def _run(self, file, tasks):
+        for encoded in self._pool.imap(_encode_dense_rows, tasks):
+            file.write(encoded)
+
+    def close(self):
+        """Stop the worker processes."""
+        self._pool.terminate()
+        self._pool.join()
+        self._remove_temp_dir()
+
+    def _remove_temp_dir(self):
+        if self._temp_dir is not None:
+            shutil.rmtree(self._temp_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _pool_context():
+    """Return a multiprocessing context for encoder pools, and whether its workers are forked."""
+    if not hasattr(multiprocessing, 'get_context'):
+        return multiprocessing, sys.platform != 'win32'  # Python 2 forks on every platform but Windows
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork'), True
+    return multiprocessing.get_context('spawn'), False
+
+
+def _share_array(array, temp_dir):
+    """Return a picklable description of a file from which a worker can memory map ``array``."""
+    if isinstance(array, np.memmap) and isinstance(array.base, mmap.mmap) and array.flags.c_contiguous:
+        return array.filename, array.dtype.str, array.shape, array.offset
+    filename = tempfile.mkstemp(dir=temp_dir)[1]
+    if array.size:
+        copy = np.memmap(filename, dtype=array.dtype, mode='w+', shape=array.shape)
+        copy[:] = array
+        copy.flush()
+        del copy
+    return filename, array.dtype.str, array.shape, 0
+
+
+def _open_shared_array(shared):
+    if not isinstance(shared, tuple):
+        return shared
+    filename, dtype, shape, offset = shared
+    if not np.prod(shape):
+        return np.empty(shape, dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode='r', shape=shape, offset=offset)
+
+
+# Shared arrays of the encoder pool worker running in this process
+_dense_worker_arrays = None
+
+
+def _init_dense_worker(shared):
+    global _dense_worker_arrays  # pylint: disable=global-statement
+    _dense_worker_arrays = [_open_shared_array(a) for a in shared]
+
+
+def _encode_dense_rows(task):
+    """Encode the rows of a task of a ``_DenseEncoderPool``, selected by a slice or an array of row indexes
+    from the arrays of the task, or the shared arrays of the pool if they are None."""
+    arrays, rows, resolved_type, resolved_label_type = task
+    array, labels = _dense_worker_arrays if arrays is None else arrays
+    buf = io.BytesIO()
+    if isinstance(rows, slice):
+        _write_dense_blocks(buf, array[rows], None if labels is None else labels[rows], resolved_type,
+                            resolved_label_type)
+    else:
+        _write_dense_blocks(buf, array, labels, resolved_type, resolved_label_type, rows)
+    return buf.getvalue()
+
+
+def _csr_components(array):
+    """Return the ``indptr``, ``indices`` and ``data`` arrays of a scipy sparse matrix in CSR layout.
+
+    CSR matrices and COO matrices in canonical (row-major, duplicate free) order are used as they
+    are, other formats are converted with ``tocsr()``."""
+    if array.format == 'csr':
+        return array.indptr, array.indices, array.data
+    if array.format == 'coo' and _is_canonical_coo(array):
+        row_counts = np.bincount(array.row, minlength=array.shape[0])
+        indptr = np.concatenate([[0], np.cumsum(row_counts)])
+        return indptr, array.col, array.data
+    csr_array = array.tocsr()
+    return csr_array.indptr, csr_array.indices, csr_array.data
+
+
+def _is_canonical_coo(array):
+    # has_canonical_format is not checked, since older scipy versions set it on entries sorted by column
+    row_steps = np.diff(array.row)
+    return bool(np.all(row_steps >= 0) and np.all((row_steps > 0) | (np.diff(array.col) > 0)))
+
+
+# The vectorized encoders describe each part of a Record as a "segment": a (data, length) pair
+# holding that part for every row of a block. ``data`` is either a bytes object repeated in every
+# row, or a uint8 array with the bytes of all rows back to back. ``length`` is the number of bytes
+# per row, either an int when it is the same for every row or an int64 array of per-row counts.
+
+
+def _packed_segment(values, row_sizes, resolved_type=None):
+    """Return the segment of a packed repeated field whose rows hold ``row_sizes`` of ``values``.
+
+    ``values`` holds the elements of all rows back to back (or is a 2D array with one row per
+    record) and ``row_sizes`` is the number of elements in each row, as an int or an array.
+    Elements are encoded as ``resolved_type`` tensor values, or as uint64 varints (tensor keys and
+    shape) if ``resolved_type`` is None."""
+    if resolved_type in _TENSOR_DTYPES:
+        dtype = _TENSOR_DTYPES[resolved_type]
+        data = np.ascontiguousarray(values, dtype=dtype).reshape(-1).view(np.uint8)
+        if np.ndim(row_sizes) == 0:
+            return data, row_sizes * dtype.itemsize
+        return _uniform_segment(data, row_sizes * dtype.itemsize)
+    values = np.asarray(values).reshape(-1)
+    if resolved_type == 'Int32':
+        # Check the range before converting, so that large uint64 values cannot wrap into range
+        if values.size and (values.min() < _INT32_MIN or values.max() > _INT32_MAX):
+            raise ValueError('Value out of range for Int32 tensor')
+        values = values.astype(np.int64)
+    data, lengths = _encode_varints(values)
+    if np.ndim(row_sizes) == 0:
+        if row_sizes == 0:
+            return data, 0
+        return _uniform_segment(data, lengths.reshape(-1, row_sizes).sum(axis=1))
+    byte_ends = np.concatenate([[0], np.cumsum(lengths)])
+    row_ends = np.concatenate([[0], np.cumsum(row_sizes)])
+    return _uniform_segment(data, byte_ends[row_ends[1:]] - byte_ends[row_ends[:-1]])
+
+
+def _label_entry(labels, resolved_label_type):
+    """Return the segments of a label map entry holding one scalar label per row."""
+    label_values = _packed_segment(labels, 1, resolved_label_type)
+    return _map_entry(_LABEL_TAG, resolved_label_type, _field(_VALUES_TAG, [label_values]))
+
+
+def _map_entry(field_tag, resolved_type, tensor_segments):
+    """Return the segments of a features or label map entry storing a tensor under "values"."""
+    value = _field(_TENSOR_TAGS[resolved_type], tensor_segments)
+    entry = [(_VALUES_KEY, len(_VALUES_KEY))] + _field(_ENTRY_VALUE_TAG, value)
+    return _field(field_tag, entry)
+
+
+def _field(tag, segments, omit_empty=False):
+    """Wrap the message formed by ``segments`` in a length-delimited field with the given tag.
+
+    If ``omit_empty`` is True, rows where the message is empty get no field at all, as protobuf
+    does for empty packed repeated fields."""
+    length = _segments_length(segments)
+    if np.ndim(length) == 0:
+        if omit_empty and length == 0:
+            return []
+        header = struct.pack('B', tag) + _encode_varints(np.array([length]))[0].tobytes()
+        return [(header, len(header))] + segments
+    present = length > 0 if omit_empty else np.ones(length.shape, dtype=bool)
+    tag_lengths = present.astype(np.int64)
+    size_data, present_size_lengths = _encode_varints(length[present])
+    size_lengths = np.zeros(length.shape, dtype=np.int64)
+    size_lengths[present] = present_size_lengths
+    tag_segment = _uniform_segment(np.full(int(tag_lengths.sum()), tag, dtype=np.uint8), tag_lengths)
+    return [tag_segment, _uniform_segment(size_data, size_lengths)] + segments
+
+
+def _segments_length(segments):
+    total = 0
+    for _, length in segments:
+        total = total + length
+    return total
+
+
+def _uniform_segment(data, lengths):
+    """Return a segment, using an int length when every row has the same number of bytes."""
+    if lengths.size == 0:
+        return data, 0
+    if (lengths == lengths[0]).all():
+        return data, int(lengths[0])
+    return data, lengths
+
+
+def _encode_varints(values):
+    """Encode an array of integers as protobuf varints.
+
+    Returns a uint8 array with the encoded values back to back and an int64 array with the number
+    of bytes used by each value. Negative values are encoded in 64-bit two's complement, the way
+    protobuf encodes negative int32 values."""
+    values = np.asarray(values)
+    if values.dtype != np.uint64:
+        values = values.astype(np.int64).view(np.uint64)
+    lengths = np.ones(values.shape, dtype=np.int64)
+    for shift in range(7, 64, 7):
+        lengths += values >= np.uint64(1 << shift)
+    ends = np.cumsum(lengths)
+    encoded = np.empty(int(ends[-1]) if ends.size else 0, dtype=np.uint8)
+    starts = ends - lengths
+    for byte_index in range(int(lengths.max()) if lengths.size else 0):
+        selected = lengths > byte_index
+        byte = (values[selected] >> np.uint64(7 * byte_index)) & np.uint64(0x7f)
+        byte |= (lengths[selected] > byte_index + 1).astype(np.uint64) << np.uint64(7)
+        encoded[starts[selected] + byte_index] = byte
+    return encoded, lengths
+
+
+def _write_record_segments(f, segments, num_rows):
+    """Frame ``num_rows`` records formed by ``segments`` as RecordIO and write them in one call."""
+    if num_rows == 0:
+        return
+    length = _segments_length(segments)
+    pad = (((length + 3) >> 2) << 2) - length
+    if np.ndim(length) == 0:
+        segments = [(struct.pack('II', _kmagic, length), 8)] + segments + [(bytes(padding[pad]), pad)]
+        out = _join_uniform_segments(segments, num_rows, 8 + length + pad)
+    else:
+        header = np.empty((num_rows, 2), dtype=np.uint32)
+        header[:, 0] = _kmagic
+        header[:, 1] = length
+        padding_segment = (np.zeros(int(pad.sum()), dtype=np.uint8), pad)
+        segments = [(header.reshape(-1).view(np.uint8), 8)] + segments + [padding_segment]
+        out = _join_segments(segments, 8 + length + pad)
+    f.write(memoryview(out))
+
+
+def _join_uniform_segments(segments, num_rows, row_length):
+    """Concatenate segments that have the same length in every row, using a 2D view of the output."""
+    out = np.empty((num_rows, row_length), dtype=np.uint8)
+    offset = 0
+    for data, size in segments:
+        if size:
+            if isinstance(data, bytes):
+                data = np.frombuffer(data, dtype=np.uint8)
+            out[:, offset:offset + size] = data.reshape(-1, size)
+        offset += size
+    return out.reshape(-1)
+
+
+def _join_segments(segments, row_lengths):
+    """Concatenate segments row by row when rows differ in length, by scattering into the output."""
+    row_ends = np.cumsum(row_lengths)
+    out = np.empty(int(row_ends[-1]), dtype=np.uint8)
+    offsets = row_ends - row_lengths
+    for data, size in segments:
+        if np.ndim(size) == 0:
+            if size:
+                if isinstance(data, bytes):
+                    data = np.frombuffer(data, dtype=np.uint8)
+                out[offsets[:, np.newaxis] + np.arange(size)] = data.reshape(-1, size)
+        else:
+            total = int(size.sum())
+            if total:
+                source_offsets = np.cumsum(size) - size
+                out[np.repeat(offsets - source_offsets, size) + np.arange(total)] = data
+        offsets = offsets + size
+    return out
+
+
+# Record fields decoded by ``read_records_as_numpy``, by field number.
+_RECORD_MAPS = {1: 'features', 2: 'label'}
+_TENSOR_TYPES = {2: 'Float32', 3: 'Float64', 7: 'Int32'}
+_NUMPY_DTYPES = {'Float32': np.dtype('float32'), 'Float64': np.dtype('float64'), 'Int32': np.dtype('int32')}
+
+
+def _read_tensor_columns(file):
+    """Decode every tensor in the Records of ``file`` into arrays with one row per record.
+
+    Returns dicts mapping keys of the features and label maps to the decoded tensors."""
+    columns = {}
+    num_records = 0
+    expected_records = None
+    for buf, offsets, lengths in _read_recordio_chunks(file):
+        if expected_records is None:
+            remaining = _remaining_bytes(file)
+            chunk_bytes = offsets[-1] + lengths[-1]
+            expected_records = len(offsets) * (1 + (remaining or 0) // chunk_bytes) if chunk_bytes else 0
+        if not _read_uniform_records(columns, expected_records, num_records, buf, offsets, lengths):
+            for index, (offset, length) in enumerate(zip(offsets, lengths)):
+                for map_name, key, tensor in _parse_record_tensors(buf, offset, offset + length):
+                    column = _tensor_column(columns, expected_records, map_name, key, tensor[0])
+                    column.append_record(num_records + index, buf, tensor)
+        num_records += len(offsets)
+
+    features, labels = {}, {}
+    for (map_name, key), column in columns.items():
+        tensors = features if map_name == 'features' else labels
+        tensors[key] = column.result(num_records, squeeze=map_name == 'label')
+    return features, labels
+
+
+def _remaining_bytes(file):
+    """Return the number of bytes left to read in ``file``, or None if it is not seekable."""
+    try:
+        position = file.tell()
+        end = file.seek(0, 2)
+        if end is None:  # Python 2 file objects return None from seek
+            end = file.tell()
+        file.seek(position)
+        return end - position
+    except (AttributeError, IOError, ValueError):
+        return None
+
+
+def _tensor_column(columns, expected_records, map_name, key, resolved_type):
+    column = columns.get((map_name, key))
+    if column is None:
+        column = columns[(map_name, key)] = _TensorColumn(map_name, key, resolved_type, expected_records)
+    return column
+
+
+def _read_uniform_records(columns, expected_records, first_index, buf, offsets, lengths):
+    """Decode a chunk of records that share the same layout with strided views of ``buf``.
+
+    Records written from dense arrays usually only differ in their tensor values, so the layout of
+    the first record locates the values of every record. Returns False, without decoding anything,
+    if the records in the chunk do not all share the layout of the first record."""
+    num_records, length = len(offsets), lengths[0]
+    if num_records < 2 or min(lengths) != length or max(lengths) != length:
+        return False
+    tensors = _parse_record_tensors(buf, offsets[0], offsets[0] + length)
+    if any(keys is not None or shape is not None for _, _, (_, _, keys, shape) in tensors):
+        return False
+
+    stride = offsets[1] - offsets[0]
+    records = np.ndarray((num_records, length), np.uint8, buffer=buf, offset=offsets[0], strides=(stride, 1))
+    values_mask = np.zeros(length, dtype=bool)
+    for _, _, (_, values, _, _) in tensors:
+        if values is not None:
+            values_mask[values[0] - offsets[0]:values[0] - offsets[0] + values[1]] = True
+    layout = records[:, ~values_mask]
+    if not (layout == layout[0]).all():
+        return False
+
+    blocks = []
+    for map_name, key, (resolved_type, values, _, _) in tensors:
+        start, size = values if values is not None else (offsets[0], 0)
+        if resolved_type == 'Int32':
+            # Only varints of a single byte are at the same position in every record
+            block = records[:, start - offsets[0]:start - offsets[0] + size]
+            if (block & 0x80).any():
+                return False
+        else:
+            dtype = _TENSOR_DTYPES[resolved_type]
+            block = np.ndarray((num_records, size // dtype.itemsize), dtype, buffer=buf, offset=start,
+                               strides=(stride, dtype.itemsize))
+        blocks.append((map_name, key, resolved_type, block))
+    for map_name, key, resolved_type, block in blocks:
+        column = _tensor_column(columns, expected_records, map_name, key, resolved_type)
+        column.append_rows(first_index, resolved_type, block)
+    return True
+
+
+def _parse_record_tensors(buf, start, end):
+    """Locate the tensors of the Record serialized in ``buf[start:end]``.
+
+    Returns a list of (map name, key, tensor) tuples, where tensor is a (resolved type, values,
+    keys, shape) tuple and values, keys and shape are the (offset, length) of the packed fields
+    in ``buf``, or None if the field is absent."""
+    tensors = []
+    for field, _, offset, length in _iter_fields(buf, start, end):
+        if field in _RECORD_MAPS:
+            key, tensor = _parse_map_entry(buf, offset, offset + length)
+            tensors.append((_RECORD_MAPS[field], key, tensor))
+    return tensors
+
+
+def _parse_map_entry(buf, start, end):
+    key, tensor = '', None
+    for field, _, offset, length in _iter_fields(buf, start, end):
+        if field == 1:
+            key = buf[offset:offset + length].decode('utf-8')
+        elif field == 2:
+            for value_field, _, value_offset, value_length in _iter_fields(buf, offset, offset + length):
+                if value_field not in _TENSOR_TYPES:
+                    raise ValueError("Unsupported Value field {} in record".format(value_field))
+                spans = _parse_tensor(buf, value_offset, value_offset + value_length)
+                tensor = (_TENSOR_TYPES[value_field],) + spans
+    if tensor is None:
+        raise ValueError("Record map entry {} holds no tensor".format(key))
+    return key, tensor
+
+
+def _parse_tensor(buf, start, end):
+    spans = [None, None, None]
+    for field, wire_type, offset, length in _iter_fields(buf, start, end):
+        if field in (1, 2, 3):
+            if wire_type != 2:
+                raise ValueError("Only packed tensor fields are supported")
+            spans[field - 1] = (offset, length)
+    return tuple(spans)
+
+
+def _iter_fields(buf, position, end):
+    """Yield the (field number, wire type, offset, length) of each field of a protobuf message."""
+    while position < end:
+        tag, position = _read_varint(buf, position)
+        wire_type = tag & 0x7
+        if wire_type == 0:
+            _, value_end = _read_varint(buf, position)
+        elif wire_type == 1:
+            value_end = position + 8
+        elif wire_type == 2:
+            length, position = _read_varint(buf, position)
+            value_end = position + length
+        elif wire_type == 5:
+            value_end = position + 4
+        else:
+            raise ValueError("Unsupported protobuf wire type {}".format(wire_type))
+        yield tag >> 3, wire_type, position, value_end - position
+        position = value_end
+
+
+def _read_varint(buf, position):
+    result, shift = 0, 0
+    while True:
+        byte = six.indexbytes(buf, position)
+        position += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, position
+        shift += 7
+
+
+def _decode_varints(data):
+    """Decode a uint8 array of back to back protobuf varints into an array of uint64 values."""
+    if not data.size:
+        return np.zeros(0, dtype=np.uint64)
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    byte_positions = np.arange(len(data)) - np.repeat(starts, ends - starts + 1)
+    shifted = (data & 0x7f).astype(np.uint64) << (7 * byte_positions).astype(np.uint64)
+    return np.add.reduceat(shifted, starts)
+
+
+def _decode_packed(buf, span, resolved_type):
+    """Decode a packed field of tensor values (or uint64 keys and shape if ``resolved_type`` is None)."""
+    offset, length = span if span is not None else (0, 0)
+    if resolved_type in _TENSOR_DTYPES:
+        dtype = _TENSOR_DTYPES[resolved_type]
+        return np.frombuffer(buf, dtype, count=length // dtype.itemsize, offset=offset)
+    values = _decode_varints(np.frombuffer(buf, np.uint8, count=length, offset=offset))
+    return values.view(np.int64).astype(np.int32) if resolved_type == 'Int32' else values
+
+
+class _GrowableArray(object):
+    """An array that grows geometrically as rows are appended to it."""
+
+    def __init__(self, dtype, row_shape=(), capacity=0):
+        self.array = np.empty((capacity,) + row_shape, dtype=dtype)
+        self.size = 0
+
+    def append(self, rows):
+        end = self.size + len(rows)
+        if end > len(self.array):
+            grown = np.empty((max(end, 2 * len(self.array)),) + self.array.shape[1:], dtype=self.array.dtype)
+            grown[:self.size] = self.array[:self.size]
+            self.array = grown
+        self.array[self.size:end] = rows
+        self.size = end
+
+    def result(self):
+        return self.array[:self.size]
+
+
+class _TensorColumn(object):
+    """Collects the values of one named tensor across records.
+
+    Dense tensors are stored in an array with one row per record. Sparse tensors are stored as the
+    values, keys and sizes of their rows, to be returned as a CSR matrix."""
+
+    def __init__(self, map_name, key, resolved_type, expected_records):
+        self.name = '{} "{}"'.format(map_name, key)
+        self.resolved_type = resolved_type
+        self.expected_records = expected_records
+        self.rows = 0
+        self.values = None
+        self.row_shape = None
+        self.sparse_shape = None
+
+    def append_rows(self, index, resolved_type, block):
+        """Append a block of dense tensor values, starting at the record at position ``index``."""
+        self._check(index, resolved_type, block.shape[1:], None)
+        self.values.append(block)
+        self.rows += len(block)
+
+    def append_record(self, index, buf, tensor):
+        """Append the tensor located in ``buf`` of the record at position ``index``."""
+        resolved_type, values, keys, shape = tensor
+        values = _decode_packed(buf, values, resolved_type)
+        if keys is None and shape is None:
+            self._check(index, resolved_type, values.shape, None)
+            self.values.append(values[np.newaxis])
+        else:
+            shape = tuple(int(dim) for dim in _decode_packed(buf, shape, None))
+            self._check(index, resolved_type, None, shape)
+            keys = _decode_packed(buf, keys, None)
+            self.values.append(values)
+            self.keys.append(keys)
+            self.row_sizes.append(np.array([len(keys)]))
+        self.rows += 1
+
+    def _check(self, index, resolved_type, row_shape, sparse_shape):
+        """Check a record is consistent with the previous ones, allocating storage on the first."""
+        if index != self.rows:
+            raise ValueError("Tensor {} is missing from some records".format(self.name))
+        if resolved_type != self.resolved_type:
+            raise ValueError("Tensor {} has different types across records".format(self.name))
+        if self.values is None:
+            dtype = _NUMPY_DTYPES[resolved_type]
+            self.row_shape, self.sparse_shape = row_shape, sparse_shape
+            if sparse_shape is None:
+                self.values = _GrowableArray(dtype, row_shape, self.expected_records)
+            else:
+                self.values = _GrowableArray(dtype)
+                self.keys = _GrowableArray(np.int64)
+                self.row_sizes = _GrowableArray(np.int64, capacity=self.expected_records)
+        elif (row_shape, sparse_shape) != (self.row_shape, self.sparse_shape):
+            raise ValueError("Tensor {} has different shapes across records".format(self.name))
+
+    def result(self, num_records, squeeze=False):
+        if self.rows != num_records:
+            raise ValueError("Tensor {} is missing from some records".format(self.name))
+        if self.sparse_shape is not None:
+            indptr = np.concatenate([[0], np.cumsum(self.row_sizes.result())])
+            return csr_matrix((self.values.result(), self.keys.result(), indptr),
+                              shape=(num_records,) + self.sparse_shape)
+        values = self.values.result()
+        if squeeze and values.shape[1:] == (1,):
+            return values[:, 0]
+        return values
 
 
 def _resolve_type(dtype):
-    if dtype == np.dtype(int):
+    """Return the tensor type used to store values of the numpy ``dtype``.
+
+    Integer and boolean values are stored as Int32, float16 and float32 values as Float32 and
+    float64 values as Float64. Values are converted one block of rows at a time while encoding,
+    so arrays of any of these types can be written without first copying them with ``astype``."""
+    dtype = np.dtype(dtype)
+    if dtype.kind in 'iub':
         return 'Int32'
-    elif dtype == np.dtype(float):
-        return 'Float64'
-    elif dtype == np.dtype('float32'):
+    elif dtype.kind == 'f' and dtype.itemsize <= 4:
         return 'Float32'
+    elif dtype.kind == 'f' and dtype.itemsize == 8:
+        return 'Float64'
     raise ValueError('Unsupported dtype {} on array'.format(dtype))
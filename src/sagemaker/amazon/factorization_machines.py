@@ -13,7 +13,7 @@
 from __future__ import absolute_import
 
 from sagemaker.amazon.amazon_estimator import AmazonAlgorithmEstimatorBase, registry
-from sagemaker.amazon.common import numpy_to_record_serializer, record_deserializer
+from sagemaker.amazon.common import record_serializer, record_deserializer, record_to_numpy_deserializer
 from sagemaker.amazon.hyperparameter import Hyperparameter as hp  # noqa
 from sagemaker.amazon.validation import gt, isin, ge
 from sagemaker.predictor import RealTimePredictor
@@ -183,21 +183,25 @@ class FactorizationMachinesPredictor(RealTimePredictor):
     """Performs binary-classification or regression prediction from input vectors.
 
     The implementation of :meth:`~sagemaker.predictor.RealTimePredictor.predict` in this
-    `RealTimePredictor` requires a numpy ``ndarray`` as input. The array should contain the
-    same number of columns as the feature-dimension of the data used to fit the model this
-    Predictor performs inference on.
+    `RealTimePredictor` requires a numpy ``ndarray`` or a scipy sparse matrix as input. The array should
+    contain the same number of columns as the feature-dimension of the data used to fit the model this
+    Predictor performs inference on. Sparse matrices are sent as sparse tensors without densifying them.
 
     :meth:`predict()` returns a list of :class:`~sagemaker.amazon.record_pb2.Record` objects, one
     for each row in the input ``ndarray``. The prediction is stored in the ``"score"``
     key of the ``Record.label`` field.
     Please refer to the formats details described: https://docs.aws.amazon.com/sagemaker/latest/dg/fm-in-formats.html
+
+    If ``return_numpy`` is True, ``predict()`` instead returns a dict mapping each key of the
+    ``Record.label`` field to a numpy array with one row per input row.
     """
 
-    def __init__(self, endpoint, sagemaker_session=None):
+    def __init__(self, endpoint, sagemaker_session=None, return_numpy=False):
+        deserializer = record_to_numpy_deserializer() if return_numpy else record_deserializer()
         super(FactorizationMachinesPredictor, self).__init__(endpoint,
                                                              sagemaker_session,
-                                                             serializer=numpy_to_record_serializer(),
-                                                             deserializer=record_deserializer())
+                                                             serializer=record_serializer(),
+                                                             deserializer=deserializer)
 
 
 class FactorizationMachinesModel(Model):
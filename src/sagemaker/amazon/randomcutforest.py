@@ -13,7 +13,7 @@
 from __future__ import absolute_import
 
 from sagemaker.amazon.amazon_estimator import AmazonAlgorithmEstimatorBase, registry
-from sagemaker.amazon.common import numpy_to_record_serializer, record_deserializer
+from sagemaker.amazon.common import numpy_to_record_serializer, record_deserializer, record_to_numpy_deserializer
 from sagemaker.amazon.hyperparameter import Hyperparameter as hp  # noqa
 from sagemaker.amazon.validation import ge, le
 from sagemaker.predictor import RealTimePredictor
@@ -114,12 +114,16 @@ class RandomCutForestPredictor(RealTimePredictor):
 
     :meth:`predict()` returns a list of :class:`~sagemaker.amazon.record_pb2.Record` objects,
     one for each row in the input. Each row's score is stored in the key ``score`` of the
-    ``Record.label`` field."""
+    ``Record.label`` field.
 
-    def __init__(self, endpoint, sagemaker_session=None):
+    If ``return_numpy`` is True, ``predict()`` instead returns a dict mapping each key of the
+    ``Record.label`` field to a numpy array with one row per input row."""
+
+    def __init__(self, endpoint, sagemaker_session=None, return_numpy=False):
+        deserializer = record_to_numpy_deserializer() if return_numpy else record_deserializer()
         super(RandomCutForestPredictor, self).__init__(endpoint, sagemaker_session,
                                                        serializer=numpy_to_record_serializer(),
-                                                       deserializer=record_deserializer())
+                                                       deserializer=deserializer)
 
 
 class RandomCutForestModel(Model):
@@ -14,21 +14,56 @@ from __future__ import print_function, absolute_import
 
 import codecs
 import csv
+import hashlib
+import io
 import json
+import math
+import struct
+import threading
+import time
+import warnings
+from collections import OrderedDict, deque
+from concurrent import futures
+from timeit import default_timer
+
 import numpy as np
 import six
+from botocore.client import BaseClient
+from botocore.exceptions import BotoCoreError, ClientError
+from scipy.sparse import issparse, vstack
 from six import StringIO, BytesIO
 
 from sagemaker.content_types import CONTENT_TYPE_JSON, CONTENT_TYPE_CSV, CONTENT_TYPE_NPY
 from sagemaker.session import Session
 
+# Default number of concurrent requests of ``RealTimePredictor.predict_async``, matching the botocore
+# default connection pool size
+_DEFAULT_MAX_CONCURRENCY = 10
+# Number of rows serialized by ``RealTimePredictor.predict_batch`` to estimate the serialized size of a row
+_PROBE_ROWS = 64
+# numpy dtype kinds serialized to CSV by formatting whole arrays: booleans, integers and floats
+_CSV_NUMERIC_KINDS = 'biuf'
+# Characters of CSV values that ``np.genfromtxt`` parses as floats rather than integers
+_CSV_FLOAT_CHARS = np.zeros(256, dtype=bool)
+_CSV_FLOAT_CHARS[[ord(c) for c in '.eEnNiI']] = True
+_CSV_DELIMITERS = np.zeros(256, dtype=bool)
+_CSV_DELIMITERS[[ord(','), ord('\n')]] = True
+# Error codes of throttled requests, which SageMaker runtime returns with HTTP 4xx status codes
+_THROTTLING_ERROR_CODES = ('ThrottlingException', 'Throttling', 'TooManyRequestsException')
+# boto3 sessions are not thread-safe, so clients are created from them one at a time
+_CLIENT_LOCK = threading.Lock()
+# Ratio between the bounds of consecutive buckets of the histograms of ``PredictorMetrics``, so that percentiles
+# are estimated within about 4.5%
+_HISTOGRAM_BUCKET_RATIO = 2 ** 0.125
+
 
 class RealTimePredictor(object):
     """Make prediction requests to an Amazon SageMaker endpoint.
     """
 
     def __init__(self, endpoint, sagemaker_session=None, serializer=None, deserializer=None,
-                 content_type=None, accept=None):
+                 content_type=None, accept=None, max_concurrency=_DEFAULT_MAX_CONCURRENCY, cache=None,
+                 metrics=None):
         """Initialize a ``RealTimePredictor``.
 
         Behavior for serialization of input data and deserialization of result data
@@ -49,6 +84,13 @@ class RealTimePredictor(object):
             content_type (str): The invocation's "ContentType", overriding any ``content_type`` from
                 the serializer (default: None).
             accept (str): The invocation's "Accept", overriding any accept from the deserializer (default: None).
+            max_concurrency (int): The maximum number of requests of :meth:`predict_async` and
+                :meth:`predict_many_async` sent at the same time (default: 10).
+            cache (sagemaker.predictor.PredictionCache): A cache of the inferences of :meth:`predict`
+                (default: None). If specified, inferences for a request body and headers that were
+                sent before are returned from the cache, without invoking the endpoint.
+            metrics (sagemaker.predictor.PredictorMetrics): Records the latencies and payload sizes of the
+                requests of :meth:`predict` (default: None). If not specified, nothing is recorded.
         """
         self.endpoint = endpoint
         self.sagemaker_session = sagemaker_session or Session()
@@ -56,8 +98,14 @@ class RealTimePredictor(object):
         self.deserializer = deserializer
         self.content_type = content_type or getattr(serializer, 'content_type', None)
         self.accept = accept or getattr(deserializer, 'accept', None)
-
-    def predict(self, data, initial_args=None):
+        self.max_concurrency = max_concurrency
+        self.cache = cache
+        self._metrics = metrics
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self._thread_local = threading.local()
+
+    def predict(self, data, initial_args=None, use_cache=True):
         """Return the inference from the specified endpoint.
 
         Args:
@@ -67,6 +115,8 @@ class RealTimePredictor(object):
                 the predict method then sends the bytes in the request body as is.
             initial_args (dict[str,str]): Optional. Default arguments for boto3
                 ``invoke_endpoint`` call. Default is None (no default arguments).
+            use_cache (bool): Whether to look up and store the inference in the predictor's ``cache``
+                (default: True).
 
         Returns:
             object: Inference for the given input. If a deserializer was specified when creating
@@ -74,9 +124,170 @@ class RealTimePredictor(object):
                 returns the sequence of bytes as is.
         """
 
+        metrics = self._metrics
+        if metrics is not None:
+            start = default_timer()
         request_args = self._create_request_args(data, initial_args)
-        response = self.sagemaker_session.sagemaker_runtime_client.invoke_endpoint(**request_args)
-        return self._handle_response(response)
+        if metrics is not None:
+            serialized = default_timer()
+            metrics.record('serialize_seconds', serialized - start)
+            _record_size(metrics, 'request_bytes', _payload_size(request_args['Body']))
+        cache_key = _cache_key(request_args) if self.cache is not None and use_cache else None
+        if cache_key is not None:
+            result = self.cache.get(cache_key, _MISSING)
+            if result is not _MISSING:
+                return result
+        if metrics is not None:
+            invoked = default_timer()
+        response = self._runtime_client().invoke_endpoint(**request_args)
+        if metrics is not None:
+            responded = default_timer()
+            metrics.record('invoke_endpoint_seconds', responded - invoked)
+            _record_size(metrics, 'response_bytes', _response_size(response))
+        result = self._handle_response(response)
+        if metrics is not None:
+            deserialized = default_timer()
+            metrics.record('deserialize_seconds', deserialized - responded)
+            metrics.record('predict_seconds', deserialized - start)
+        # Streams returned by the deserializer, like the one of StreamDeserializer, can only be read once
+        streams = result if isinstance(result, tuple) else (result,)
+        if cache_key is not None and not any(hasattr(item, 'read') for item in streams):
+            self.cache.put(cache_key, result)
+        return result
+
+    def predict_async(self, data, initial_args=None):
+        """Start an inference request to the specified endpoint, without waiting for its result.
+
+        The request is serialized, sent and deserialized by a pool of at most ``max_concurrency``
+        threads, each with its own SageMaker runtime client. In a coroutine, the result can be
+        awaited with ``await asyncio.wrap_future(predictor.predict_async(data))``.
+
+        Args:
+            data (object): Input data for which you want the model to provide inference, see :meth:`predict`.
+            initial_args (dict[str,str]): Optional. Default arguments for boto3
+                ``invoke_endpoint`` call. Default is None (no default arguments).
+
+        Returns:
+            concurrent.futures.Future: A future of the inference for the given input, as returned by :meth:`predict`.
+        """
+        return self._get_executor().submit(self._predict_in_thread, data, initial_args)
+
+    def predict_many_async(self, data, initial_args=None, max_in_flight=None):
+        """Return the inferences for each input of an iterable, sending several requests at the same time.
+
+        Inputs are read from ``data`` only as requests complete, so that at most ``max_in_flight``
+        requests are pending or waiting for their results to be read. Inferences are returned in the
+        order of the inputs. If a request fails, its error is raised when its inference is reached.
+
+        Args:
+            data (iterable): Inputs for which you want the model to provide inference, see :meth:`predict`.
+            initial_args (dict[str,str]): Optional. Default arguments for boto3
+                ``invoke_endpoint`` calls. Default is None (no default arguments).
+            max_in_flight (int): The maximum number of requests started ahead of the inference being
+                returned (default: None). If not specified, twice ``max_concurrency`` is used.
+
+        Returns:
+            generator: The inference for each input, as returned by :meth:`predict`.
+        """
+        if max_in_flight is None:
+            max_in_flight = 2 * self.max_concurrency
+        if max_in_flight < 1:
+            raise ValueError("max_in_flight must be >= 1")
+        pending = deque()
+        try:
+            for item in data:
+                if len(pending) >= max_in_flight:
+                    yield pending.popleft().result()
+                pending.append(self.predict_async(item, initial_args))
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def predict_batch(self, data, initial_args=None, max_payload_mb=5, max_rows=None, concurrency=None):
+        """Return the inference for a large number of rows, sent in several concurrent requests.
+
+        The rows of ``data`` are split into chunks whose serialized request bodies are at most
+        ``max_payload_mb`` large. Chunk sizes are estimated from the serialized size of the first rows,
+        and a chunk that serializes larger than the limit is split into smaller chunks. Chunks are
+        sent with :meth:`predict_many_async`, and the inferences of the chunks are concatenated in
+        order: numpy arrays and scipy sparse matrices along their first axis, lists one after the
+        other, and dicts key by key. Other inferences are returned as a list with one item per chunk.
+
+        Args:
+            data (object): A 2D numpy array, scipy sparse matrix, pandas DataFrame, or list of rows.
+                Other data is sent in a single request, see :meth:`predict`.
+            initial_args (dict[str,str]): Optional. Default arguments for boto3
+                ``invoke_endpoint`` calls. Default is None (no default arguments).
+            max_payload_mb (float): The maximum size of a request body in MB (default: 5).
+            max_rows (int): The maximum number of rows sent in one request (default: None).
+            concurrency (int): The maximum number of requests sent at the same time (default: None).
+                If not specified, ``max_concurrency`` is used. Requests are sent by the threads of
+                :meth:`predict_async`, so it cannot be greater than ``max_concurrency``.
+
+        Returns:
+            object: The concatenated inferences for the rows of ``data``.
+        """
+        num_rows = _num_rows(data)
+        if num_rows is None:
+            return self.predict(data, initial_args)
+        if self.serializer is None:
+            raise ValueError("predict_batch requires a serializer to split data into requests")
+        if num_rows == 0:
+            raise ValueError("Cannot predict on empty data")
+        if max_rows is not None and max_rows < 1:
+            raise ValueError("max_rows must be >= 1")
+        if concurrency is None:
+            concurrency = self.max_concurrency
+        if not 1 <= concurrency <= self.max_concurrency:
+            raise ValueError("concurrency must be between 1 and max_concurrency ({})".format(self.max_concurrency))
+        bodies = self._serialize_chunks(data, num_rows, int(max_payload_mb * 1024 * 1024), max_rows)
+        results = list(self.predict_many_async(bodies, initial_args, max_in_flight=concurrency))
+        return _concatenate_results(results)
+
+    def _serialize_chunks(self, data, num_rows, max_payload, max_rows):
+        """Yield the serialized request bodies of chunks of the rows of ``data`` of at most ``max_payload`` bytes."""
+        probe_rows = min(num_rows, _PROBE_ROWS)
+        probe_size = _chunk_payload_size(self.serializer(_slice_rows(data, 0, probe_rows)))
+        rows_per_chunk = max(1, int(probe_rows * max_payload / max(1, probe_size)))
+        if max_rows is not None:
+            rows_per_chunk = min(rows_per_chunk, max_rows)
+        start = 0
+        while start < num_rows:
+            rows = min(rows_per_chunk, num_rows - start)
+            body = self.serializer(_slice_rows(data, start, start + rows))
+            size = _chunk_payload_size(body)
+            if size > max_payload:
+                if rows == 1:
+                    raise ValueError("Row {} serializes to {} bytes, more than the maximum payload of {} bytes"
+                                     .format(start, size, max_payload))
+                # Shrink the chunks in proportion to the measured size
+                rows_per_chunk = max(1, min(rows - 1, int(rows * max_payload / size)))
+                continue
+            yield _SerializedBody(body)
+            start += rows
+
+    def _predict_in_thread(self, data, initial_args=None):
+        client = self.sagemaker_session.sagemaker_runtime_client
+        # Clients other than botocore clients, like the client of a local session, are shared by all threads
+        if isinstance(client, BaseClient) and getattr(self._thread_local, 'client', None) is None:
+            with _CLIENT_LOCK:
+                self._thread_local.client = self.sagemaker_session.boto_session.client(
+                    'runtime.sagemaker', region_name=client.meta.region_name, endpoint_url=client.meta.endpoint_url,
+                    config=client.meta.config)
+        return self.predict(data, initial_args)
+
+    def _runtime_client(self):
+        """Return the SageMaker runtime client of the session, or the client of the current thread in
+        the threads of :meth:`predict_async`."""
+        return getattr(self._thread_local, 'client', None) or self.sagemaker_session.sagemaker_runtime_client
+
+    def _get_executor(self):
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = futures.ThreadPoolExecutor(self.max_concurrency)
+            return self._executor
 
     def _handle_response(self, response):
         response_body = response['Body']
@@ -99,7 +310,9 @@ class RealTimePredictor(object):
         if self.accept and 'Accept' not in args:
             args['Accept'] = self.accept
 
-        if self.serializer is not None:
+        if isinstance(data, _SerializedBody):
+            data = data.body
+        elif self.serializer is not None:
             data = self.serializer(data)
 
         args['Body'] = data
@@ -110,10 +323,531 @@ class RealTimePredictor(object):
         """
         self.sagemaker_session.delete_endpoint(self.endpoint)
 
+    def close(self):
+        """Stop the threads sending the requests of :meth:`predict_async`, after pending requests complete.
+        """
+        with self._executor_lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown()
+
+    def metrics(self):
+        """Return a snapshot of the latencies and payload sizes recorded by the ``metrics`` of the predictor.
+
+        Returns:
+            dict: The statistics of each recorded quantity, see :meth:`PredictorMetrics.snapshot`, or an empty
+                dict if the predictor was created without ``metrics``.
+        """
+        return {} if self._metrics is None else self._metrics.snapshot()
+
+
+class PredictorMetrics(object):
+    """A thread-safe recorder of the latencies and payload sizes of the requests of a ``RealTimePredictor``.
+
+    Each request of :meth:`RealTimePredictor.predict` that invokes the endpoint records:
+
+    * ``serialize_seconds``: the time spent creating the request, including serializing the input data.
+    * ``request_bytes``: the size of the request body.
+    * ``invoke_endpoint_seconds``: the time spent waiting for the response of the endpoint.
+    * ``response_bytes``: the size of the response body, when the response has a "Content-Length" header.
+    * ``deserialize_seconds``: the time spent deserializing the response.
+    * ``predict_seconds``: the total time of the request.
+
+    Requests answered from a ``PredictionCache`` only record ``serialize_seconds`` and ``request_bytes``.
+    Values are aggregated into histograms with logarithmic buckets, from which percentiles are estimated.
+    """
+
+    def __init__(self, callback=None):
+        """Initialize a ``PredictorMetrics``.
+
+        Args:
+            callback (callable): Accepts two arguments, the name of a quantity and a recorded value, and is
+                called for each recorded value, from the thread sending the request (default: None).
+                It can forward the values to an external metrics system, like Amazon CloudWatch or StatsD.
+        """
+        self.callback = callback
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, value):
+        """Add ``value`` to the histogram of the quantity ``name``."""
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = _Histogram()
+            histogram.add(value)
+        if self.callback is not None:
+            self.callback(name, value)
+
+    def snapshot(self):
+        """Return the statistics of the recorded values.
+
+        Returns:
+            dict: For each recorded quantity, a dict with the ``count``, ``sum``, ``mean``, ``min`` and ``max``
+                of its values, and the estimated percentiles ``p50``, ``p90`` and ``p99``.
+        """
+        with self._lock:
+            return {name: histogram.statistics() for name, histogram in six.iteritems(self._histograms)}
+
+    def reset(self):
+        """Remove all recorded values."""
+        with self._lock:
+            self._histograms.clear()
+
+
+class _Histogram(object):
+    """Counts of non-negative values in buckets whose bounds grow by ``_HISTOGRAM_BUCKET_RATIO``."""
 
-class _CsvSerializer(object):
     def __init__(self):
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+        # Bucket index to count, where bucket ``i`` holds values in (ratio ** (i - 1), ratio ** i], and
+        # bucket None holds zeros
+        self._buckets = {}
+
+    def add(self, value):
+        bucket = int(math.ceil(math.log(value, _HISTOGRAM_BUCKET_RATIO))) if value > 0 else None
+        self._buckets[bucket] = self._buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, q):
+        """Estimate the ``q``-th percentile as the geometric middle of the bucket holding it."""
+        rank = q / 100.0 * self.count
+        seen = self._buckets.get(None, 0)
+        if seen >= rank:
+            return 0
+        for bucket in sorted(b for b in self._buckets if b is not None):
+            seen += self._buckets[bucket]
+            if seen >= rank:
+                break
+        estimate = _HISTOGRAM_BUCKET_RATIO ** (bucket - 0.5)
+        return min(max(estimate, self.min), self.max)
+
+    def statistics(self):
+        return {'count': self.count, 'sum': self.sum, 'mean': self.sum / float(self.count),
+                'min': self.min, 'max': self.max,
+                'p50': self.percentile(50), 'p90': self.percentile(90), 'p99': self.percentile(99)}
+
+
+class PredictionCache(object):
+    """A thread-safe cache of the inferences of a ``RealTimePredictor``, evicting the least recently used
+    inferences when it is full, and inferences older than a time to live.
+
+    Inferences are stored as returned by the deserializer of the predictor, and the same object is
+    returned for each cache hit, so it should not be modified.
+    """
+
+    def __init__(self, max_size=1024, ttl=None):
+        """Initialize a ``PredictionCache``.
+
+        Args:
+            max_size (int): The maximum number of inferences stored (default: 1024).
+            ttl (float): The number of seconds after which a stored inference expires (default: None).
+                If not specified, inferences are only evicted when the cache is full.
+        """
+        if max_size < 1:
+            raise ValueError("max_size must be >= 1")
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Return the inference stored for ``key``, or ``default`` if there is none or it expired."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or (self.ttl is not None and time.time() - entry[1] > self.ttl):
+                self.misses += 1
+                return default
+            # Reinsert the entry as the most recently used
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        """Store the inference ``value`` for ``key``."""
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.time())
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Remove all inferences and reset the hit and miss counts."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# Marks a cache miss, which cannot be confused with a cached None inference
+_MISSING = object()
+
+
+def _cache_key(request_args):
+    """Return a digest of the body and the other arguments of an ``invoke_endpoint`` request, or None if the
+    body is a stream that cannot be read again."""
+    digest = hashlib.sha1(repr(sorted((key, value) for key, value in six.iteritems(request_args)
+                                      if key != 'Body')).encode('utf-8'))
+    body = request_args['Body']
+    if isinstance(body, six.text_type):
+        digest.update(body.encode('utf-8'))
+    elif hasattr(body, 'read'):
+        if not (hasattr(body, 'seekable') and body.seekable()):
+            return None
+        position = body.tell()
+        for chunk in iter(lambda: body.read(1 << 20), b''):
+            digest.update(chunk)
+        body.seek(position)
+    else:
+        digest.update(body)
+    return digest.hexdigest()
+
+
+class BatchingPredictor(object):
+    """Combine the rows predicted by many concurrent callers into fewer requests to a ``RealTimePredictor``.
+
+    Rows passed to :meth:`predict` or :meth:`predict_async` are held until ``max_batch_size`` rows are
+    waiting, or until the first of them has waited ``max_latency_ms``, and are then sent in a single
+    request with :meth:`RealTimePredictor.predict_async`. The inference is split back into one inference
+    per row, as :meth:`RealTimePredictor.predict_batch` would concatenate them. If a combined request
+    fails because of its input, a ``ModelError`` or another client error other than throttling, each of
+    its rows is sent again in a request of its own, so that an invalid row only fails the call that
+    passed it. Other errors, like throttling, server errors and connection timeouts, fail every call
+    of the combined request.
+    """
+
+    def __init__(self, predictor, max_batch_size=32, max_latency_ms=10, timeout=None):
+        """Initialize a ``BatchingPredictor``.
+
+        Args:
+            predictor (sagemaker.predictor.RealTimePredictor): The predictor sending the combined requests.
+                Its serializer must accept a 2D numpy array, a scipy sparse matrix, or a list of rows.
+            max_batch_size (int): The maximum number of rows combined into one request (default: 32).
+            max_latency_ms (float): The maximum time in milliseconds a row waits for other rows before
+                its request is sent (default: 10). Requests may also wait for a thread of ``predictor``,
+                see its ``max_concurrency``.
+            timeout (float): The maximum time in seconds between a call and its inference (default: None).
+                Calls without an inference by then fail with ``concurrent.futures.TimeoutError``. If not
+                specified, calls wait for their requests to complete, however long they take.
+        """
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be >= 1")
+        if max_latency_ms < 0:
+            raise ValueError("max_latency_ms must be >= 0")
+        if timeout is not None and timeout <= 0:
+            raise ValueError("timeout must be > 0")
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_latency_ms = max_latency_ms
+        self.timeout = timeout
+        self._pending = []
+        # Deadlines of the calls, in the order of the calls since they all have the same timeout
+        self._deadlines = deque()
+        self._closed = False
+        self._condition = threading.Condition()
+        # Completes each call once, whether by its inference or its deadline
+        self._future_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._dispatch, name='BatchingPredictor')
+        self._thread.daemon = True
+        self._thread.start()
+        if timeout is not None:
+            expire_thread = threading.Thread(target=self._expire, name='BatchingPredictorTimeout')
+            expire_thread.daemon = True
+            expire_thread.start()
+
+    def predict(self, data):
+        """Return the inference for a single row, sent in a request combined with the rows of other callers.
+
+        Args:
+            data (object): A row, like a 1D numpy array or a list of values.
+
+        Returns:
+            object: The part of the combined inference for ``data``, see :class:`BatchingPredictor`.
+        """
+        return self.predict_async(data).result()
+
+    def predict_async(self, data):
+        """Queue a single row to be sent in a combined request, without waiting for its inference.
+
+        Args:
+            data (object): A row, like a 1D numpy array or a list of values.
+
+        Returns:
+            concurrent.futures.Future: A future of the inference for ``data``, see :meth:`predict`.
+        """
+        future = futures.Future()
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("Cannot predict with a closed BatchingPredictor")
+            now = time.time()
+            self._pending.append((data, future, now))
+            if self.timeout is not None:
+                self._deadlines.append((now + self.timeout, future))
+            self._condition.notify_all()
+        return future
+
+    def close(self):
+        """Send the rows waiting to be sent, and stop combining rows.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+
+    def _dispatch(self):
+        max_latency = self.max_latency_ms / 1000.0
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                if not self._pending:
+                    return
+                deadline = self._pending[0][2] + max_latency
+                while len(self._pending) < self.max_batch_size and not self._closed:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                batch = self._pending[:self.max_batch_size]
+                del self._pending[:self.max_batch_size]
+            # Calls cancelled or past their deadline while waiting are not sent
+            batch = [(data, future) for data, future, _ in batch if self._start(future)]
+            if batch:
+                self._send(batch)
+
+    def _expire(self):
+        while True:
+            with self._condition:
+                while self._deadlines and self._deadlines[0][1].done():
+                    self._deadlines.popleft()
+                if not self._deadlines:
+                    if self._closed:
+                        return
+                    self._condition.wait()
+                    continue
+                deadline, future = self._deadlines[0]
+                remaining = deadline - time.time()
+                if remaining > 0:
+                    self._condition.wait(remaining)
+                    continue
+                self._deadlines.popleft()
+            self._set_exception(future, futures.TimeoutError(
+                "No inference within the timeout of {} seconds".format(self.timeout)))
+
+    def _send(self, batch):
+        if len(batch) == 1:
+            self._send_each(batch)
+            return
+        try:
+            combined = self.predictor.predict_async(_combine_rows([data for data, _ in batch]))
+        except Exception as e:  # pylint: disable=broad-except
+            self._fail(batch, e)
+            return
+        combined.add_done_callback(lambda done: self._complete(batch, done))
+
+    def _complete(self, batch, done):
+        try:
+            parts = _split_result(done.result(), len(batch))
+        except Exception as e:  # pylint: disable=broad-except
+            self._fail(batch, e)
+            return
+        for (_, future), part in zip(batch, parts):
+            self._set_result(future, part)
+
+    def _fail(self, batch, error):
+        """Send each row of a failed combined request on its own if ``error`` may be caused by one of the rows,
+        otherwise fail every call of the request."""
+        if _is_input_error(error):
+            self._send_each(batch)
+            return
+        for _, future in batch:
+            self._set_exception(future, error)
+
+    def _send_each(self, batch):
+        for data, future in batch:
+            # Calls past their deadline are not sent again
+            if not future.done():
+                self._send_one(data, future)
+
+    def _send_one(self, data, future):
+        def complete(done):
+            try:
+                result = _split_result(done.result(), 1)[0]
+            except Exception as e:  # pylint: disable=broad-except
+                self._set_exception(future, e)
+            else:
+                self._set_result(future, result)
+
+        try:
+            self.predictor.predict_async(_combine_rows([data])).add_done_callback(complete)
+        except Exception as e:  # pylint: disable=broad-except
+            self._set_exception(future, e)
+
+    def _start(self, future):
+        """Mark a call as running, returning False if it was cancelled or failed by its deadline."""
+        with self._future_lock:
+            return not future.done() and future.set_running_or_notify_cancel()
+
+    def _set_result(self, future, result):
+        with self._future_lock:
+            if not future.done():
+                future.set_result(result)
+
+    def _set_exception(self, future, error):
+        with self._future_lock:
+            if future.done() or not (future.running() or future.set_running_or_notify_cancel()):
+                return
+            future.set_exception(error)
+
+
+def _is_input_error(error):
+    """Return whether a ``BatchingPredictor`` combined request may have failed because of one of its rows,
+    rather than because the endpoint is throttling requests, failing or unreachable."""
+    if isinstance(error, ClientError):
+        code = error.response.get('Error', {}).get('Code')
+        status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+        client_error = status is not None and 400 <= status < 500 and code not in _THROTTLING_ERROR_CODES
+        return code == 'ModelError' or client_error
+    # Other errors are raised while serializing, deserializing or splitting the rows, unless they are
+    # raised by botocore
+    return not isinstance(error, (BotoCoreError, futures.TimeoutError))
+
+
+def _combine_rows(rows):
+    """Return the request data of a ``BatchingPredictor`` combined request for ``rows``."""
+    if all(isinstance(row, np.ndarray) for row in rows):
+        return np.vstack(rows)
+    if all(issparse(row) for row in rows):
+        return vstack(rows, format='csr')
+    return list(rows)
+
+
+def _result_rows(result):
+    """Return the number of rows of an inference ``BatchingPredictor`` can split, or None if it cannot split it."""
+    if isinstance(result, list):
+        return len(result)
+    if (isinstance(result, np.ndarray) and result.ndim > 0) or issparse(result) or hasattr(result, 'iloc'):
+        return result.shape[0]
+    return None
+
+
+def _split_result(result, num_rows):
+    """Split the inference of a ``BatchingPredictor`` combined request into the inference of each row.
+
+    Dicts are split value by value, keeping the values without a row for each of ``num_rows`` rows."""
+    if isinstance(result, dict):
+        split = {key: _split_result(value, num_rows) for key, value in six.iteritems(result)
+                 if _result_rows(value) == num_rows}
+        if not split:
+            raise ValueError("Cannot split an inference without values for each of {} rows".format(num_rows))
+        return [{key: split[key][i] if key in split else value for key, value in six.iteritems(result)}
+                for i in range(num_rows)]
+    if _result_rows(result) != num_rows:
+        raise ValueError("Cannot split an inference of type {} into {} rows".format(type(result), num_rows))
+    return [_slice_rows(result, i, i + 1) for i in range(num_rows)]
+
+
+class _SerializedBody(object):
+    """A request body that was already serialized, sent by ``RealTimePredictor`` without serializing it again."""
+
+    def __init__(self, body):
+        self.body = body
+
+
+def _num_rows(data):
+    """Return the number of rows ``predict_batch`` can split ``data`` into, or None if it cannot split it."""
+    if issparse(data) or hasattr(data, 'iloc'):
+        return data.shape[0]
+    if isinstance(data, np.ndarray):
+        return data.shape[0] if data.ndim > 1 else None
+    if isinstance(data, list) and len(data) > 0 and _is_sequence_like(data[0]):
+        return len(data)
+    return None
+
+
+def _slice_rows(data, start, end):
+    if hasattr(data, 'iloc'):
+        return data.iloc[start:end]
+    return data[start:end]
+
+
+def _payload_size(body):
+    """Return the size in bytes of a serialized request body, or None if it is a stream that is not seekable.
+
+    The size of a stream is the number of bytes from its current position to its end."""
+    if isinstance(body, six.text_type):
+        return len(body.encode('utf-8'))
+    if hasattr(body, 'read'):
+        if not (hasattr(body, 'seekable') and body.seekable()):
+            return None
+        position = body.tell()
+        body.seek(0, 2)
+        size = body.tell() - position
+        body.seek(position)
+        return size
+    return memoryview(body).nbytes
+
+
+def _chunk_payload_size(body):
+    """Return the size in bytes of a request body serialized by ``predict_batch``."""
+    size = _payload_size(body)
+    if size is None:
+        raise ValueError("predict_batch requires a serializer returning bytes, str or a seekable stream")
+    return size
+
+
+def _record_size(metrics, name, size):
+    """Record a request or response size in ``metrics``, unless it is None because it is unknown."""
+    if size is not None:
+        metrics.record(name, size)
+
+
+def _response_size(response):
+    """Return the size in bytes of the body of an ``invoke_endpoint`` response, or None if it is unknown."""
+    headers = response.get('ResponseMetadata', {}).get('HTTPHeaders', {})
+    content_length = headers.get('content-length')
+    return None if content_length is None else int(content_length)
+
+
+def _concatenate_results(results, keep_equal=False):
+    """Concatenate the inferences of the chunks of ``predict_batch``, see :meth:`RealTimePredictor.predict_batch`.
+
+    If ``keep_equal`` is True, inferences that cannot be concatenated but are all equal are returned once."""
+    first = results[0]
+    if all(isinstance(result, np.ndarray) and result.ndim > 0 for result in results):
+        return np.concatenate(results)
+    if all(issparse(result) for result in results):
+        return vstack(results, format='csr')
+    if all(isinstance(result, list) for result in results):
+        return [item for result in results for item in result]
+    if all(isinstance(result, dict) and set(result) == set(first) for result in results):
+        return {key: _concatenate_results([result[key] for result in results], keep_equal=True) for key in first}
+    if keep_equal and all(result == first for result in results):
+        return first
+    return results
+
+
+class _CsvSerializer(object):
+    def __init__(self, float_precision=None):
+        """Serialize data into CSV.
+
+        Args:
+            float_precision (int): The number of significant digits of the values of float numpy arrays
+                and DataFrames (default: None). If not specified, values are written with the shortest
+                representation that reads back to the same value.
+        """
         self.content_type = CONTENT_TYPE_CSV
+        self.float_precision = float_precision
 
     def __call__(self, data):
         """Take data of various data formats and serialize them into CSV.
@@ -124,6 +858,11 @@ class _CsvSerializer(object):
         Returns:
             object: Sequence of bytes to be used for the request body.
         """
+        if hasattr(data, 'iloc'):
+            # Rows of pandas DataFrames, without the index and column names
+            data = data.values
+        if isinstance(data, np.ndarray) and data.dtype.kind in _CSV_NUMERIC_KINDS and data.size > 0:
+            return _csv_serialize_numeric(data, self.float_precision)
         # For inputs which represent multiple "rows", the result should be newline-separated CSV rows
         if _is_mutable_sequence_like(data) and len(data) > 0 and _is_sequence_like(data[0]):
             return '\n'.join([_CsvSerializer._serialize_row(row) for row in data])
@@ -149,6 +888,21 @@ class _CsvSerializer(object):
         raise ValueError("Unable to handle input format: ", type(data))
 
 
+def _csv_serialize_numeric(array, float_precision=None):
+    """Serialize a numeric numpy array into CSV, a row per item of its first axis for arrays of 2 or more
+    dimensions, formatting all of its values at once."""
+    array = array.reshape(array.shape[0], -1) if array.ndim > 1 else array.reshape(1, -1)
+    if array.dtype.kind != 'f':
+        # Python ints and bools have the same str() as numpy ones, and are formatted much faster
+        return '\n'.join([','.join(map(str, row)) for row in array.tolist()])
+    if float_precision is not None:
+        strings = np.char.mod('%.{}g'.format(float_precision), array)
+    else:
+        # Matches the str() of each value written by csv.writer
+        strings = array.astype(str)
+    return '\n'.join([','.join(row) for row in strings.tolist()])
+
+
 def _csv_serialize_python_array(data):
     return _csv_serialize_object(data)
 
@@ -236,8 +990,19 @@ class StreamDeserializer(object):
 
 
 class _JsonSerializer(object):
-    def __init__(self):
+    def __init__(self, json_backend=None):
+        """Serialize data into JSON.
+
+        Args:
+            json_backend (module): A JSON module with a ``dumps`` function like the ``json`` module, such as
+                ``simplejson``, ``ujson`` or ``orjson`` (default: None). If not specified, the ``json`` module
+                is used. Modules that serialize numpy arrays themselves, like ``orjson``, are passed numeric
+                arrays without converting them to lists.
+        """
         self.content_type = CONTENT_TYPE_JSON
+        self.json_backend = json_backend or json
+        # orjson serializes numpy arrays when passed this option
+        self._numpy_option = getattr(self.json_backend, 'OPT_SERIALIZE_NUMPY', None)
 
     def __call__(self, data):
         """Take data of various formats and serialize them into the expected request body.
@@ -251,13 +1016,23 @@ class _JsonSerializer(object):
         """
         if isinstance(data, dict):
             # convert each value in dict from a numpy array to a list if necessary, so they can be json serialized
-            return json.dumps({k: _ndarray_to_list(v) for k, v in six.iteritems(data)})
+            return self._dumps({k: self._to_serializable(v) for k, v in six.iteritems(data)})
 
         # files and buffers
         if hasattr(data, 'read'):
             return _json_serialize_from_buffer(data)
 
-        return json.dumps(_ndarray_to_list(data))
+        return self._dumps(self._to_serializable(data))
+
+    def _to_serializable(self, value):
+        if self._numpy_option is not None and _is_native_numeric_array(value):
+            return value
+        return _ndarray_to_list(value)
+
+    def _dumps(self, value):
+        if self._numpy_option is not None:
+            return self.json_backend.dumps(value, option=self._numpy_option)
+        return self.json_backend.dumps(value)
 
 
 json_serializer = _JsonSerializer()
@@ -267,13 +1042,27 @@ def _ndarray_to_list(data):
     return data.tolist() if isinstance(data, np.ndarray) else data
 
 
+def _is_native_numeric_array(data):
+    """Return whether ``data`` is a C-contiguous numpy array of native byte order booleans, integers or floats."""
+    return (isinstance(data, np.ndarray) and data.dtype.kind in _CSV_NUMERIC_KINDS and data.dtype.isnative
+            and data.flags.c_contiguous)
+
+
 def _json_serialize_from_buffer(buff):
     return buff.read()
 
 
 class _JsonDeserializer(object):
-    def __init__(self):
+    def __init__(self, json_backend=None):
+        """Deserialize JSON data.
+
+        Args:
+            json_backend (module): A JSON module with a ``loads`` function like the ``json`` module, such as
+                ``simplejson``, ``ujson`` or ``orjson`` (default: None). If not specified, the ``json``
+                module is used.
+        """
         self.accept = CONTENT_TYPE_JSON
+        self.json_backend = json_backend
 
     def __call__(self, stream, content_type):
         """Decode a JSON object into the corresponding Python object.
@@ -286,6 +1075,8 @@ class _JsonDeserializer(object):
             object: Body of the response deserialized into a JSON object.
         """
         try:
+            if self.json_backend is not None:
+                return self.json_backend.loads(stream.read())
             return json.load(codecs.getreader('utf-8')(stream))
         finally:
             stream.close()
@@ -311,15 +1102,84 @@ class _NumpyDeserializer(object):
         """
         try:
             if content_type == CONTENT_TYPE_CSV:
-                return np.genfromtxt(codecs.getreader('utf-8')(stream), delimiter=',', dtype=self.dtype)
+                data = stream.read()
+                array = _parse_csv_numeric(data, self.dtype)
+                if array is None:
+                    array = np.genfromtxt(codecs.getreader('utf-8')(BytesIO(data)), delimiter=',', dtype=self.dtype)
+                return array
             elif content_type == CONTENT_TYPE_JSON:
                 return np.array(json.load(codecs.getreader('utf-8')(stream)), dtype=self.dtype)
             elif content_type == CONTENT_TYPE_NPY:
-                return np.load(BytesIO(stream.read()))
+                return _npy_deserialize(stream)
         finally:
             stream.close()
 
 
+def _parse_csv_numeric(data, dtype=None):
+    """Parse CSV bytes of numbers into the array ``np.genfromtxt(..., delimiter=',', dtype=dtype)`` returns.
+
+    The whole buffer is parsed at once with ``np.fromstring``. Returns None if the rows are ragged or
+    hold missing or non-numeric values, or if ``np.genfromtxt`` would return a structured array, so that
+    the data can be parsed by ``np.genfromtxt`` instead.
+    """
+    kind = 'f' if dtype is None else np.dtype(dtype).kind
+    data = data.strip()
+    if kind not in 'iuf' or not data:
+        return None
+    buf = np.frombuffer(data, dtype=np.uint8)
+    delimiters = np.flatnonzero(_CSV_DELIMITERS[buf])
+    shape = _csv_shape(buf, delimiters)
+    if shape is None:
+        return None
+    with warnings.catch_warnings():
+        # np.fromstring warns instead of raising when it stops at a value it cannot parse
+        warnings.simplefilter('error', DeprecationWarning)
+        try:
+            values = np.fromstring(data.replace(b'\n', b','), dtype=np.float64, sep=',')
+        except (ValueError, DeprecationWarning):
+            return None
+    if values.size != shape[0] * shape[1]:
+        return None
+    # The column of each value holding a character of a float, from the number of delimiters before it
+    float_columns = np.zeros(shape[1], dtype=bool)
+    float_columns[np.searchsorted(delimiters, np.flatnonzero(_CSV_FLOAT_CHARS[buf])) % shape[1]] = True
+    values = _csv_cast_values(values, dtype, float_columns)
+    return None if values is None else np.squeeze(values.reshape(shape))
+
+
+def _csv_shape(buf, delimiters):
+    """Return the number of rows and columns of the CSV bytes ``buf``, or None if its rows are ragged.
+
+    ``delimiters`` are the positions of the commas and newlines of ``buf``."""
+    line_ends = np.append(np.flatnonzero(buf == ord('\n')), len(buf))
+    # The delimiters before the end of each line after the first include the newline of the previous line
+    commas_per_line = np.diff(np.concatenate([[0], np.searchsorted(delimiters, line_ends)]))
+    commas_per_line[1:] -= 1
+    num_columns = commas_per_line[0] + 1
+    if (commas_per_line != num_columns - 1).any():
+        return None
+    return len(line_ends), num_columns
+
+
+def _csv_cast_values(values, dtype, float_columns):
+    """Return the float64 ``values`` parsed from CSV as the array of ``dtype`` ``np.genfromtxt`` returns, or
+    None if ``np.genfromtxt`` would return a structured array or the values are not exact integers.
+
+    ``float_columns`` tells which columns hold values written as floats. If ``dtype`` is None, the values
+    are integers if no column holds floats, and floats if every column does."""
+    kind = 'f' if dtype is None else np.dtype(dtype).kind
+    if kind == 'f':
+        if dtype is not None or float_columns.all():
+            return values.astype(dtype or np.float64, copy=False)
+        if float_columns.any():
+            return None
+        dtype = np.int64
+    # Integers are exact as float64 values up to 2 ** 53
+    if float_columns.any() or (values.size and np.abs(values).max() >= 2 ** 53):
+        return None
+    return values.astype(dtype)
+
+
 numpy_deserializer = _NumpyDeserializer()
 
 
@@ -354,9 +1214,130 @@ class _NPYSerializer(object):
 
 
 def _npy_serialize(data):
-    buffer = BytesIO()
-    np.save(buffer, data)
-    return buffer.getvalue()
+    """Serialize an array into a readable NPY file object.
+
+    Arrays without Python objects are read from their own memory after the NPY header, so that the
+    request body is not a copy of the array, see :class:`_NpyBody`.
+    """
+    if data.dtype.hasobject:
+        buffer = BytesIO()
+        np.save(buffer, data)
+        buffer.seek(0)
+        return buffer
+    if data.flags.f_contiguous and not data.flags.c_contiguous:
+        # Written in Fortran order, which is the C order of the transposed array
+        header_array, memory_order = data, data.T
+    else:
+        header_array = memory_order = np.require(data, requirements='C')
+    header = BytesIO()
+    header_data = np.lib.format.header_data_from_array_1_0(header_array)
+    try:
+        np.lib.format.write_array_header_1_0(header, header_data)
+    except ValueError:
+        # The header is too large for NPY format version 1.0
+        header = BytesIO()
+        np.lib.format.write_array_header_2_0(header, header_data)
+    return _NpyBody(header.getvalue(), memory_order.reshape(-1).view(np.uint8))
+
+
+class _NpyBody(io.RawIOBase):
+    """A seekable, readable NPY file made of a header and the bytes of an array, read without copying them
+    into a single buffer."""
+
+    def __init__(self, header, data):
+        super(_NpyBody, self).__init__()
+        self._parts = [np.frombuffer(header, dtype=np.uint8), data]
+        self._size = len(header) + data.nbytes
+        self._position = 0
+
+    def __len__(self):
+        return self._size
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._size
+        if offset < 0:
+            raise ValueError("Negative seek position {}".format(offset))
+        self._position = offset
+        return offset
+
+    def readinto(self, b):
+        out = np.frombuffer(b, dtype=np.uint8)
+        written, start = 0, 0
+        for part in self._parts:
+            begin = self._position + written - start
+            if 0 <= begin < len(part):
+                count = min(len(part) - begin, len(out) - written)
+                out[written:written + count] = part[begin:begin + count]
+                written += count
+            start += len(part)
+        self._position += written
+        return written
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = max(0, self._size - self._position)
+        chunk = bytearray(min(size, max(0, self._size - self._position)))
+        self.readinto(chunk)
+        return bytes(chunk)
+
+
+def _npy_deserialize(stream):
+    """Read an NPY file from a stream into a new array, copying its data from the stream only once.
+
+    Arrays of Python objects are read with ``np.load``.
+    """
+    prefix = _read_exactly(stream, len(np.lib.format.MAGIC_PREFIX) + 2)
+    header_length_size = 2 if prefix[-2:-1] == b'\x01' else 4
+    header_length = _read_exactly(stream, header_length_size)
+    header = prefix + header_length + _read_exactly(
+        stream, struct.unpack('<H' if header_length_size == 2 else '<I', header_length)[0])
+    header_file = BytesIO(header)
+    version = np.lib.format.read_magic(header_file)
+    if version not in ((1, 0), (2, 0)):
+        return np.load(BytesIO(header + stream.read()))
+    read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else \
+        np.lib.format.read_array_header_2_0
+    shape, fortran_order, dtype = read_header(header_file)
+    if dtype.hasobject:
+        return np.load(BytesIO(header + stream.read()))
+    array = np.empty(shape, dtype=dtype, order='F' if fortran_order else 'C')
+    _read_into(stream, array.reshape(-1, order='A').view(np.uint8))
+    return array
+
+
+def _read_exactly(stream, size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise ValueError("NPY data ended after {} of {} bytes".format(len(data), size))
+    return data
+
+
+def _read_into(stream, out):
+    """Fill the uint8 array ``out`` with bytes read from ``stream``."""
+    readinto = getattr(stream, 'readinto', None)
+    position = 0
+    while position < len(out):
+        if readinto is not None:
+            count = readinto(memoryview(out[position:]))
+        else:
+            chunk = stream.read(min(len(out) - position, 1 << 20))
+            count = len(chunk)
+            out[position:position + count] = np.frombuffer(chunk, dtype=np.uint8)
+        if not count:
+            raise ValueError("NPY data ended after {} of {} bytes".format(position, len(out)))
+        position += count
 
 
 npy_serializer = _NPYSerializer()
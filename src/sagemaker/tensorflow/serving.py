@@ -77,7 +77,7 @@ class Predictor(sagemaker.RealTimePredictor):
 
         return self.predict(data, args)
 
-    def predict(self, data, initial_args=None):
+    def predict(self, data, initial_args=None, use_cache=True):
         args = dict(initial_args) if initial_args else {}
         if self._model_attributes:
             if 'CustomAttributes' in args:
@@ -85,7 +85,7 @@ class Predictor(sagemaker.RealTimePredictor):
             else:
                 args['CustomAttributes'] = self._model_attributes
 
-        return super(Predictor, self).predict(data, args)
+        return super(Predictor, self).predict(data, args, use_cache=use_cache)
 
 
 class Model(sagemaker.Model):
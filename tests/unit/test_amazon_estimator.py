@@ -12,13 +12,25 @@
 # language governing permissions and limitations under the License.
 from __future__ import absolute_import
 
+import gzip
+import io
+import json
+import threading
+import time
+
 import numpy as np
 import pytest
-from mock import Mock, patch, call
+from scipy.sparse import csr_matrix, random as sparse_random
+from botocore.exceptions import ClientError
+from mock import ANY, Mock, patch, call
 
 # Use PCA as a test implementation of AmazonAlgorithmEstimator
 from sagemaker.amazon.pca import PCA
-from sagemaker.amazon.amazon_estimator import upload_numpy_to_s3_shards, _build_shards, registry
+from sagemaker.amazon.amazon_estimator import (RecordSet, upload_numpy_to_s3_shards, upload_numpy_chunks_to_s3_shards,
+                                               upload_spmatrix_to_s3_shards, _build_shards,
+                                               _build_sparse_shard_bounds, _record_set_fingerprint, _split_rows,
+                                               recommended_shard_size_mb, registry, _gzip_compress)
+from sagemaker.amazon.common import read_records_as_numpy, _read_recordio_index, _DenseEncoderPool
 
 COMMON_ARGS = {'role': 'myrole', 'train_instance_count': 1, 'train_instance_type': 'ml.c4.xlarge'}
 
@@ -148,16 +160,18 @@ def test_fit_ndarray(time, sagemaker_session):
     train = [[1.0, 2.0, 3.0], [4.0, 5.0, 6.0], [7.0, 8.0, 8.0], [44.0, 55.0, 66.0]]
     labels = [99, 85, 87, 2]
     pca.fit(pca.record_set(np.array(train), np.array(labels)))
-    mock_s3.Object.assert_any_call(
-        BUCKET_NAME, 'key-prefix/PCA-2017-11-06-14:14:15.671/matrix_0.pbr'.format(TIMESTAMP))
-    mock_s3.Object.assert_any_call(
-        BUCKET_NAME, 'key-prefix/PCA-2017-11-06-14:14:15.671/matrix_1.pbr'.format(TIMESTAMP))
-    mock_s3.Object.assert_any_call(
-        BUCKET_NAME, 'key-prefix/PCA-2017-11-06-14:14:15.671/matrix_2.pbr'.format(TIMESTAMP))
+    put_object = mock_s3.meta.client.put_object
+    put_object.assert_any_call(
+        Bucket=BUCKET_NAME, Key='key-prefix/PCA-2017-11-06-14:14:15.671/matrix_0.pbr'.format(TIMESTAMP), Body=ANY)
+    put_object.assert_any_call(
+        Bucket=BUCKET_NAME, Key='key-prefix/PCA-2017-11-06-14:14:15.671/matrix_1.pbr'.format(TIMESTAMP), Body=ANY)
+    put_object.assert_any_call(
+        Bucket=BUCKET_NAME, Key='key-prefix/PCA-2017-11-06-14:14:15.671/matrix_2.pbr'.format(TIMESTAMP), Body=ANY)
     mock_s3.Object.assert_any_call(
         BUCKET_NAME, 'key-prefix/PCA-2017-11-06-14:14:15.671/.amazon.manifest'.format(TIMESTAMP))
 
-    assert mock_object.put.call_count == 4
+    assert put_object.call_count == 3
+    assert mock_object.put.call_count == 1
 
 
 def test_build_shards():
@@ -180,6 +194,638 @@ def test_upload_numpy_to_s3_shards():
     array = np.array([[j for j in range(10)] for i in range(10)])
     labels = np.array([i for i in range(10)])
     upload_numpy_to_s3_shards(3, mock_s3, BUCKET_NAME, "key-prefix", array, labels)
-    mock_s3.Object.assert_has_calls([call(BUCKET_NAME, 'key-prefix/matrix_0.pbr')])
-    mock_s3.Object.assert_has_calls([call(BUCKET_NAME, 'key-prefix/matrix_1.pbr')])
-    mock_s3.Object.assert_has_calls([call(BUCKET_NAME, 'key-prefix/matrix_2.pbr')])
+    put_object = mock_s3.meta.client.put_object
+    put_object.assert_has_calls([call(Bucket=BUCKET_NAME, Key='key-prefix/matrix_0.pbr', Body=ANY)])
+    put_object.assert_has_calls([call(Bucket=BUCKET_NAME, Key='key-prefix/matrix_1.pbr', Body=ANY)])
+    put_object.assert_has_calls([call(Bucket=BUCKET_NAME, Key='key-prefix/matrix_2.pbr', Body=ANY)])
+    mock_s3.Object.assert_called_once_with(BUCKET_NAME, 'key-prefix/.amazon.manifest')
+
+
+class _UploadRecorder(object):
+    """An s3 resource mock that keeps the body of every object uploaded."""
+
+    def __init__(self, fail_on=None):
+        self.bodies = {}
+        self.deleted = []
+        self.aborted = []
+        self.fail_on = fail_on
+        self._parts = {}
+        self.meta = Mock()
+        self.meta.client.put_object = Mock(side_effect=lambda Bucket, Key, Body: self._upload(Key, Body))
+        self.meta.client.create_multipart_upload = Mock(side_effect=self._create_multipart_upload)
+        self.meta.client.upload_part = Mock(side_effect=self._upload_part)
+        self.meta.client.complete_multipart_upload = Mock(side_effect=self._complete_multipart_upload)
+        self.meta.client.abort_multipart_upload = Mock(
+            side_effect=lambda Bucket, Key, UploadId: self.aborted.append(Key))
+        self.meta.client.head_object = Mock(side_effect=lambda Bucket, Key: self._get(Key, '404'))
+        self.meta.client.get_object = Mock(side_effect=self._get_range)
+
+    def _upload(self, key, body):
+        if key == self.fail_on:
+            raise RuntimeError('Upload failed')
+        self.bodies[key] = bytes(body)
+
+    def _create_multipart_upload(self, Bucket, Key):
+        self._parts[Key] = {}
+        return {'UploadId': 'upload-' + Key}
+
+    def _upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        if Key == self.fail_on:
+            raise RuntimeError('Upload failed')
+        self._parts[Key][PartNumber] = bytes(Body)
+        return {'ETag': '"{}"'.format(PartNumber)}
+
+    def _complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self._parts.pop(Key)
+        self.bodies[Key] = b''.join(parts[part['PartNumber']] for part in MultipartUpload['Parts'])
+
+    def _get(self, key, error_code):
+        if key not in self.bodies:
+            raise ClientError({'Error': {'Code': error_code, 'Message': 'Not Found'}}, 'GetObject')
+        return {'Body': io.BytesIO(self.bodies[key])}
+
+    def _get_range(self, Bucket, Key, Range=None):
+        response = self._get(Key, 'NoSuchKey')
+        if Range is not None:
+            start, end = [int(bound) for bound in Range[len('bytes='):].split('-')]
+            response['Body'] = io.BytesIO(self.bodies[Key][start:end + 1])
+        return response
+
+    def Object(self, bucket, key):
+        return Mock(put=Mock(side_effect=lambda Body: self._upload(key, Body)),
+                    get=Mock(side_effect=lambda: self._get(key, 'NoSuchKey')),
+                    delete=Mock(side_effect=lambda: self.deleted.append(key)))
+
+    def Bucket(self, bucket):
+        def delete_prefix(Prefix):
+            objects = Mock()
+            objects.delete = Mock(side_effect=lambda: self.deleted.extend(
+                key for key in sorted(self.bodies) if key.startswith(Prefix)))
+            return objects
+
+        return Mock(objects=Mock(filter=Mock(side_effect=delete_prefix)))
+
+    def shards(self, key_prefix):
+        manifest = json.loads(self.bodies[key_prefix + '.amazon.manifest'].decode('utf-8'))
+        return [self.bodies[key_prefix + file_name] for file_name in manifest[1:]]
+
+
+def _read_shards(shards, labels=True):
+    decoded = [read_records_as_numpy(io.BytesIO(shard)) for shard in shards]
+    features = np.concatenate([features for features, _ in decoded])
+    if not labels:
+        return features, None
+    return features, np.concatenate([label_columns['values'] for _, label_columns in decoded])
+
+
+def test_upload_numpy_chunks_to_s3_shards():
+    s3 = _UploadRecorder()
+    array = np.arange(600, dtype='float64').reshape(100, 6)
+    labels = np.arange(100, dtype='float64')
+    chunks = ((array[i:i + 30], labels[i:i + 30]) for i in range(0, 100, 30))
+    with patch('sagemaker.amazon.amazon_estimator._STREAM_BLOCK_BYTES', 240):
+        manifest, num_records, feature_dim = upload_numpy_chunks_to_s3_shards(s3, BUCKET_NAME, 'key-prefix', chunks,
+                                                                              shard_size=1000)
+    assert manifest == 's3://{}/key-prefix/.amazon.manifest'.format(BUCKET_NAME)
+    assert (num_records, feature_dim) == (100, 6)
+    shards = s3.shards('key-prefix/')
+    assert len(shards) > 3
+    # Blocks are capped to the rest of the shard, so shards exceed the shard size by at most a record
+    assert all(len(shard) < 1100 for shard in shards)
+    features, read_labels = _read_shards(shards)
+    assert np.array_equal(features, array)
+    assert np.array_equal(read_labels, labels)
+
+
+def test_upload_numpy_chunks_to_s3_shards_min_shards():
+    s3 = _UploadRecorder()
+    array = np.arange(30, dtype='float64').reshape(10, 3)
+    labels = np.arange(10, dtype='float64')
+    upload_numpy_chunks_to_s3_shards(s3, BUCKET_NAME, 'key-prefix/', [(array, labels)], min_shards=3)
+    shards = s3.shards('key-prefix/')
+    assert len(shards) == 3
+    features, read_labels = _read_shards(shards)
+    assert np.array_equal(features, array)
+    assert np.array_equal(read_labels, labels)
+
+    with pytest.raises(ValueError):
+        upload_numpy_chunks_to_s3_shards(_UploadRecorder(), BUCKET_NAME, 'key-prefix/', [(array, labels)],
+                                         min_shards=11)
+
+
+@patch('sagemaker.amazon.amazon_estimator._UPLOAD_PART_SIZE', 150)
+def test_upload_numpy_chunks_to_s3_shards_multipart_index():
+    s3 = _UploadRecorder()
+    array = np.arange(600, dtype='float64').reshape(100, 6)
+    chunks = ((array[i:i + 30], None) for i in range(0, 100, 30))
+    upload_numpy_chunks_to_s3_shards(s3, BUCKET_NAME, 'key-prefix', chunks, shard_size=1000, min_shards=2,
+                                     index=True)
+    shards = s3.shards('key-prefix/')
+    assert s3.meta.client.complete_multipart_upload.call_count == len([shard for shard in shards if len(shard) > 150])
+    features, _ = _read_shards(shards, labels=False)
+    assert np.array_equal(features, array)
+    manifest = json.loads(s3.bodies['key-prefix/.amazon.manifest'].decode('utf-8'))
+    counts = [len(_read_recordio_index(s3.bodies['key-prefix/' + file_name + '.idx'], len(shard)))
+              for file_name, shard in zip(manifest[1:], shards)]
+    assert sum(counts) == 100
+
+
+def test_upload_numpy_chunks_to_s3_shards_deletes_on_failure():
+    s3 = _UploadRecorder(fail_on='key-prefix/.amazon.manifest')
+    array = np.arange(30, dtype='float64').reshape(10, 3)
+    with pytest.raises(RuntimeError):
+        upload_numpy_chunks_to_s3_shards(s3, BUCKET_NAME, 'key-prefix/', [(array, None), (array, None)],
+                                         shard_size=100)
+    assert sorted(s3.deleted) == sorted(key for key in s3.bodies)
+
+    with pytest.raises(ValueError):
+        upload_numpy_chunks_to_s3_shards(_UploadRecorder(), BUCKET_NAME, 'key-prefix/',
+                                         [(array, None), (array[:, :2], None)])
+
+
+@patch('time.strftime', return_value=TIMESTAMP)
+def test_record_set_chunks(time, sagemaker_session):
+    s3 = _UploadRecorder()
+    sagemaker_session.boto_session.resource = Mock(return_value=s3)
+    kwargs = dict(COMMON_ARGS)
+    kwargs['train_instance_count'] = 2
+    pca = PCA(num_components=55, sagemaker_session=sagemaker_session,
+              data_location='s3://{}/key-prefix/'.format(BUCKET_NAME), **kwargs)
+    chunks = iter([(np.ones((3, 4)), np.zeros(3)), (np.ones((2, 4)), np.zeros(2))])
+    records = pca.record_set(chunks)
+    assert records.s3_data == 's3://{}/key-prefix/PCA-{}/.amazon.manifest'.format(BUCKET_NAME, TIMESTAMP)
+    assert records.num_records == 5
+    assert records.feature_dim == 4
+    assert len(s3.shards('key-prefix/PCA-{}/'.format(TIMESTAMP))) == 2
+
+    with pytest.raises(ValueError):
+        pca.record_set(iter([]), np.zeros(3))
+
+
+def test_upload_numpy_to_s3_shards_memmap(tmpdir):
+    s3 = _UploadRecorder()
+    array = np.memmap(str(tmpdir.join('train')), dtype='float32', mode='w+', shape=(10, 3))
+    array[:] = np.arange(30).reshape(10, 3)
+    labels = np.arange(10, dtype='float32')
+    upload_numpy_to_s3_shards(2, s3, BUCKET_NAME, 'key-prefix', array, labels)
+    features, read_labels = _read_shards(s3.shards('key-prefix/'))
+    assert np.array_equal(features, array)
+    assert np.array_equal(read_labels, labels)
+
+
+def test_upload_numpy_to_s3_shards_deletes_on_failure():
+    s3 = _UploadRecorder(fail_on='key-prefix/matrix_1.pbr')
+    array = np.arange(30, dtype='float64').reshape(10, 3)
+    with pytest.raises(RuntimeError):
+        upload_numpy_to_s3_shards(3, s3, BUCKET_NAME, 'key-prefix', array)
+    assert sorted(s3.deleted) == ['key-prefix/matrix_0.pbr', 'key-prefix/matrix_1.pbr', 'key-prefix/matrix_2.pbr']
+    assert 'key-prefix/.amazon.manifest' not in s3.bodies
+
+
+def test_upload_numpy_to_s3_shards_concurrent_uploads():
+    s3 = _UploadRecorder()
+    lock = threading.Lock()
+    in_flight = [0, 0]
+
+    def upload(Bucket, Key, Body):
+        with lock:
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight)
+        time.sleep(0.01)
+        with lock:
+            in_flight[0] -= 1
+        s3.bodies[Key] = bytes(Body)
+
+    s3.meta.client.put_object.side_effect = upload
+    array = np.arange(60, dtype='float64').reshape(20, 3)
+    upload_numpy_to_s3_shards(10, s3, BUCKET_NAME, 'key-prefix', array)
+    assert 1 < in_flight[1] <= 4
+    features, _ = _read_shards(s3.shards('key-prefix/'), labels=False)
+    assert np.array_equal(features, array)
+
+
+@patch('sagemaker.amazon.amazon_estimator._UPLOAD_PART_SIZE', 100)
+def test_upload_numpy_to_s3_shards_multipart():
+    s3 = _UploadRecorder()
+    array = np.arange(300, dtype='float64').reshape(50, 6)
+    labels = np.arange(50, dtype='float64')
+    upload_numpy_to_s3_shards(2, s3, BUCKET_NAME, 'key-prefix', array, labels)
+    assert s3.meta.client.put_object.call_count == 0
+    parts = s3.meta.client.upload_part.call_args_list
+    assert len(parts) > 2
+    # Every part but the last part of each shard has the part size
+    assert all(len(kwargs['Body']) == 100 for _, kwargs in parts[:-1] if kwargs['Key'] == parts[-1][1]['Key'])
+    assert s3.meta.client.complete_multipart_upload.call_count == 2
+    features, read_labels = _read_shards(s3.shards('key-prefix/'))
+    assert np.array_equal(features, array)
+    assert np.array_equal(read_labels, labels)
+
+
+@patch('sagemaker.amazon.amazon_estimator._UPLOAD_PART_SIZE', 100)
+def test_upload_numpy_to_s3_shards_multipart_aborted_on_failure():
+    s3 = _UploadRecorder(fail_on='key-prefix/matrix_1.pbr')
+    array = np.arange(300, dtype='float64').reshape(50, 6)
+    with pytest.raises(RuntimeError):
+        upload_numpy_to_s3_shards(2, s3, BUCKET_NAME, 'key-prefix', array)
+    assert 'key-prefix/matrix_1.pbr' in s3.aborted
+    assert sorted(s3.deleted) == ['key-prefix/matrix_0.pbr', 'key-prefix/matrix_1.pbr']
+    assert 'key-prefix/.amazon.manifest' not in s3.bodies
+
+
+def test_build_sparse_shard_bounds():
+    assert _build_sparse_shard_bounds(3, np.array([0, 100, 100, 100, 101, 102, 200])) == [0, 1, 5, 6]
+    assert _build_sparse_shard_bounds(3, np.array([0, 0, 0, 0])) == [0, 1, 2, 3]
+    assert _build_sparse_shard_bounds(1, np.array([0, 5])) == [0, 1]
+    # The rows after a row with most of the values are split evenly
+    assert _build_sparse_shard_bounds(4, np.cumsum([0, 1000] + [1] * 99)) == [0, 1, 34, 67, 100]
+
+    with pytest.raises(ValueError):
+        _build_sparse_shard_bounds(0, np.array([0, 5]))
+    with pytest.raises(ValueError):
+        _build_sparse_shard_bounds(3, np.array([0, 5, 6]))
+
+
+def test_upload_spmatrix_to_s3_shards():
+    s3 = _UploadRecorder()
+    array = sparse_random(200, 50, density=0.05, format='csr', random_state=0)
+    array = csr_matrix(np.vstack([np.ones((20, 50)), array.toarray()]))
+    labels = np.arange(220, dtype='float64')
+    upload_spmatrix_to_s3_shards(4, s3, BUCKET_NAME, 'key-prefix', array.tocoo(), labels)
+
+    shards = s3.shards('key-prefix/')
+    assert len(shards) == 4
+    decoded = [read_records_as_numpy(io.BytesIO(shard)) for shard in shards]
+    # Equal row counts would put over 1000 of the 1500 non-zero values in the first shard
+    nnz = [features.nnz for features, _ in decoded]
+    assert max(nnz) < 1.5 * min(nnz)
+    features = np.vstack([features.toarray() for features, _ in decoded])
+    assert np.array_equal(features, array.toarray())
+    assert np.array_equal(np.concatenate([label_columns['values'] for _, label_columns in decoded]), labels)
+
+
+@patch('time.strftime', return_value=TIMESTAMP)
+def test_record_set_sparse(time, sagemaker_session):
+    s3 = _UploadRecorder()
+    sagemaker_session.boto_session.resource = Mock(return_value=s3)
+    pca = PCA(num_components=55, sagemaker_session=sagemaker_session,
+              data_location='s3://{}/key-prefix/'.format(BUCKET_NAME), **COMMON_ARGS)
+    records = pca.record_set(csr_matrix(np.eye(5)), np.arange(5))
+    assert records.num_records == 5
+    assert records.feature_dim == 5
+    features, _ = read_records_as_numpy(io.BytesIO(s3.shards('key-prefix/PCA-{}/'.format(TIMESTAMP))[0]))
+    assert np.array_equal(features.toarray(), np.eye(5))
+
+
+def test_split_rows():
+    splits = _split_rows(100, [.8, .1, .1], shuffle_seed=1)
+    assert [len(rows) for rows in splits] == [80, 10, 10]
+    assert np.array_equal(np.sort(np.concatenate(splits)), np.arange(100))
+    assert all(np.array_equal(a, b) for a, b in zip(splits, _split_rows(100, [.8, .1, .1], shuffle_seed=1)))
+    assert [len(rows) for rows in _split_rows(10, [.5, .25])] == [5, 3]
+    for fractions in ([], [.5, 0], [.8, .3]):
+        with pytest.raises(ValueError):
+            _split_rows(10, fractions)
+
+
+@pytest.mark.parametrize('sparse', [False, True])
+@patch('time.strftime', return_value=TIMESTAMP)
+def test_record_sets(time, sagemaker_session, sparse):
+    s3 = _UploadRecorder()
+    sagemaker_session.boto_session.resource = Mock(return_value=s3)
+    pca = PCA(num_components=55, sagemaker_session=sagemaker_session,
+              data_location='s3://{}/key-prefix/'.format(BUCKET_NAME), **COMMON_ARGS)
+    array = np.arange(600, dtype='float64').reshape(100, 6)
+    labels = np.arange(100, dtype='float64')
+    features = csr_matrix(array) if sparse else array
+
+    def read_channel(channel):
+        decoded = [read_records_as_numpy(io.BytesIO(shard))
+                   for shard in s3.shards('key-prefix/PCA-{}/{}/'.format(TIMESTAMP, channel))]
+        return (np.vstack([f.toarray() if sparse else f for f, _ in decoded]),
+                np.concatenate([label_columns['values'] for _, label_columns in decoded]).astype(int))
+
+    records = pca.record_sets(features, labels, splits=[('train', .7), ('test', .3)], shuffle_seed=3,
+                              shards_per_instance=2)
+    assert [(r.channel, r.num_records, r.feature_dim) for r in records] == [('train', 70, 6), ('test', 30, 6)]
+    rows = []
+    for record_set in records:
+        key_prefix = 'key-prefix/PCA-{}/{}/'.format(TIMESTAMP, record_set.channel)
+        assert record_set.s3_data == 's3://{}/{}.amazon.manifest'.format(BUCKET_NAME, key_prefix)
+        assert len(s3.shards(key_prefix)) == 2
+        decoded_features, decoded_rows = read_channel(record_set.channel)
+        assert np.array_equal(decoded_features, array[decoded_rows])
+        rows.append(decoded_rows)
+    assert np.array_equal(np.sort(np.concatenate(rows)), np.arange(100))
+    assert not np.array_equal(rows[0], np.sort(rows[0]))
+
+    again = pca.record_sets(features, labels, splits=[('train', .7), ('test', .3)], shuffle_seed=3)
+    assert [r.s3_data for r in again] == [r.s3_data for r in records]
+    assert np.array_equal(read_channel('train')[1], rows[0])
+
+
+def test_record_sets_checks_channels_before_uploading(sagemaker_session):
+    s3 = _UploadRecorder()
+    sagemaker_session.boto_session.resource = Mock(return_value=s3)
+    kwargs = dict(COMMON_ARGS)
+    kwargs['train_instance_count'] = 2
+    pca = PCA(num_components=55, sagemaker_session=sagemaker_session,
+              data_location='s3://{}/key-prefix/'.format(BUCKET_NAME), **kwargs)
+    with pytest.raises(ValueError) as error:
+        pca.record_sets(np.ones((50, 3)), splits=[('train', .98), ('test', .02)])
+    assert 'Channel test' in str(error)
+    assert s3.bodies == {}
+
+
+@patch('time.strftime', return_value=TIMESTAMP)
+def test_record_sets_deletes_channels_on_failure(time, sagemaker_session):
+    key_prefix = 'key-prefix/PCA-{}/'.format(TIMESTAMP)
+    s3 = _UploadRecorder(fail_on=key_prefix + 'test/matrix_0.pbr')
+    sagemaker_session.boto_session.resource = Mock(return_value=s3)
+    pca = PCA(num_components=55, sagemaker_session=sagemaker_session,
+              data_location='s3://{}/key-prefix/'.format(BUCKET_NAME), **COMMON_ARGS)
+    with pytest.raises(RuntimeError):
+        pca.record_sets(np.ones((50, 3)), splits=[('train', .6), ('validation', .2), ('test', .2)], index=True)
+    for channel in ('train', 'validation'):
+        channel_keys = [key for key in s3.bodies if key.startswith(key_prefix + channel + '/')]
+        assert key_prefix + channel + '/.amazon.manifest' in channel_keys
+        assert set(channel_keys) <= set(s3.deleted)
+
+
+def test_record_sets_default_splits(sagemaker_session):
+    sagemaker_session.boto_session.resource = Mock(return_value=_UploadRecorder())
+    pca = PCA(num_components=55, sagemaker_session=sagemaker_session,
+              data_location='s3://{}/key-prefix/'.format(BUCKET_NAME), **COMMON_ARGS)
+    records = pca.record_sets(np.ones((50, 3)), shuffle_seed=0)
+    assert [(r.channel, r.num_records) for r in records] == [('train', 40), ('validation', 5), ('test', 5)]
+    with pytest.raises(ValueError):
+        pca.record_sets(np.ones((50, 3)), splits={'train': .9, 'test': .2})
+
+
+@pytest.mark.parametrize('compression', ['gzip', 'Gzip'])
+def test_upload_numpy_to_s3_shards_gzip(compression):
+    s3 = _UploadRecorder()
+    array = np.arange(600, dtype='float64').reshape(100, 6)
+    labels = np.arange(100, dtype='float64')
+    upload_numpy_to_s3_shards(2, s3, BUCKET_NAME, 'key-prefix', array, labels, compression=compression)
+    manifest = json.loads(s3.bodies['key-prefix/.amazon.manifest'].decode('utf-8'))
+    assert manifest[1:] == ['matrix_0.pbr.gz', 'matrix_1.pbr.gz']
+
+    uncompressed = _UploadRecorder()
+    upload_numpy_to_s3_shards(2, uncompressed, BUCKET_NAME, 'key-prefix', array, labels)
+    for shard, expected in zip(s3.shards('key-prefix/'), uncompressed.shards('key-prefix/')):
+        assert gzip.GzipFile(fileobj=io.BytesIO(shard)).read() == expected
+        assert len(shard) < len(expected)
+
+
+@patch('sagemaker.amazon.amazon_estimator._UPLOAD_PART_SIZE', 100)
+def test_upload_numpy_to_s3_shards_gzip_multipart():
+    s3 = _UploadRecorder()
+    array = np.random.RandomState(0).rand(100, 6)
+    compress_threads = []
+
+    def compress(data):
+        compress_threads.append(threading.current_thread())
+        return _gzip_compress(data)
+
+    with patch('sagemaker.amazon.amazon_estimator._gzip_compress', side_effect=compress):
+        upload_numpy_to_s3_shards(2, s3, BUCKET_NAME, 'key-prefix', array, compression='gzip')
+    # Shards are compressed in blocks by the upload threads
+    assert len(compress_threads) > 2
+    assert threading.current_thread() not in compress_threads
+    assert s3.meta.client.complete_multipart_upload.call_count == 2
+    for key in ('key-prefix/matrix_0.pbr.gz', 'key-prefix/matrix_1.pbr.gz'):
+        parts = [kwargs['Body'] for _, kwargs in s3.meta.client.upload_part.call_args_list if kwargs['Key'] == key]
+        assert all(len(part) >= 100 for part in parts[:-1])
+    shards = [gzip.GzipFile(fileobj=io.BytesIO(shard)).read() for shard in s3.shards('key-prefix/')]
+    assert np.array_equal(_read_shards(shards, labels=False)[0], array)
+
+
+def test_upload_numpy_chunks_to_s3_shards_gzip():
+    s3 = _UploadRecorder()
+    array = np.arange(600, dtype='float64').reshape(100, 6)
+    manifest, _, _ = upload_numpy_chunks_to_s3_shards(s3, BUCKET_NAME, 'key-prefix', [(array, None)], min_shards=2,
+                                                      compression='gzip')
+    shards = [gzip.GzipFile(fileobj=io.BytesIO(shard)).read() for shard in s3.shards('key-prefix/')]
+    assert len(shards) == 2
+    assert np.array_equal(_read_shards(shards, labels=False)[0], array)
+
+
+@patch('time.strftime', return_value=TIMESTAMP)
+def test_record_set_gzip(time, sagemaker_session):
+    sagemaker_session.boto_session.resource = Mock(return_value=_UploadRecorder())
+    pca = PCA(num_components=55, sagemaker_session=sagemaker_session,
+              data_location='s3://{}/key-prefix/'.format(BUCKET_NAME), **COMMON_ARGS)
+    records = pca.record_set(np.ones((10, 3)), compression='gzip')
+    assert records.compression == 'Gzip'
+    config = records.records_s3_input().config
+    assert config['CompressionType'] == 'Gzip'
+    assert config['InputMode'] == 'Pipe'
+    assert [r.compression for r in pca.record_sets(np.ones((10, 3)), compression='gzip')] == ['Gzip'] * 3
+    with pytest.raises(ValueError):
+        pca.record_set(np.ones((10, 3)), compression='bzip2')
+
+
+def test_record_set_uncompressed_channel():
+    config = RecordSet('s3://{}/manifest'.format(BUCKET_NAME), num_records=1, feature_dim=1).records_s3_input().config
+    assert 'CompressionType' not in config
+    assert 'InputMode' not in config
+
+
+def test_upload_numpy_to_s3_shards_index():
+    s3 = _UploadRecorder()
+    array = np.arange(600, dtype='float64').reshape(100, 6)
+    upload_numpy_to_s3_shards(2, s3, BUCKET_NAME, 'key-prefix', array, np.arange(100, dtype='float64'), index=True)
+    manifest = json.loads(s3.bodies['key-prefix/.amazon.manifest'].decode('utf-8'))
+    assert manifest[1:] == ['matrix_0.pbr', 'matrix_1.pbr']
+    for file_name, shard in zip(manifest[1:], s3.shards('key-prefix/')):
+        index = _read_recordio_index(s3.bodies['key-prefix/' + file_name + '.idx'], len(shard))
+        assert len(index) == 50
+    with pytest.raises(ValueError):
+        upload_numpy_to_s3_shards(2, s3, BUCKET_NAME, 'key-prefix', array, index=True, compression='gzip')
+
+
+def _indexed_record_set(sagemaker_session, array, labels, index=True):
+    s3 = _UploadRecorder()
+    sagemaker_session.boto_session.resource = Mock(return_value=s3)
+    pca = PCA(num_components=55, sagemaker_session=sagemaker_session,
+              data_location='s3://{}/key-prefix/'.format(BUCKET_NAME), **COMMON_ARGS)
+    return pca.record_set(array, labels, target_shard_size_mb=.0005, index=index)
+
+
+def test_record_set_head(sagemaker_session):
+    array = np.arange(600, dtype='float64').reshape(100, 6)
+    labels = np.arange(100, dtype='float64')
+    records = _indexed_record_set(sagemaker_session, array, labels)
+    features, label_columns = records.head(30, sagemaker_session=sagemaker_session)
+    assert np.array_equal(features, array[:30])
+    assert np.array_equal(label_columns['values'], labels[:30])
+    assert len(records.head(500, sagemaker_session=sagemaker_session)[0]) == 100
+
+
+def test_record_set_sample(sagemaker_session):
+    array = np.arange(600, dtype='float64').reshape(100, 6)
+    labels = np.arange(100, dtype='float64')
+    records = _indexed_record_set(sagemaker_session, array, labels)
+    for n in (5, 80):
+        features, label_columns = records.sample(n, random_state=0, sagemaker_session=sagemaker_session)
+        rows = label_columns['values'].astype(int)
+        assert len(np.unique(rows)) == n
+        assert np.all(np.diff(rows) > 0)
+        assert np.array_equal(features, array[rows])
+    assert np.array_equal(records.sample(5, random_state=0, sagemaker_session=sagemaker_session)[0],
+                          records.sample(5, random_state=0, sagemaker_session=sagemaker_session)[0])
+    with pytest.raises(ValueError):
+        records.sample(101, sagemaker_session=sagemaker_session)
+
+
+def test_record_set_head_without_index(sagemaker_session):
+    records = _indexed_record_set(sagemaker_session, np.ones((10, 3)), None, index=False)
+    with pytest.raises(ValueError) as error:
+        records.head(1, sagemaker_session=sagemaker_session)
+    assert 'index=True' in str(error.value)
+
+
+def test_build_shards_even_sizes():
+    shards = _build_shards(4, np.arange(10))
+    assert [len(shard) for shard in shards] == [2, 3, 2, 3]
+    assert np.array_equal(np.concatenate(shards), np.arange(10))
+
+
+def test_recommended_shard_size_mb():
+    assert recommended_shard_size_mb(100, 1) == 64
+    assert recommended_shard_size_mb(2000, 2) == 250
+    assert recommended_shard_size_mb(2000, 2, min_shards_per_instance=1) == 1000
+    assert recommended_shard_size_mb(100000, 2) == 1024
+
+
+@pytest.mark.parametrize('shard_args, num_shards', [({}, 2),
+                                                    ({'shards_per_instance': 3}, 6),
+                                                    ({'target_shard_size_mb': 0.003}, 4),
+                                                    ({'target_shard_size_mb': 100}, 2),
+                                                    ({'target_shard_size_mb': 0.00001}, 120)])
+def test_record_set_num_shards(sagemaker_session, shard_args, num_shards):
+    s3 = _UploadRecorder()
+    sagemaker_session.boto_session.resource = Mock(return_value=s3)
+    kwargs = dict(COMMON_ARGS)
+    kwargs['train_instance_count'] = 2
+    pca = PCA(num_components=55, sagemaker_session=sagemaker_session,
+              data_location='s3://{}/key-prefix/'.format(BUCKET_NAME), **kwargs)
+    # 120 records of 10 float64 values and 32 bytes of overhead are estimated at about 0.0064 MB per instance
+    train = np.ones((120, 10))
+    records = pca.record_set(train, **shard_args)
+    key_prefix = records.s3_data[len('s3://{}/'.format(BUCKET_NAME)):-len('.amazon.manifest')]
+    shards = s3.shards(key_prefix)
+    assert len(shards) == num_shards
+    assert max(len(shard) for shard in shards) == min(len(shard) for shard in shards)
+
+
+def test_record_set_shard_options_validation(sagemaker_session):
+    pca = PCA(num_components=55, sagemaker_session=sagemaker_session, **COMMON_ARGS)
+    with pytest.raises(ValueError):
+        pca.record_set(np.ones((10, 2)), target_shard_size_mb=1, shards_per_instance=2)
+    with pytest.raises(ValueError):
+        pca.record_set(np.ones((10, 2)), shards_per_instance=0)
+    with pytest.raises(ValueError):
+        pca.record_set(iter([(np.ones((10, 2)), None)]), shards_per_instance=2)
+
+
+def test_record_set_fingerprint():
+    array = np.arange(12, dtype='float64').reshape(4, 3)
+    labels = np.arange(4)
+    fingerprint = _record_set_fingerprint(array, labels, 2)
+    assert fingerprint == _record_set_fingerprint(array.copy(), labels.copy(), 2)
+    assert fingerprint == _record_set_fingerprint(np.asfortranarray(array), labels, 2)
+    assert fingerprint != _record_set_fingerprint(array, labels, 3)
+    assert fingerprint != _record_set_fingerprint(array, None, 2)
+    assert fingerprint != _record_set_fingerprint(array, labels + 1, 2)
+    assert fingerprint != _record_set_fingerprint(array.astype('float32'), labels, 2)
+    assert fingerprint != _record_set_fingerprint(array.reshape(3, 4), labels, 2)
+    assert fingerprint != _record_set_fingerprint(csr_matrix(array), labels, 2)
+
+
+def test_record_set_cache(sagemaker_session):
+    s3 = _UploadRecorder()
+    sagemaker_session.boto_session.resource = Mock(return_value=s3)
+    pca = PCA(num_components=55, sagemaker_session=sagemaker_session,
+              data_location='s3://{}/key-prefix/'.format(BUCKET_NAME), **COMMON_ARGS)
+    train = np.arange(30, dtype='float64').reshape(10, 3)
+    labels = np.arange(10, dtype='float64')
+
+    records = pca.record_set(train, labels, cache=True)
+    assert records.s3_data.startswith('s3://{}/key-prefix/PCA-'.format(BUCKET_NAME))
+    assert (records.num_records, records.feature_dim) == (10, 3)
+    assert s3.meta.client.put_object.call_count == 1
+
+    cached = pca.record_set(train, labels, channel='test', cache=True)
+    assert cached.s3_data == records.s3_data
+    assert (cached.num_records, cached.feature_dim, cached.channel) == (10, 3, 'test')
+    assert s3.meta.client.put_object.call_count == 1
+
+    del s3.bodies[[key for key in s3.bodies if key.endswith('matrix_0.pbr')][0]]
+    assert pca.record_set(train, labels, cache=True).s3_data == records.s3_data
+    assert s3.meta.client.put_object.call_count == 2
+
+    assert pca.record_set(train, labels * 2, cache=True).s3_data != records.s3_data
+    with pytest.raises(ValueError):
+        pca.record_set(iter([(train, labels)]), cache=True)
+
+
+class _PoolRecorder(object):
+    """Creates encoder pools, recording the number of threads running when each pool is created."""
+
+    def __init__(self):
+        self.thread_counts = []
+
+    def __call__(self, *args, **kwargs):
+        self.thread_counts.append(threading.active_count())
+        return _DenseEncoderPool(*args, **kwargs)
+
+
+@patch('time.strftime', return_value=TIMESTAMP)
+def test_record_set_processes_single_pool(time, sagemaker_session):
+    s3 = _UploadRecorder()
+    sagemaker_session.boto_session.resource = Mock(return_value=s3)
+    pca = PCA(num_components=55, sagemaker_session=sagemaker_session,
+              data_location='s3://{}/key-prefix/'.format(BUCKET_NAME), **COMMON_ARGS)
+    array = np.arange(600, dtype='float64').reshape(100, 6)
+    labels = np.arange(100, dtype='float64')
+    threads = threading.active_count()
+
+    pools = _PoolRecorder()
+    with patch('sagemaker.amazon.amazon_estimator._DenseEncoderPool', pools):
+        pca.record_set(array, labels, processes=2, shards_per_instance=3)
+    # One pool encodes every shard, and is started before the upload threads
+    assert pools.thread_counts == [threads]
+    features, read_labels = _read_shards(s3.shards('key-prefix/PCA-{}/'.format(TIMESTAMP)))
+    assert np.array_equal(features, array)
+    assert np.array_equal(read_labels, labels)
+
+    pools = _PoolRecorder()
+    with patch('sagemaker.amazon.amazon_estimator._DenseEncoderPool', pools):
+        records = pca.record_sets(array, labels, splits=[('train', .5), ('test', .5)], processes=2,
+                                  shards_per_instance=2)
+    assert pools.thread_counts == [threads]
+    rows = []
+    for record_set in records:
+        features, read_labels = _read_shards(s3.shards('key-prefix/PCA-{}/{}/'.format(TIMESTAMP, record_set.channel)))
+        assert np.array_equal(features, array[read_labels.astype(int)])
+        rows.append(read_labels)
+    assert np.array_equal(np.sort(np.concatenate(rows)), labels)
+
+
+def test_upload_numpy_chunks_to_s3_shards_processes():
+    s3 = _UploadRecorder()
+    array = np.arange(600, dtype='float64').reshape(100, 6)
+    labels = np.arange(100, dtype='float64')
+    chunks = ((array[i:i + 30], labels[i:i + 30]) for i in range(0, 100, 30))
+    pools = _PoolRecorder()
+    with patch('sagemaker.amazon.amazon_estimator._DenseEncoderPool', pools):
+        upload_numpy_chunks_to_s3_shards(s3, BUCKET_NAME, 'key-prefix', chunks, shard_size=1000, processes=8)
+    assert len(pools.thread_counts) == 1
+    shards = s3.shards('key-prefix/')
+    # Blocks of the processes are capped to the rest of the shard, so shards exceed the shard size by at
+    # most a record of 6 features and a label (about 90 bytes)
+    assert max(len(shard) for shard in shards) < 1100
+    features, read_labels = _read_shards(shards)
+    assert np.array_equal(features, array)
+    assert np.array_equal(read_labels, labels)
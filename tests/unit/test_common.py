@@ -12,16 +12,48 @@
 # language governing permissions and limitations under the License.
 from __future__ import absolute_import
 
+import io
+import os
 import numpy as np
 import tempfile
 import pytest
 import itertools
-from scipy.sparse import coo_matrix
-from sagemaker.amazon.common import (record_deserializer, write_numpy_to_dense_tensor, read_recordio,
-                                     numpy_to_record_serializer, write_spmatrix_to_sparse_tensor)
+from mock import patch
+from scipy.sparse import coo_matrix, csr_matrix
+from sagemaker.amazon.common import (record_deserializer, record_to_numpy_deserializer, write_numpy_to_dense_tensor,
+                                     read_recordio, numpy_to_record_serializer, write_spmatrix_to_sparse_tensor,
+                                     iter_records, read_records_as_numpy, RecordIOFile, record_serializer,
+                                     spmatrix_to_record_serializer,
+                                     _write_recordio, _share_array, _open_shared_array, _DenseEncoderPool)
 from sagemaker.amazon.record_pb2 import Record
 
 
+def _protobuf_dense_tensor(array, labels, feature_tensor, label_tensor):
+    buf = io.BytesIO()
+    for index, vector in enumerate(array):
+        record = Record()
+        getattr(record.features["values"], feature_tensor).values.extend(vector)
+        if labels is not None:
+            getattr(record.label["values"], label_tensor).values.extend([labels[index]])
+        _write_recordio(buf, record.SerializeToString())
+    return buf.getvalue()
+
+
+def _protobuf_sparse_tensor(array, labels, tensor):
+    buf = io.BytesIO()
+    csr_array = csr_matrix(array)
+    for index in range(csr_array.shape[0]):
+        row = csr_array.getrow(index)
+        record = Record()
+        getattr(record.features["values"], tensor).values.extend(row.data)
+        getattr(record.features["values"], tensor).keys.extend(row.indices.astype(np.uint64))
+        getattr(record.features["values"], tensor).shape.extend([csr_array.shape[1]])
+        if labels is not None:
+            record.label["values"].int32_tensor.values.extend([labels[index]])
+        _write_recordio(buf, record.SerializeToString())
+    return buf.getvalue()
+
+
 def test_serializer():
     s = numpy_to_record_serializer()
     array_data = [[1.0, 2.0, 3.0], [10.0, 20.0, 30.0]]
@@ -51,6 +83,42 @@ def test_deserializer():
         assert record.features["values"].float64_tensor.values == expected
 
 
+def test_spmatrix_to_record_serializer():
+    array = csr_matrix(np.array([[0.0, 2.0, 0.0], [0.0, 0.0, 0.0], [1.0, 0.0, 3.0]]))
+    buf = spmatrix_to_record_serializer()(array)
+    assert buf.getvalue() == _protobuf_sparse_tensor(array, None, 'float64_tensor')
+
+
+def test_record_serializer():
+    serializer = record_serializer()
+    assert serializer.content_type == 'application/x-recordio-protobuf'
+
+    sparse = csr_matrix(np.array([[0.0, 2.0, 0.0], [1.0, 0.0, 3.0]]))
+    tensor = Record.FromString(next(read_recordio(serializer(sparse)))).features["values"].float64_tensor
+    assert tensor.values == [2.0] and tensor.keys == [1] and tensor.shape == [3]
+
+    dense = np.array([1.0, 2.0, 3.0])
+    tensor = Record.FromString(next(read_recordio(serializer(dense)))).features["values"].float64_tensor
+    assert tensor.values == [1.0, 2.0, 3.0] and not tensor.keys
+
+
+def test_record_to_numpy_deserializer():
+    buf = io.BytesIO()
+    for cluster, distance in [(1, 0.5), (0, 2.5), (3, 1.0)]:
+        record = Record()
+        record.label["closest_cluster"].float32_tensor.values.extend([cluster])
+        record.label["distance_to_cluster"].float32_tensor.values.extend([distance])
+        _write_recordio(buf, record.SerializeToString())
+    buf.seek(0)
+
+    labels = record_to_numpy_deserializer()(buf, 'application/x-recordio-protobuf')
+    assert buf.closed
+    assert sorted(labels) == ['closest_cluster', 'distance_to_cluster']
+    assert labels['closest_cluster'].dtype == np.float32
+    assert np.array_equal(labels['closest_cluster'], [1, 0, 3])
+    assert np.array_equal(labels['distance_to_cluster'], [0.5, 2.5, 1.0])
+
+
 def test_float_write_numpy_to_dense_tensor():
     array_data = [[1.0, 2.0, 3.0], [10.0, 20.0, 30.0]]
     array = np.array(array_data)
@@ -147,6 +215,64 @@ def test_invalid_label():
             write_numpy_to_dense_tensor(f, array, label_data)
 
 
+@pytest.mark.parametrize('dtype, feature_tensor', [('float32', 'float32_tensor'),
+                                                   ('float64', 'float64_tensor'),
+                                                   ('int64', 'int32_tensor')])
+@pytest.mark.parametrize('label_dtype, label_tensor', [(None, None),
+                                                       ('float32', 'float32_tensor'),
+                                                       ('float64', 'float64_tensor'),
+                                                       ('int64', 'int32_tensor')])
+def test_write_numpy_to_dense_tensor_matches_protobuf(dtype, feature_tensor, label_dtype, label_tensor):
+    array = (np.random.RandomState(7).randn(50, 13) * 1000).astype(dtype)
+    labels = None if label_dtype is None else np.arange(-25, 25).astype(label_dtype) * 7
+    buf = io.BytesIO()
+    with patch('sagemaker.amazon.common._ENCODE_BLOCK_BYTES', 64):
+        write_numpy_to_dense_tensor(buf, array, labels)
+    assert buf.getvalue() == _protobuf_dense_tensor(array, labels, feature_tensor, label_tensor)
+
+
+def test_write_numpy_to_dense_tensor_empty_rows_matches_protobuf():
+    array = np.zeros((3, 0), dtype='float32')
+    buf = io.BytesIO()
+    write_numpy_to_dense_tensor(buf, array)
+    assert buf.getvalue() == _protobuf_dense_tensor(array, None, 'float32_tensor', None)
+
+
+def test_write_numpy_to_dense_tensor_int_out_of_range():
+    array = np.array([[1, 2 ** 31]])
+    with pytest.raises(ValueError):
+        write_numpy_to_dense_tensor(io.BytesIO(), array)
+
+
+@pytest.mark.parametrize('dtype, converted_dtype, tensor', [('int8', 'int64', 'int32_tensor'),
+                                                            ('int16', 'int64', 'int32_tensor'),
+                                                            ('>i4', 'int64', 'int32_tensor'),
+                                                            ('uint8', 'int64', 'int32_tensor'),
+                                                            ('uint32', 'int64', 'int32_tensor'),
+                                                            ('bool', 'int64', 'int32_tensor'),
+                                                            ('float16', 'float32', 'float32_tensor'),
+                                                            ('>f8', 'float64', 'float64_tensor')])
+def test_write_numpy_to_dense_tensor_converts_dtype(dtype, converted_dtype, tensor):
+    array = (np.random.RandomState(9).rand(20, 7) * 100).astype(dtype)
+    labels = np.arange(20).astype(dtype)
+    buf = io.BytesIO()
+    with patch('sagemaker.amazon.common._ENCODE_BLOCK_BYTES', 64):
+        write_numpy_to_dense_tensor(buf, array, labels)
+    expected = _protobuf_dense_tensor(array.astype(converted_dtype), labels.astype(converted_dtype), tensor, tensor)
+    assert buf.getvalue() == expected
+
+
+def test_write_numpy_to_dense_tensor_uint64_out_of_range():
+    array = np.array([[1, 2 ** 64 - 1]], dtype='uint64')
+    with pytest.raises(ValueError):
+        write_numpy_to_dense_tensor(io.BytesIO(), array)
+
+
+def test_write_numpy_to_dense_tensor_unsupported_dtype():
+    with pytest.raises(ValueError):
+        write_numpy_to_dense_tensor(io.BytesIO(), np.array([['a', 'b']]))
+
+
 def test_dense_float_write_spmatrix_to_sparse_tensor():
     array_data = [[1.0, 2.0, 3.0], [10.0, 20.0, 30.0]]
     keys_data = [[0, 1, 2], [0, 1, 2]]
@@ -340,3 +466,270 @@ def test_dense_to_sparse():
     with tempfile.TemporaryFile() as f:
         with pytest.raises(TypeError):
             write_spmatrix_to_sparse_tensor(f, array, label_data)
+
+
+@pytest.mark.parametrize('sparse_format', ['csr', 'csc', 'coo'])
+@pytest.mark.parametrize('dtype, tensor', [('float32', 'float32_tensor'),
+                                           ('float64', 'float64_tensor'),
+                                           ('int64', 'int32_tensor'),
+                                           ('int16', 'int32_tensor'),
+                                           ('uint16', 'int32_tensor')])
+def test_write_spmatrix_to_sparse_tensor_matches_protobuf(sparse_format, dtype, tensor):
+    dense = np.random.RandomState(3).randint(-200, 200, size=(40, 300))
+    dense[dense < 170] = 0
+    dense[7] = 0
+    array = coo_matrix(dense.astype(dtype)).asformat(sparse_format)
+    labels = np.arange(40) * 11
+    buf = io.BytesIO()
+    with patch('sagemaker.amazon.common._ENCODE_BLOCK_BYTES', 64):
+        write_spmatrix_to_sparse_tensor(buf, array, labels)
+    assert buf.getvalue() == _protobuf_sparse_tensor(array, labels, tensor)
+
+
+def test_write_spmatrix_to_sparse_tensor_uses_canonical_coo_without_tocsr():
+    array = coo_matrix(np.array([[1.0, 0.0, 2.0], [0.0, 0.0, 0.0], [0.0, 3.0, 0.0]]))
+    expected = _protobuf_sparse_tensor(array, None, 'float64_tensor')
+    buf = io.BytesIO()
+    with patch.object(coo_matrix, 'tocsr', side_effect=AssertionError('tocsr called')):
+        write_spmatrix_to_sparse_tensor(buf, array)
+    assert buf.getvalue() == expected
+
+
+def test_write_spmatrix_to_sparse_tensor_column_sorted_canonical_coo():
+    dense = np.array([[1.0, 0.0, 2.0], [0.0, 4.0, 0.0], [3.0, 5.0, 6.0]])
+    col, row = np.nonzero(dense.T)
+    # Column-major entries, flagged as canonical like scipy 1.0 sum_duplicates does
+    array = coo_matrix((dense[row, col], (row, col)), shape=dense.shape)
+    array.has_canonical_format = True
+    buf = io.BytesIO()
+    write_spmatrix_to_sparse_tensor(buf, array)
+    buf.seek(0)
+    features, _ = read_records_as_numpy(buf)
+    assert np.array_equal(features.toarray(), dense)
+
+
+def test_read_recordio_small_chunks():
+    array = np.arange(60.0).reshape(20, 3)
+    buf = io.BytesIO()
+    write_numpy_to_dense_tensor(buf, array)
+    expected = list(read_recordio(io.BytesIO(buf.getvalue())))
+    with patch('sagemaker.amazon.common._READ_CHUNK_BYTES', 7):
+        assert list(read_recordio(io.BytesIO(buf.getvalue()))) == expected
+    assert len(expected) == 20
+
+
+def test_iter_records_is_lazy():
+    buf = numpy_to_record_serializer()(np.array([[1.0, 2.0], [3.0, 4.0]]))
+    records = iter_records(buf)
+    assert next(records).features["values"].float64_tensor.values == [1.0, 2.0]
+    assert next(records).features["values"].float64_tensor.values == [3.0, 4.0]
+    with pytest.raises(StopIteration):
+        next(records)
+
+
+@pytest.mark.parametrize('chunk_bytes', [7, 1 << 24])
+@pytest.mark.parametrize('dtype, expected_dtype', [('float32', 'float32'), ('float64', 'float64'), ('int64', 'int32')])
+def test_read_records_as_numpy_dense(chunk_bytes, dtype, expected_dtype):
+    array = (np.random.RandomState(5).randn(30, 4) * 300).astype(dtype)
+    labels = np.arange(30) * 5
+    buf = io.BytesIO()
+    write_numpy_to_dense_tensor(buf, array, labels)
+    buf.seek(0)
+    with patch('sagemaker.amazon.common._READ_CHUNK_BYTES', chunk_bytes):
+        features, label_columns = read_records_as_numpy(buf)
+    assert features.dtype == np.dtype(expected_dtype)
+    assert np.array_equal(features, array)
+    assert list(label_columns) == ['values']
+    assert np.array_equal(label_columns['values'], labels)
+
+
+def test_read_records_as_numpy_sparse():
+    array = coo_matrix(([1.0, 2.0, 3.0], ([0, 0, 2], [1, 4, 3])), shape=(3, 5))
+    buf = io.BytesIO()
+    write_spmatrix_to_sparse_tensor(buf, array)
+    buf.seek(0)
+    features, label_columns = read_records_as_numpy(buf)
+    assert features.shape == (3, 5)
+    assert np.array_equal(features.toarray(), array.toarray())
+    assert label_columns == {}
+
+
+def test_read_records_as_numpy_label_keys():
+    buf = io.BytesIO()
+    for cluster, distance in [(1, 0.5), (0, 2.5)]:
+        record = Record()
+        record.label["closest_cluster"].float32_tensor.values.extend([cluster])
+        record.label["distance_to_cluster"].float32_tensor.values.extend([distance])
+        _write_recordio(buf, record.SerializeToString())
+
+    buf.seek(0)
+    features, label_columns = read_records_as_numpy(buf, label_keys=['distance_to_cluster'])
+    assert features is None
+    assert list(label_columns) == ['distance_to_cluster']
+    assert np.array_equal(label_columns['distance_to_cluster'], [0.5, 2.5])
+
+    buf.seek(0)
+    with pytest.raises(ValueError):
+        read_records_as_numpy(buf, label_keys=['projection'])
+
+
+def test_read_records_as_numpy_ragged_features():
+    buf = io.BytesIO()
+    for vector in [[1.0, 2.0], [3.0]]:
+        record = Record()
+        record.features["values"].float64_tensor.values.extend(vector)
+        _write_recordio(buf, record.SerializeToString())
+    buf.seek(0)
+    with pytest.raises(ValueError):
+        read_records_as_numpy(buf)
+
+
+@pytest.mark.parametrize('labels', [None, np.array([0.0, 1.0] * 50)])
+def test_dense_parallel_encoding(labels):
+    array = np.arange(1000, dtype='int64').reshape(100, 10)
+    expected = io.BytesIO()
+    write_numpy_to_dense_tensor(expected, array, labels)
+    with patch('sagemaker.amazon.common._PARALLEL_TASK_BYTES', 400):
+        buf = io.BytesIO()
+        write_numpy_to_dense_tensor(buf, array, labels, processes=2)
+    assert buf.getvalue() == expected.getvalue()
+
+
+@pytest.mark.parametrize('dtype, processes', [('float64', None), ('float64', 2), ('int64', None), ('int64', 2)])
+def test_write_numpy_to_dense_tensor_rows(dtype, processes):
+    array = np.arange(1000, dtype=dtype).reshape(100, 10)
+    labels = np.arange(100, dtype='float32')
+    rows = np.random.RandomState(0).permutation(100)[:60]
+    expected = io.BytesIO()
+    write_numpy_to_dense_tensor(expected, array[rows], labels[rows])
+    with patch('sagemaker.amazon.common._PARALLEL_TASK_BYTES', 400), \
+            patch('sagemaker.amazon.common._ENCODE_BLOCK_BYTES', 400):
+        buf = io.BytesIO()
+        write_numpy_to_dense_tensor(buf, array, labels, processes=processes, rows=rows)
+    assert buf.getvalue() == expected.getvalue()
+
+
+def test_dense_encoder_pool():
+    array = np.arange(1000, dtype='float64').reshape(100, 10)
+    labels = np.arange(100, dtype='float32')
+    rows = np.random.RandomState(0).permutation(100)[:60]
+
+    def expected(features, feature_labels):
+        buf = io.BytesIO()
+        write_numpy_to_dense_tensor(buf, features, feature_labels)
+        return buf.getvalue()
+
+    with patch('sagemaker.amazon.common._PARALLEL_TASK_BYTES', 400), _DenseEncoderPool(3, array, labels) as pool:
+        # The same workers encode every write
+        for shard_rows, shard in [(slice(10, 50), slice(10, 50)), (None, slice(None)), (rows, rows)]:
+            buf = io.BytesIO()
+            pool.write(buf, shard_rows)
+            assert buf.getvalue() == expected(array[shard], labels[shard])
+        buf = io.BytesIO()
+        pool.write_arrays(buf, array[:7] * 2, None)
+        assert buf.getvalue() == expected(array[:7] * 2, None)
+
+
+def test_share_array(tmpdir):
+    array = np.arange(12, dtype='float32').reshape(4, 3)
+    shared = _share_array(array, str(tmpdir))
+    assert np.array_equal(_open_shared_array(shared), array)
+
+    memmap = np.memmap(str(tmpdir.join('array')), dtype='float32', mode='w+', shape=(4, 3))
+    memmap[:] = array
+    memmap.flush()
+    assert _share_array(memmap, str(tmpdir))[0] == str(tmpdir.join('array'))
+    assert np.array_equal(_open_shared_array(_share_array(memmap, str(tmpdir))), array)
+    assert np.array_equal(_open_shared_array(_share_array(memmap[:, 1:], str(tmpdir))), array[:, 1:])
+
+
+def _record_payload(record):
+    return Record.FromString(bytes(record)).features["values"].float64_tensor.values
+
+
+@pytest.mark.parametrize('vectors', [[[1.0, 2.0]] * 3 + [[4.0, 5.0]], [[1.0], [2.0, 3.0], [], [4.0, 5.0, 6.0]]])
+def test_recordio_file(tmpdir, vectors):
+    path = str(tmpdir.join('matrix_0.pbr'))
+    with open(path, 'wb') as f:
+        for vector in vectors:
+            record = Record()
+            record.features["values"].float64_tensor.values.extend(vector)
+            _write_recordio(f, record.SerializeToString())
+
+    with RecordIOFile(path) as records:
+        assert len(records) == len(vectors)
+        assert [list(_record_payload(record)) for record in records] == vectors
+        assert list(_record_payload(records[-1])) == vectors[-1]
+        assert [list(_record_payload(record)) for record in records[1:3]] == vectors[1:3]
+        sample = [list(_record_payload(record)) for record in records.sample(3, random_state=0)]
+        assert len(sample) == 3 and all(vector in vectors for vector in sample)
+    assert tmpdir.join('matrix_0.pbr.idx').check()
+
+    with patch('sagemaker.amazon.common._build_recordio_index') as build_index:
+        with RecordIOFile(path) as records:
+            assert [list(_record_payload(record)) for record in records] == vectors
+    build_index.assert_not_called()
+
+
+def test_recordio_file_stale_index(tmpdir):
+    path = str(tmpdir.join('matrix_0.pbr'))
+    with open(path, 'wb') as f:
+        write_numpy_to_dense_tensor(f, np.array([[1.0, 2.0], [3.0, 4.0]]))
+    RecordIOFile(path).close()
+    with open(path, 'ab') as f:
+        write_numpy_to_dense_tensor(f, np.array([[5.0, 6.0]]))
+
+    with RecordIOFile(path, save_index=False) as records:
+        assert len(records) == 3
+        assert list(_record_payload(records[2])) == [5.0, 6.0]
+
+
+@pytest.mark.parametrize('same_mtime', [False, True])
+def test_recordio_file_stale_index_same_size(tmpdir, same_mtime):
+    path = str(tmpdir.join('matrix_0.pbr'))
+
+    def write(vectors):
+        with open(path, 'wb') as f:
+            for vector in vectors:
+                record = Record()
+                record.features["values"].float64_tensor.values.extend(vector)
+                _write_recordio(f, record.SerializeToString())
+
+    write([[1.0, 2.0], [3.0, 4.0]])
+    RecordIOFile(path).close()
+    stat = os.stat(path)
+    # The rewritten file has the same size, but its second record starts 8 bytes earlier
+    write([[1.0], [2.0, 3.0, 4.0]])
+    assert os.stat(path).st_size == stat.st_size
+    if same_mtime:
+        os.utime(path, (stat.st_atime, stat.st_mtime))
+    else:
+        os.utime(path, (stat.st_atime, stat.st_mtime + 1))
+
+    with RecordIOFile(path) as records:
+        assert [list(_record_payload(record)) for record in records] == [[1.0], [2.0, 3.0, 4.0]]
+
+
+def test_recordio_file_closed_on_error(tmpdir):
+    path = str(tmpdir.join('matrix_0.pbr'))
+    with open(path, 'wb') as f:
+        f.write(b'not a recordio file')
+    opened = []
+    real_open = open
+
+    def tracking_open(*args, **kwargs):
+        opened.append(real_open(*args, **kwargs))
+        return opened[-1]
+
+    with patch('sagemaker.amazon.common.open', tracking_open, create=True):
+        with pytest.raises(AssertionError):
+            RecordIOFile(path)
+    assert opened[0].closed
+
+
+def test_recordio_file_empty(tmpdir):
+    path = str(tmpdir.join('empty.pbr'))
+    open(path, 'wb').close()
+    with RecordIOFile(path, index_path=str(tmpdir.join('index'))) as records:
+        assert len(records) == 0
+        assert list(records) == []
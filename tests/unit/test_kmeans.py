@@ -17,6 +17,7 @@ from mock import Mock, patch
 
 from sagemaker.amazon.kmeans import KMeans, KMeansPredictor
 from sagemaker.amazon.amazon_estimator import registry, RecordSet
+from sagemaker.amazon.common import record_deserializer, record_to_numpy_deserializer
 
 ROLE = 'myrole'
 TRAIN_INSTANCE_COUNT = 1
@@ -221,3 +222,9 @@ def test_predictor_type(sagemaker_session):
     predictor = model.deploy(1, TRAIN_INSTANCE_TYPE)
 
     assert isinstance(predictor, KMeansPredictor)
+
+
+def test_predictor_return_numpy(sagemaker_session):
+    assert isinstance(KMeansPredictor('kmeans-endpoint', sagemaker_session).deserializer, record_deserializer)
+    predictor = KMeansPredictor('kmeans-endpoint', sagemaker_session, return_numpy=True)
+    assert isinstance(predictor.deserializer, record_to_numpy_deserializer)
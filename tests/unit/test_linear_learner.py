@@ -17,6 +17,7 @@ from mock import Mock, patch
 
 from sagemaker.amazon.linear_learner import LinearLearner, LinearLearnerPredictor
 from sagemaker.amazon.amazon_estimator import registry, RecordSet
+from sagemaker.amazon.common import record_serializer
 
 ROLE = 'myrole'
 TRAIN_INSTANCE_COUNT = 1
@@ -320,3 +321,8 @@ def test_predictor_type(sagemaker_session):
     predictor = model.deploy(1, TRAIN_INSTANCE_TYPE)
 
     assert isinstance(predictor, LinearLearnerPredictor)
+
+
+def test_predictor_serializer(sagemaker_session):
+    predictor = LinearLearnerPredictor('linear-learner-endpoint', sagemaker_session)
+    assert isinstance(predictor.serializer, record_serializer)
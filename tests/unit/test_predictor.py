@@ -16,13 +16,18 @@ import io
 import json
 import os
 import pytest
-from mock import Mock
+import threading
+from botocore.client import BaseClient
+from botocore.exceptions import ClientError
+from concurrent import futures
+from mock import Mock, patch
 
 import numpy as np
 
-from sagemaker.predictor import RealTimePredictor
+from sagemaker.predictor import BatchingPredictor, PredictionCache, PredictorMetrics, RealTimePredictor
 from sagemaker.predictor import json_serializer, json_deserializer, csv_serializer, BytesDeserializer, \
-    StringDeserializer, StreamDeserializer, numpy_deserializer, npy_serializer, _NumpyDeserializer
+    StringDeserializer, StreamDeserializer, numpy_deserializer, npy_serializer, _NumpyDeserializer, \
+    _CsvSerializer, _csv_serialize_object, _parse_csv_numeric, _JsonSerializer, _JsonDeserializer
 from tests.unit import DATA_DIR
 
 # testing serialization functions
@@ -75,6 +80,52 @@ def test_json_serializer_csv_buffer():
         assert result == validation_value
 
 
+class _CompactJson(object):
+    """A JSON backend module writing compact JSON text."""
+
+    @staticmethod
+    def dumps(value):
+        return json.dumps(value, separators=(',', ':'))
+
+    @staticmethod
+    def loads(data):
+        return json.loads(data.decode('utf-8'))
+
+
+def test_json_serializer_backend():
+    serializer = _JsonSerializer(json_backend=_CompactJson)
+
+    assert serializer(np.array([[1, 2], [3, 4]])) == '[[1,2],[3,4]]'
+    assert serializer({'a': np.array([1.5]), 'b': 'c'}) == '{"a":[1.5],"b":"c"}'
+
+
+def test_json_serializer_numpy_backend():
+    backend = Mock(OPT_SERIALIZE_NUMPY=1, dumps=Mock(return_value=b'[]'))
+    serializer = _JsonSerializer(json_backend=backend)
+    array = np.ones((2, 3))
+
+    serializer({'a': array, 'b': np.ones((3, 2)).T, 'c': np.array(['x'])})
+
+    (value,), kwargs = backend.dumps.call_args
+    assert value['a'] is array
+    assert value['b'] == np.ones((2, 3)).tolist()
+    assert value['c'] == ['x']
+    assert kwargs == {'option': 1}
+
+
+def test_json_serializer_orjson():
+    orjson = pytest.importorskip('orjson')
+    array = np.random.RandomState(0).randn(20, 3)
+
+    assert json.loads(_JsonSerializer(json_backend=orjson)({'instances': array})) == {'instances': array.tolist()}
+
+
+def test_json_deserializer_backend():
+    result = _JsonDeserializer(json_backend=_CompactJson)(io.BytesIO(b'{"a": [1, 2]}'), 'application/json')
+
+    assert result == {'a': [1, 2]}
+
+
 def test_csv_serializer_str():
     original = '1,2,3'
     result = csv_serializer('1,2,3')
@@ -141,6 +192,39 @@ def test_csv_serializer_csv_reader():
         assert result == validation_data
 
 
+@pytest.mark.parametrize('dtype', ['float64', 'float32', 'float16', 'int32', 'uint8', 'bool'])
+def test_csv_serializer_numpy_matches_csv_writer(dtype):
+    values = np.random.RandomState(0).randn(50, 7) * 10.0 ** np.arange(-10, 11, 3)
+    values[0, :3] = [np.nan, np.inf, -0.0]
+    array = values.astype(dtype) if dtype.startswith('float') else (values > 0).astype(dtype)
+
+    expected = '\n'.join(_csv_serialize_object(row) for row in array)
+
+    assert csv_serializer(array) == expected
+    assert csv_serializer(array[0]) == _csv_serialize_object(array[0])
+
+
+def test_csv_serializer_numpy_multidimensional():
+    array = np.arange(12).reshape(2, 3, 2)
+
+    assert csv_serializer(array) == '0,1,2,3,4,5\n6,7,8,9,10,11'
+
+
+def test_csv_serializer_dataframe():
+    pd = pytest.importorskip('pandas')
+    frame = pd.DataFrame({'a': [1.5, 2.0], 'b': [3, 4]}, index=['x', 'y'])
+
+    assert csv_serializer(frame) == '1.5,3.0\n2.0,4.0'
+    assert csv_serializer(pd.DataFrame({'a': ['p,q', 'r'], 'b': [1, 2]})) == '"p,q",1\nr,2'
+
+
+def test_csv_serializer_float_precision():
+    serializer = _CsvSerializer(float_precision=3)
+
+    assert serializer(np.array([[1.23456, 1e-7], [100.0, 2.5]])) == '1.23,1e-07\n100,2.5'
+    assert serializer(np.array([[12345, 2]])) == '12345,2'
+
+
 def test_json_deserializer_array():
     result = json_deserializer(io.BytesIO(b'[1, 2, 3]'), 'application/json')
 
@@ -182,7 +266,7 @@ def test_npy_serializer_python_array():
     array = [1, 2, 3]
     result = npy_serializer(array)
 
-    assert np.array_equal(array, np.load(io.BytesIO(result)))
+    assert np.array_equal(array, np.load(result))
 
 
 def test_npy_serializer_python_array_with_dtype():
@@ -191,7 +275,7 @@ def test_npy_serializer_python_array_with_dtype():
 
     result = npy_serializer(array, dtype)
 
-    deserialized = np.load(io.BytesIO(result))
+    deserialized = np.load(result)
     assert np.array_equal(array, deserialized)
     assert deserialized.dtype == dtype
 
@@ -200,21 +284,21 @@ def test_npy_serializer_numpy_valid_2_dimensional():
     array = np.array([[1, 2, 3], [3, 4, 5]])
     result = npy_serializer(array)
 
-    assert np.array_equal(array, np.load(io.BytesIO(result)))
+    assert np.array_equal(array, np.load(result))
 
 
 def test_npy_serializer_numpy_valid_multidimensional():
     array = np.ones((10, 10, 10, 10))
     result = npy_serializer(array)
 
-    assert np.array_equal(array, np.load(io.BytesIO(result)))
+    assert np.array_equal(array, np.load(result))
 
 
 def test_npy_serializer_numpy_valid_list_of_strings():
     array = np.array(['one', 'two', 'three'])
     result = npy_serializer(array)
 
-    assert np.array_equal(array, np.load(io.BytesIO(result)))
+    assert np.array_equal(array, np.load(result))
 
 
 def test_npy_serializer_from_buffer_or_file():
@@ -233,7 +317,30 @@ def test_npy_serializer_object():
 
     result = npy_serializer(object)
 
-    assert np.array_equal(np.array(object), np.load(io.BytesIO(result)))
+    assert np.array_equal(np.array(object), np.load(result))
+
+
+def test_npy_serializer_zero_copy():
+    array = np.asfortranarray(np.arange(12, dtype='float32').reshape(3, 4))
+    expected = io.BytesIO()
+    np.save(expected, array)
+
+    result = npy_serializer(array)
+    array[0, 0] = -1
+
+    assert len(result) == len(expected.getvalue())
+    assert np.load(result)[0, 0] == -1
+    result.seek(0)
+    assert result.read(10) + result.read() == expected.getvalue().replace(
+        np.float32(0).tobytes(), np.float32(-1).tobytes(), 1)
+
+
+def test_npy_serializer_non_contiguous():
+    array = np.arange(24).reshape(4, 6)[::2, 1::2]
+    expected = io.BytesIO()
+    np.save(expected, array)
+
+    assert npy_serializer(array).read() == expected.getvalue()
 
 
 def test_npy_serializer_list_of_empty():
@@ -272,6 +379,28 @@ def test_numpy_deser_from_csv_alpha():
     assert np.array_equal(arr, np.array([['hello', 2, 3], [4, 5, 6]]))
 
 
+@pytest.mark.parametrize('data', [b'1,2,3\n4,5,6\n', b'1.5,2.0\n3,4e3', b'nan,1.0\r\n-inf,.5\r\n', b'1\n2\n3', b'7',
+                                  b'1.5,2\n3.5,4', b'1,,3\n4,5,6', b'1,2\n\n3,4'])
+@pytest.mark.parametrize('dtype', [None, 'float32', 'int64'])
+def test_numpy_deser_from_csv_matches_genfromtxt(data, dtype):
+    expected = np.genfromtxt(io.BytesIO(data), delimiter=',', dtype=dtype)
+
+    arr = _NumpyDeserializer(dtype=dtype)(io.BytesIO(data), 'text/csv')
+
+    assert arr.dtype == expected.dtype
+    assert arr.shape == expected.shape
+    assert np.array_equal(arr, expected) or np.array_equal(np.isnan(arr), np.isnan(expected))
+
+
+def test_parse_csv_numeric_fallbacks():
+    assert _parse_csv_numeric(b'1,2\n3,4', None).dtype == np.int64
+    # Ragged rows, missing and non-numeric values, and mixed integer and float columns
+    for data in [b'1,2\n3,4,5\n6', b'1,,3', b'a,1', b'1.5,2\n3.5,4']:
+        assert _parse_csv_numeric(data, None) is None
+    assert _parse_csv_numeric(b'1.5\n2', 'int32') is None
+    assert _parse_csv_numeric(b'1,2', 'U5') is None
+
+
 def test_numpy_deser_from_json():
     arr = numpy_deserializer(io.BytesIO(b'[[1,2,3],\n[4,5,6]]'), 'application/json')
     assert np.array_equal(arr, np.array([[1, 2, 3], [4, 5, 6]]))
@@ -299,6 +428,29 @@ def test_numpy_deser_from_npy():
     assert np.array_equal(array, result)
 
 
+@pytest.mark.parametrize('array', [np.arange(12.).reshape(3, 4), np.asfortranarray(np.arange(12).reshape(3, 4)),
+                                   np.array(['one', 'two']), np.array(5.0), np.zeros((0, 3))])
+def test_numpy_deser_from_npy_reads_into_array(array):
+    stream = io.BytesIO()
+    np.save(stream, array)
+    stream.seek(0)
+
+    result = numpy_deserializer(stream, 'application/x-npy')
+
+    assert np.array_equal(array, result)
+    assert result.dtype == array.dtype
+    assert result.flags.writeable
+    assert np.isfortran(result) == np.isfortran(array)
+
+
+def test_numpy_deser_from_npy_truncated():
+    stream = io.BytesIO()
+    np.save(stream, np.ones((2, 3)))
+
+    with pytest.raises(ValueError):
+        numpy_deserializer(io.BytesIO(stream.getvalue()[:-8]), 'application/x-npy')
+
+
 def test_numpy_deser_from_npy_object_array():
     array = np.array(['one', 'two'])
     stream = io.BytesIO()
@@ -313,6 +465,7 @@ def test_numpy_deser_from_npy_object_array():
 
 
 ENDPOINT = 'mxnet_endpoint'
+REGION = 'us-west-2'
 BUCKET_NAME = 'mxnet_endpoint'
 DEFAULT_CONTENT_TYPE = 'application/json'
 CSV_CONTENT_TYPE = 'text/csv'
@@ -447,3 +600,414 @@ def test_predict_call_with_headers_and_csv():
     assert kwargs == expected_request_args
 
     assert result == CSV_RETURN_VALUE
+
+
+def _body_bytes(body):
+    if hasattr(body, 'read'):
+        body.seek(0)
+        return body.read()
+    if isinstance(body, str):
+        return body.encode('utf-8')
+    return bytes(body)
+
+
+def echo_sagemaker_session():
+    ims = Mock(name='sagemaker_session')
+    ims.sagemaker_runtime_client = Mock(name='sagemaker_runtime')
+    ims.sagemaker_runtime_client.invoke_endpoint = Mock(
+        name='invoke_endpoint',
+        side_effect=lambda **kwargs: {'Body': io.BytesIO(_body_bytes(kwargs['Body'])),
+                                      'ContentType': kwargs.get('ContentType', CSV_CONTENT_TYPE)})
+    return ims
+
+
+def test_predict_async():
+    sagemaker_session = echo_sagemaker_session()
+    predictor = RealTimePredictor(ENDPOINT, sagemaker_session)
+
+    future = predictor.predict_async(b'1,2', initial_args={'CustomAttributes': 'attributes'})
+
+    assert future.result() == b'1,2'
+    call_args, kwargs = sagemaker_session.sagemaker_runtime_client.invoke_endpoint.call_args
+    assert kwargs == {'Body': b'1,2', 'EndpointName': ENDPOINT, 'CustomAttributes': 'attributes'}
+    predictor.close()
+
+
+def test_predict_async_thread_clients():
+    sagemaker_session = echo_sagemaker_session()
+    client = Mock(spec=BaseClient)
+    client.meta = Mock(region_name=REGION, endpoint_url='https://runtime', config='config')
+    sagemaker_session.sagemaker_runtime_client = client
+    thread_client = sagemaker_session.boto_session.client.return_value
+    thread_client.invoke_endpoint = Mock(side_effect=lambda **kwargs: {'Body': io.BytesIO(kwargs['Body'])})
+    predictor = RealTimePredictor(ENDPOINT, sagemaker_session, max_concurrency=1)
+
+    assert predictor.predict_async(b'1').result() == b'1'
+    assert predictor.predict_async(b'2').result() == b'2'
+
+    sagemaker_session.boto_session.client.assert_called_once_with('runtime.sagemaker', region_name=REGION,
+                                                                  endpoint_url='https://runtime', config='config')
+    assert thread_client.invoke_endpoint.call_count == 2
+    predictor.close()
+
+
+def test_predict_many_async_order_and_backpressure():
+    sagemaker_session = echo_sagemaker_session()
+    predictor = RealTimePredictor(ENDPOINT, sagemaker_session, max_concurrency=4)
+    consumed = []
+
+    def inputs():
+        for i in range(20):
+            consumed.append(i)
+            yield str(i).encode('utf-8')
+
+    results = predictor.predict_many_async(inputs(), max_in_flight=3)
+    assert next(results) == b'0'
+    assert len(consumed) == 4
+    assert list(results) == [str(i).encode('utf-8') for i in range(1, 20)]
+    predictor.close()
+
+
+def test_predict_many_async_error():
+    sagemaker_session = echo_sagemaker_session()
+    invoke_endpoint = sagemaker_session.sagemaker_runtime_client.invoke_endpoint.side_effect
+
+    def fail_on_two(**kwargs):
+        if kwargs['Body'] == b'2':
+            raise RuntimeError('Invocation failed')
+        return invoke_endpoint(**kwargs)
+
+    sagemaker_session.sagemaker_runtime_client.invoke_endpoint.side_effect = fail_on_two
+    predictor = RealTimePredictor(ENDPOINT, sagemaker_session)
+    results = predictor.predict_many_async([b'0', b'1', b'2', b'3'])
+
+    assert [next(results), next(results)] == [b'0', b'1']
+    with pytest.raises(RuntimeError):
+        next(results)
+    with pytest.raises(ValueError):
+        list(predictor.predict_many_async([b'0'], max_in_flight=-1))
+    predictor.close()
+
+
+def test_predict_batch_numpy():
+    sagemaker_session = echo_sagemaker_session()
+    predictor = RealTimePredictor(ENDPOINT, sagemaker_session, serializer=npy_serializer,
+                                  deserializer=numpy_deserializer)
+    data = np.arange(3000, dtype='float64').reshape(1000, 3)
+
+    result = predictor.predict_batch(data, max_payload_mb=.01)
+
+    assert np.array_equal(result, data)
+    bodies = [_body_bytes(kwargs['Body']) for _, kwargs in
+              sagemaker_session.sagemaker_runtime_client.invoke_endpoint.call_args_list]
+    assert len(bodies) > 1
+    assert all(len(body) <= .01 * 1024 * 1024 for body in bodies)
+    predictor.close()
+
+
+def test_predict_batch_max_rows_and_lists():
+    sagemaker_session = echo_sagemaker_session()
+    predictor = RealTimePredictor(ENDPOINT, sagemaker_session, serializer=json_serializer,
+                                  deserializer=json_deserializer)
+    data = [[i, i + 1] for i in range(25)]
+
+    assert predictor.predict_batch(data, max_rows=10, concurrency=2) == data
+    assert sagemaker_session.sagemaker_runtime_client.invoke_endpoint.call_count == 3
+    predictor.close()
+
+
+def test_predict_batch_shrinks_chunks():
+    sagemaker_session = echo_sagemaker_session()
+    predictor = RealTimePredictor(ENDPOINT, sagemaker_session, serializer=csv_serializer,
+                                  deserializer=StringDeserializer())
+    # Rows after the first ones serialize much larger than the rows used to estimate the chunk size
+    data = [['1']] * 64 + [['1' * 500]] * 100
+
+    result = predictor.predict_batch(data, max_payload_mb=.01)
+
+    assert '\n'.join(result).split('\n') == [row[0] for row in data]
+    for _, kwargs in sagemaker_session.sagemaker_runtime_client.invoke_endpoint.call_args_list:
+        assert len(_body_bytes(kwargs['Body'])) <= .01 * 1024 * 1024
+    predictor.close()
+
+
+def test_predict_batch_dicts():
+    sagemaker_session = Mock(name='sagemaker_session')
+    sagemaker_session.sagemaker_runtime_client.invoke_endpoint = Mock(
+        side_effect=lambda **kwargs: {'Body': io.BytesIO(json.dumps(
+            {'predictions': json.loads(kwargs['Body']), 'version': 1}).encode('utf-8')),
+            'ContentType': 'application/json'})
+    predictor = RealTimePredictor(ENDPOINT, sagemaker_session, serializer=json_serializer,
+                                  deserializer=json_deserializer)
+
+    result = predictor.predict_batch(np.arange(12).reshape(6, 2), max_rows=4)
+
+    assert result == {'predictions': [[0, 1], [2, 3], [4, 5], [6, 7], [8, 9], [10, 11]], 'version': 1}
+    predictor.close()
+
+
+def test_predict_batch_errors():
+    predictor = RealTimePredictor(ENDPOINT, echo_sagemaker_session(), serializer=csv_serializer)
+
+    with pytest.raises(ValueError):
+        predictor.predict_batch([['1' * 100]], max_payload_mb=.00001)
+    with pytest.raises(ValueError):
+        predictor.predict_batch(np.ones((0, 2)))
+    with pytest.raises(ValueError):
+        RealTimePredictor(ENDPOINT, echo_sagemaker_session()).predict_batch(np.ones((2, 2)))
+    with pytest.raises(ValueError):
+        predictor.predict_batch(np.ones((2, 2)), concurrency=predictor.max_concurrency + 1)
+    with pytest.raises(ValueError):
+        predictor.predict_batch(np.ones((2, 2)), concurrency=0)
+    predictor.close()
+
+
+def test_predict_batch_single_request():
+    sagemaker_session = echo_sagemaker_session()
+    predictor = RealTimePredictor(ENDPOINT, sagemaker_session, serializer=csv_serializer)
+
+    assert predictor.predict_batch(np.array([1, 2, 3])) == b'1,2,3'
+    assert sagemaker_session.sagemaker_runtime_client.invoke_endpoint.call_count == 1
+
+
+def _client_error(code, status):
+    return ClientError({'Error': {'Code': code, 'Message': code},
+                        'ResponseMetadata': {'HTTPStatusCode': status}}, 'InvokeEndpoint')
+
+
+def npy_echo_predictor(fail_on_negative=False, error=None):
+    sagemaker_session = echo_sagemaker_session()
+    invoke_endpoint = sagemaker_session.sagemaker_runtime_client.invoke_endpoint.side_effect
+
+    def invoke_negative(**kwargs):
+        if fail_on_negative and (np.load(io.BytesIO(_body_bytes(kwargs['Body']))) < 0).any():
+            raise error or _client_error('ModelError', 424)
+        return invoke_endpoint(**kwargs)
+
+    sagemaker_session.sagemaker_runtime_client.invoke_endpoint.side_effect = invoke_negative
+    return RealTimePredictor(ENDPOINT, sagemaker_session, serializer=npy_serializer, deserializer=numpy_deserializer)
+
+
+def _request_rows(predictor):
+    return [len(np.load(io.BytesIO(_body_bytes(kwargs['Body'])))) for _, kwargs in
+            predictor.sagemaker_session.sagemaker_runtime_client.invoke_endpoint.call_args_list]
+
+
+def test_batching_predictor_combines_rows():
+    predictor = npy_echo_predictor()
+    batching = BatchingPredictor(predictor, max_batch_size=4, max_latency_ms=60000)
+
+    results = [batching.predict_async(np.array([i, i + 1])) for i in range(8)]
+
+    for i, result in enumerate(results):
+        assert np.array_equal(result.result(), [[i, i + 1]])
+    assert _request_rows(predictor) == [4, 4]
+    batching.close()
+    predictor.close()
+
+
+def test_batching_predictor_max_latency():
+    predictor = npy_echo_predictor()
+    batching = BatchingPredictor(predictor, max_batch_size=100, max_latency_ms=20)
+
+    results = [batching.predict_async([i, i]) for i in range(3)]
+
+    assert [result.result(timeout=10).tolist() for result in results] == [[[0, 0]], [[1, 1]], [[2, 2]]]
+    assert sum(_request_rows(predictor)) == 3
+    batching.close()
+    predictor.close()
+
+
+def test_batching_predictor_isolates_errors():
+    predictor = npy_echo_predictor(fail_on_negative=True)
+    batching = BatchingPredictor(predictor, max_batch_size=3, max_latency_ms=60000)
+
+    results = [batching.predict_async(np.array([value])) for value in (1, -1, 2)]
+
+    assert np.array_equal(results[0].result(), [[1]])
+    with pytest.raises(ClientError):
+        results[1].result()
+    assert np.array_equal(results[2].result(), [[2]])
+    assert _request_rows(predictor) == [3, 1, 1, 1]
+    batching.close()
+    predictor.close()
+
+
+@pytest.mark.parametrize('error', [_client_error('ThrottlingException', 400),
+                                   _client_error('ServiceUnavailable', 503)])
+def test_batching_predictor_fails_batch_on_endpoint_errors(error):
+    predictor = npy_echo_predictor(fail_on_negative=True, error=error)
+    batching = BatchingPredictor(predictor, max_batch_size=3, max_latency_ms=60000)
+
+    results = [batching.predict_async(np.array([value])) for value in (1, -1, 2)]
+
+    for result in results:
+        with pytest.raises(ClientError):
+            result.result(timeout=10)
+    assert _request_rows(predictor) == [3]
+    batching.close()
+    predictor.close()
+
+
+def test_batching_predictor_timeout():
+    predictor = npy_echo_predictor()
+    invoke_endpoint = predictor.sagemaker_session.sagemaker_runtime_client.invoke_endpoint
+    respond = invoke_endpoint.side_effect
+    release = threading.Event()
+    invoke_endpoint.side_effect = lambda **kwargs: release.wait(10) and respond(**kwargs)
+    batching = BatchingPredictor(predictor, max_batch_size=2, max_latency_ms=0, timeout=0.05)
+
+    with pytest.raises(futures.TimeoutError):
+        batching.predict(np.array([1, 2]))
+    release.set()
+    assert np.array_equal(batching.predict(np.array([3, 4])), [[3, 4]])
+    with pytest.raises(ValueError):
+        BatchingPredictor(predictor, timeout=0)
+    batching.close()
+    predictor.close()
+
+
+def test_batching_predictor_close():
+    predictor = npy_echo_predictor()
+    batching = BatchingPredictor(predictor, max_batch_size=10, max_latency_ms=60000)
+    result = batching.predict_async(np.array([1, 2]))
+
+    batching.close()
+
+    assert np.array_equal(result.result(timeout=10), [[1, 2]])
+    with pytest.raises(RuntimeError):
+        batching.predict(np.array([1, 2]))
+    with pytest.raises(ValueError):
+        BatchingPredictor(predictor, max_batch_size=0)
+    predictor.close()
+
+
+def test_predict_cache():
+    sagemaker_session = echo_sagemaker_session()
+    cache = PredictionCache(max_size=2)
+    predictor = RealTimePredictor(ENDPOINT, sagemaker_session, serializer=csv_serializer,
+                                  deserializer=StringDeserializer(), cache=cache)
+    invoke_endpoint = sagemaker_session.sagemaker_runtime_client.invoke_endpoint
+
+    assert predictor.predict([1, 2]) == '1,2'
+    assert predictor.predict([1, 2]) == '1,2'
+    assert invoke_endpoint.call_count == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    predictor.predict([1, 2], initial_args={'CustomAttributes': 'a'})
+    predictor.predict([1, 2], use_cache=False)
+    assert invoke_endpoint.call_count == 3
+
+    # [1, 2] with CustomAttributes is the least recently used inference when [3] is stored
+    predictor.predict([1, 2])
+    predictor.predict([3])
+    predictor.predict([1, 2], initial_args={'CustomAttributes': 'a'})
+    assert invoke_endpoint.call_count == 5
+    assert len(cache) == 2
+
+    cache.clear()
+    assert (len(cache), cache.hits, cache.misses) == (0, 0, 0)
+
+
+def test_predict_cache_streams():
+    sagemaker_session = echo_sagemaker_session()
+    predictor = RealTimePredictor(ENDPOINT, sagemaker_session, serializer=npy_serializer,
+                                  deserializer=StreamDeserializer(), cache=PredictionCache())
+
+    predictor.predict(np.ones(3))
+    predictor.predict(np.ones(3))
+    assert sagemaker_session.sagemaker_runtime_client.invoke_endpoint.call_count == 2
+
+    predictor.deserializer = numpy_deserializer
+    for _ in range(2):
+        assert np.array_equal(predictor.predict(np.ones(3)), np.ones(3))
+    assert sagemaker_session.sagemaker_runtime_client.invoke_endpoint.call_count == 3
+
+
+@patch('time.time')
+def test_prediction_cache_ttl(time):
+    cache = PredictionCache(ttl=10)
+    time.return_value = 100
+    cache.put('key', None)
+
+    time.return_value = 110
+    assert cache.get('key', 'missing') is None
+    time.return_value = 111
+    assert cache.get('key', 'missing') == 'missing'
+    assert (cache.hits, cache.misses, len(cache)) == (1, 1, 0)
+    with pytest.raises(ValueError):
+        PredictionCache(max_size=0)
+
+
+def test_predict_metrics():
+    sagemaker_session = echo_sagemaker_session()
+    recorded = []
+    predictor = RealTimePredictor(ENDPOINT, sagemaker_session, serializer=csv_serializer,
+                                  deserializer=StringDeserializer(), cache=PredictionCache(),
+                                  metrics=PredictorMetrics(callback=lambda name, value: recorded.append(name)))
+
+    predictor.predict([1, 2])
+    predictor.predict([1, 2, 3])
+    predictor.predict([1, 2])
+
+    metrics = predictor.metrics()
+    assert sorted(metrics) == ['deserialize_seconds', 'invoke_endpoint_seconds', 'predict_seconds',
+                               'request_bytes', 'serialize_seconds']
+    assert metrics['serialize_seconds']['count'] == 3
+    assert metrics['invoke_endpoint_seconds']['count'] == 2
+    assert (metrics['request_bytes']['min'], metrics['request_bytes']['max']) == (3, 5)
+    assert metrics['request_bytes']['sum'] == 11
+    assert recorded.count('request_bytes') == 3
+    assert recorded[:2] == ['serialize_seconds', 'request_bytes']
+
+    predictor._metrics.reset()
+    assert predictor.metrics() == {}
+
+
+def test_predict_metrics_response_bytes():
+    sagemaker_session = empty_sagemaker_session()
+    sagemaker_session.sagemaker_runtime_client.invoke_endpoint.return_value = {
+        'Body': io.BytesIO(b'result'), 'ResponseMetadata': {'HTTPHeaders': {'content-length': '6'}}}
+    predictor = RealTimePredictor(ENDPOINT, sagemaker_session, metrics=PredictorMetrics())
+
+    assert predictor.predict(b'data') == b'result'
+    assert predictor.metrics()['response_bytes']['p50'] == 6
+
+
+def test_predict_metrics_request_streams():
+    sagemaker_session = empty_sagemaker_session()
+    sagemaker_session.sagemaker_runtime_client.invoke_endpoint.return_value = {'Body': io.BytesIO(b'result')}
+    predictor = RealTimePredictor(ENDPOINT, sagemaker_session, metrics=PredictorMetrics())
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, b'data')
+    os.close(write_fd)
+
+    # The size of a stream that is not seekable is not recorded
+    with os.fdopen(read_fd, 'rb') as pipe:
+        assert predictor.predict(pipe) == b'result'
+    assert 'request_bytes' not in predictor.metrics()
+
+    sagemaker_session.sagemaker_runtime_client.invoke_endpoint.return_value = {'Body': io.BytesIO(b'result')}
+    body = io.BytesIO(b'header,data')
+    body.seek(7)
+    predictor.predict(body)
+    assert predictor.metrics()['request_bytes']['sum'] == 4
+
+
+def test_predict_without_metrics():
+    predictor = RealTimePredictor(ENDPOINT, echo_sagemaker_session())
+
+    predictor.predict(b'1,2')
+    assert predictor.metrics() == {}
+
+
+def test_predictor_metrics_percentiles():
+    metrics = PredictorMetrics()
+    for value in range(101):
+        metrics.record('latency', value)
+
+    statistics = metrics.snapshot()['latency']
+    assert (statistics['count'], statistics['min'], statistics['max'], statistics['mean']) == (101, 0, 100, 50)
+    for q in (50, 90, 99):
+        assert statistics['p%d' % q] == pytest.approx(q, rel=0.05)
+    assert PredictorMetrics().snapshot() == {}